@@ -0,0 +1,381 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script is an asyncio version of the Database class in parse_and_insert.py, built on asyncpg. It has the same
+    operations (insert_and_return, select, select_multiple, df_to_db), but every one of them is a coroutine that borrows a
+    connection from an asyncpg pool for as long as it runs. That way, one process (and one thread) can drive many table
+    loads and exports at the same time with asyncio.gather, instead of one thread and one connection per upload.
+
+    COPY in: df_to_db streams the PostgreSQL binary COPY format (pg_copy.py) to copy_to_table as an async iterable. Each
+    batch is encoded in a worker thread, so the event loop keeps serving the other uploads while it is encoded. If the
+    binary COPY fails, or a batch can't be encoded, the CSV format is tried instead (only possible for a data frame, which
+    can be read twice).
+
+    COPY out: select_multiple_batches streams COPY (SELECT ...) TO STDOUT WITH CSV from copy_from_query into a
+    CopyOutParser (pg_copy.py), which parses it into Polars data frames a batch at a time, using the column types of the
+    table rather than inferring them.
+
+Usage:  python(3) async_database.py [number of rows]
+    - Use with get_topics.py, pg_copy.py, and raw_data_db_launch.sql (the tables need to exist)
+    - Running this script checks the backend against a local PostgreSQL database: synthetic data frames are loaded into
+      every table at the same time, read back at the same time, the row counts are compared, and the rows are deleted. An
+      iterator of batches with different column types is also written, which has to be rejected without inserting a row.
+    - Need to know before using:
+        - database connection parameters: username, password, server, port, database name
+
+    From other scripts:
+        db = await AsyncDatabase.connect(username, password, server, port, db_name)
+        bag_id = await db.select('bag_files', 'id', 'bag_file_name', bag_file)
+        await asyncio.gather(*[db.df_to_db(table_name, df, db_col_lst) for table_name, df, db_col_lst in job_lst])
+        df_lst = await asyncio.gather(*[db.select_multiple(table_name, 'bag_files_id', bag_id) for table_name in table_lst])
+        await db.disconnect()
+
+Packages to Install:
+    pip install asyncpg
+
+Method(s):
+    1. class AsyncDatabase(pool)
+        asyncio version of the Database class. Create it with await AsyncDatabase.connect(...).
+
+    2. iter_async_chunks(chunks)
+        Turn an iterator of bytes into an async iterator, pulling each chunk (and so encoding each batch) in a worker
+        thread.
+'''
+import asyncio
+import sys
+import time
+
+import asyncpg
+import polars as pl
+
+from get_topics import get_topics
+from pg_copy import can_encode_binary, encode_error_types, iter_batches, iter_binary_copy, iter_csv_copy, pg_type_dict, CopyOutParser
+
+'''
+Turn an iterator of bytes into an async iterator for copy_to_table. Each chunk is pulled from the iterator in a worker thread,
+so encoding a batch doesn't hold up the event loop.
+'''
+async def iter_async_chunks(chunks):
+    iterator = iter(chunks)
+
+    while True:
+        chunk = await asyncio.to_thread(next, iterator, None)
+        if chunk is None:
+            break
+
+        yield chunk
+
+'''
+    =================================== Class AsyncDatabase =======================================
+    #	Purpose: An asyncio version of the Database class in parse_and_insert.py. Every method is a
+    #            coroutine that borrows a connection from the pool while it runs, so many of them can
+    #            run at the same time with asyncio.gather. Each method runs in its own transaction.
+    #
+    #   Methods:
+    #       1. async def connect(cls, username, password, server, port, db_name, min_conn = 1, max_conn = 10)
+    #           Create the connection pool and return a new AsyncDatabase.
+    #
+    #       2. async def insert_and_return(self, table_name, col_lst, val_lst)
+    #           Insert a new row into a specific table. Returns the id of the new row.
+    #           Query: INSERT INTO table_name (cols) VALUES ($1, ...) RETURNING id;
+    #
+    #       3. async def select(self, table_name, col1, col2, val)
+    #           Select a singular row from a specific table and return col1 of this row. The value is
+    #           inserted if it isn't in the table yet.
+    #           Query: SELECT col1 FROM table_name WHERE col2 = $1;
+    #
+    #       4. async def select_multiple_batches(self, table_name, col, val, batch_function, batch_mb = 64)
+    #           Stream the rows of a table where col = val out with COPY, parsing them into Polars data
+    #           frames a batch at a time. Each batch is handed to batch_function. Returns the number of rows.
+    #           Query: COPY (SELECT * FROM table_name WHERE col = $1) TO STDOUT WITH CSV
+    #
+    #       5. async def select_multiple(self, table_name, col, val)
+    #           Same as select_multiple_batches, but returns one data frame.
+    #
+    #       6. async def df_to_db(self, table_name, df, db_col_lst, copy_format = 'binary', max_buffer_mb = 64)
+    #           Insert a data frame (or an iterator of record batches) with a streamed binary COPY, falling
+    #           back to CSV. Returns True if the data was inserted and False otherwise.
+    #           Query: COPY table_name (db_col_lst) FROM STDIN WITH (FORMAT binary)
+    #
+    #       7. async def delete_rows(self, table_name, col, val)
+    #           Delete every row of a table where col = val. Returns the number of rows deleted.
+    #           Query: DELETE FROM table_name WHERE col = $1;
+    #
+    #       8. async def disconnect(self)
+    #           Close every connection of the pool.
+    ===============================================================================================
+'''
+class AsyncDatabase:
+    def __init__(self, pool):
+        self.pool = pool
+
+    '''
+    Create the connection pool (min_conn to max_conn connections) and return a new AsyncDatabase.
+    '''
+    @classmethod
+    async def connect(cls, username, password, server, port, db_name, min_conn = 1, max_conn = 10):
+        pool = await asyncpg.create_pool(user = username, password = password, host = server, port = int(port), database = db_name,
+                                         min_size = min_conn, max_size = max_conn)
+        print("PostgreSQL connection pool is open.")
+
+        return cls(pool)
+
+    '''
+    Insert a new row into a specific table. Accepts a table to insert to, the columns where data will be added, and the values to add
+    to those columns as inputs. Returns the id of this newly created entry.
+    Query: INSERT INTO table_name (cols) VALUES ($1, ...) RETURNING id;
+    '''
+    async def insert_and_return(self, table_name, col_lst, val_lst):
+        try:
+            cols = ','.join(col_lst)
+            vals = ','.join([f"${index}" for index in range(1, len(val_lst) + 1)])
+
+            insert_query = f"INSERT INTO {table_name} ({cols}) VALUES ({vals}) RETURNING id;"
+            async with self.pool.acquire() as conn:
+                inserted_id = await conn.fetchval(insert_query, *val_lst)
+            print(f"\tNew row(s) inserted into {table_name}")
+
+            return inserted_id
+
+        except asyncpg.PostgresError as e:
+            print(f"\nUnable to insert into the database: {e}")
+
+    '''
+    Select a singular row from a specific table and return col1 of this row. If the value isn't in the table yet, insert it.
+    Query: SELECT col1 FROM table_name WHERE col2 = $1;
+    '''
+    async def select(self, table_name, col1, col2, val):
+        try:
+            select_query = f"SELECT {col1} FROM {table_name} WHERE {col2} = $1;"
+            async with self.pool.acquire() as conn:
+                result = await conn.fetchval(select_query, val)
+
+            if (result is None):
+                return await self.insert_and_return(table_name, [col2], [val])
+
+            return result
+
+        except asyncpg.PostgresError as e:
+            print(f"\nUnable to select from the database: {e}")
+
+    '''
+    Stream the rows of a table where col = val out of the database with COPY ... TO STDOUT, and parse the CSV text straight into
+    Polars data frames of about batch_mb megabytes each. The column types come from the table itself (a prepared statement), so
+    nothing is inferred. Each batch is handed to batch_function as soon as it is parsed. Returns the number of rows read.
+    Query: COPY (SELECT * FROM table_name WHERE col = $1) TO STDOUT WITH CSV
+    '''
+    async def select_multiple_batches(self, table_name, col, val, batch_function, batch_mb = 64):
+        try:
+            select_query = f"SELECT * FROM {table_name} WHERE {col} = $1"
+
+            async with self.pool.acquire() as conn:
+                # Get the columns and their data types without reading any rows
+                statement = await conn.prepare(select_query)
+                schema = {attribute.name : pg_type_dict.get(attribute.type.oid, pl.Utf8) for attribute in statement.get_attributes()}
+
+                # Stream the rows out, parsing them into Polars data frames along the way
+                parser = CopyOutParser(schema, batch_function, batch_mb)
+
+                async def write(data):
+                    parser.write(data)
+
+                await conn.copy_from_query(select_query, val, output = write, format = 'csv')
+
+            parser.close()
+            return parser.n_rows
+
+        except asyncpg.PostgresError as e:
+            print(f"\nUnable to select from the database: {e}")
+            return 0
+
+    '''
+    Select multiple rows from a table where col = val (read in batches with select_multiple_batches). Returns the data frame.
+    '''
+    async def select_multiple(self, table_name, col, val):
+        batch_lst = []
+        await self.select_multiple_batches(table_name, col, val, batch_lst.append)
+
+        # Put the batches together into one data frame (an empty data frame if nothing was found)
+        if (len(batch_lst) > 0):
+            return pl.concat(batch_lst, rechunk = False)
+
+        return pl.DataFrame()
+
+    '''
+    Insert a data frame (or an iterator of Polars data frames / Arrow record batches) into the database with copy_to_table. The data
+    is split into batches of at most max_buffer_mb megabytes and encoded one batch at a time as copy_to_table asks for more (see
+    iter_async_chunks), in the binary COPY format by default.
+
+    The COPY runs in a transaction, with the binary COPY inside a savepoint. If the data can't be written in the binary format (including
+    a batch that fails part way through encoding, see encode_error_types in pg_copy.py), or the database rejects it, the CSV format is
+    used instead (only for a data frame, since an iterator can only be read once). An iterator whose batches don't all have the same
+    columns and types as the first one is rejected (see iter_same_schema in pg_copy.py) and nothing is inserted. Returns True if the data
+    was inserted (or there was nothing to insert) and False otherwise.
+    Query: COPY table_name (db_col_lst) FROM STDIN WITH (FORMAT binary)
+           COPY table_name (db_col_lst) FROM STDIN WITH (FORMAT csv, HEADER, NULL 'NULL')
+    '''
+    async def df_to_db(self, table_name, df, db_col_lst, copy_format = 'binary', max_buffer_mb = 64):
+        # Look at the first batch to decide whether the binary format can be used, then put it back in front of the rest
+        batches = iter_batches(df, max_buffer_mb)
+        first_batch = next(batches, None)
+        if first_batch is None:
+            print(f"\nThe data frame is empty. Nothing was inserted into {table_name}.")
+            return True
+
+        def chain_batches():
+            yield first_batch
+            yield from batches
+
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    if (copy_format == 'binary') and can_encode_binary(first_batch):
+                        try:
+                            # A nested transaction is a savepoint
+                            async with conn.transaction():
+                                await conn.copy_to_table(table_name, source = iter_async_chunks(iter_binary_copy(chain_batches())),
+                                                         columns = db_col_lst, format = 'binary')
+                            print(f"\nThe data frame has successfully been inserted into {table_name}.")
+                            return True
+
+                        except (asyncpg.PostgresError,) + encode_error_types as e:
+                            if not isinstance(df, pl.DataFrame):
+                                raise
+
+                            print(f"\nUnable to write the data frame into the database with binary COPY, trying CSV: {e}")
+                            batches = iter_batches(df, max_buffer_mb)
+                            first_batch = next(batches)
+
+                    await conn.copy_to_table(table_name, source = iter_async_chunks(iter_csv_copy(chain_batches())),
+                                             columns = db_col_lst, format = 'csv', header = True, null = 'NULL')
+                    print(f"\nThe data frame has successfully been inserted into {table_name}.")
+                    return True
+
+        except (asyncpg.PostgresError,) + encode_error_types as e:
+            print(f"\nUnable to write the data frame into the database: {e}")
+            return False
+
+    '''
+    Delete every row of a table where col = val. Returns the number of rows deleted.
+    Query: DELETE FROM table_name WHERE col = $1;
+    '''
+    async def delete_rows(self, table_name, col, val):
+        try:
+            async with self.pool.acquire() as conn:
+                status = await conn.execute(f"DELETE FROM {table_name} WHERE {col} = $1;", val)
+
+            return int(status.split()[-1])   # 'DELETE <number of rows>'
+
+        except asyncpg.PostgresError as e:
+            print(f"\nUnable to delete from the database: {e}")
+            return 0
+
+    '''
+    Close every connection of the pool.
+    '''
+    async def disconnect(self):
+        await self.pool.close()
+        print("PostgreSQL connection pool is closed.")
+
+'''
+Check the backend against a local database. Synthetic data frames (see make_table_df in synthetic_bag.py) are loaded into every table at the same
+time under a throwaway bag file, read back at the same time, and the row counts are compared. Then the first table is written again from an
+iterator whose second batch has a bigint column as float, which df_to_db has to reject without inserting any row. The rows are deleted at the end.
+Returns the number of checks that failed.
+'''
+async def check_backend(db, topic_lst, n_rows):
+    from synthetic_bag import make_table_df   # Only needed for the check (it imports rosbag and genpy)
+
+    bag_files_id = await db.select('bag_files', 'id', 'bag_file_name', 'async_database_check.bag')
+    base_station_id = await db.select('base_station_messages', 'id', 'base_station_name', 'async_database_check')
+
+    job_lst = []
+    for topic in topic_lst:
+        table_name, mapping_dict, db_col_lst = get_topics(topic)
+        df = make_table_df(topic, n_rows, bag_files_id, base_station_id)
+        if not df.is_empty():
+            job_lst.append((table_name, df, db_col_lst))
+
+    failed_count = 0
+
+    try:
+        # Load every table at the same time
+        start_time = time.perf_counter()
+        inserted_lst = await asyncio.gather(*[db.df_to_db(table_name, df, db_col_lst) for table_name, df, db_col_lst in job_lst])
+        load_time = time.perf_counter() - start_time
+
+        # Read every table back at the same time
+        start_time = time.perf_counter()
+        df_lst = await asyncio.gather(*[db.select_multiple(table_name, 'bag_files_id', bag_files_id) for table_name, df, db_col_lst in job_lst])
+        export_time = time.perf_counter() - start_time
+
+        print("------------------------------------------------------------------------------------------------------------------")
+        for (table_name, df, db_col_lst), inserted, read_df in zip(job_lst, inserted_lst, df_lst):
+            ok = inserted and (read_df.height == df.height)
+            failed_count += 0 if ok else 1
+            print(f"{'OK' if ok else 'FAILED':<8}{table_name:<32}{df.height:>10} rows written{read_df.height:>10} rows read")
+
+        # A second batch with different column types has to be rejected, not written as the raw bytes of the other type
+        table_name, df, db_col_lst = job_lst[0]
+        int_col = next(col for col, dtype in df.schema.items() if (dtype == pl.Int64) and not col.endswith('_id'))
+        half = df.height // 2
+        batch_lst = [df.head(half), df.tail(df.height - half).with_columns(pl.col(int_col).cast(pl.Float64) + 0.5)]
+
+        inserted = await db.df_to_db(table_name, iter(batch_lst), db_col_lst)
+        read_df = await db.select_multiple(table_name, 'bag_files_id', bag_files_id)
+        ok = (not inserted) and (read_df.height == df.height)
+        failed_count += 0 if ok else 1
+        print(f"{'OK' if ok else 'FAILED':<8}{table_name:<32}batches with '{int_col}' as bigint then float rejected, {read_df.height - df.height} rows added")
+
+        total_rows = sum(df.height for table_name, df, db_col_lst in job_lst)
+        print(f"\nLoaded {total_rows} rows into {len(job_lst)} tables concurrently in {load_time:.2f} seconds ({total_rows / load_time:.0f} rows/sec)")
+        print(f"Read {total_rows} rows from {len(job_lst)} tables concurrently in {export_time:.2f} seconds ({total_rows / export_time:.0f} rows/sec)")
+        print("------------------------------------------------------------------------------------------------------------------")
+
+    finally:
+        # Delete everything that was written
+        await asyncio.gather(*[db.delete_rows(table_name, 'bag_files_id', bag_files_id) for table_name, df, db_col_lst in job_lst])
+        await db.delete_rows('bag_files', 'id', bag_files_id)
+        await db.delete_rows('base_station_messages', 'id', base_station_id)
+
+    return failed_count
+
+async def run_check(n_rows):
+    topic_lst = ['/GPS_SparkFun_Front_GGA', '/GPS_SparkFun_Front_VTG',
+                 '/GPS_SparkFun_RearLeft_GGA', '/GPS_SparkFun_RearLeft_GST', '/GPS_SparkFun_RearLeft_VTG',
+                 '/GPS_SparkFun_RearRight_GGA', '/GPS_SparkFun_RearRight_GST', '/GPS_SparkFun_RearRight_VTG',
+                 '/parseEncoder', '/parseTrigger']
+
+    # Database connection parameters
+    username = "postgres"
+    password = "pass"
+    server   = "127.0.0.1"
+    port     = "5432"
+    db_name  = "testdb"
+
+    db = await AsyncDatabase.connect(username, password, server, port, db_name, max_conn = len(topic_lst))
+
+    try:
+        failed_count = await check_backend(db, topic_lst, n_rows)
+    finally:
+        await db.disconnect()
+
+    return failed_count
+
+def main():
+    # Number of rows per data frame
+    n_rows = 10000
+    if (len(sys.argv) == 2):
+        n_rows = int(sys.argv[1])
+
+    failed_count = asyncio.run(run_check(n_rows))
+    if (failed_count > 0):
+        print(f"\n{failed_count} checks failed.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
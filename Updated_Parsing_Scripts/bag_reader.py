@@ -0,0 +1,614 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script holds the bag file reading helpers that are shared by parse_and_insert.py and parse_and_insert_no_db.py.
+    Previously, every topic would reopen the bag file and run its own read_messages() call, meaning a list of ten topics
+    would make ten full passes through a (possibly multi-GB) mapping van bag file. Here, the bag file is opened once, the
+    chunks are walked once, and every message is sent to an extractor for its topic.
+
+    Each topic's extractor is compiled once, from the keys in its get_topics mapping and the field types in the message
+    definition stored in the bag file. Every wanted attribute of a message is fetched with a single operator.attrgetter call
+    (written in C) and appended as one tuple, so there is no per-key if-chain and no dictionary per row. Once the bag has been
+    read, the tuples are transposed into typed NumPy columns. Arrays of numbers (such as the ranges and intensities of
+    /sick_lms_5xx/scan) become Polars List columns of the array's type, made from one 2D NumPy array when every message has
+    the same number of elements.
+
+    Topics whose messages only hold numbers, strings, and arrays of numbers (the GPS SparkFun GGA/GST/VTG, /parseEncoder,
+    /parseTrigger, and /sick_lms_5xx/scan messages, for example) skip the message objects altogether. The bag file is read with raw = True and
+    the serialized bytes are decoded in bulk with a decoder generated from the message definition in the bag file
+    (ros_struct_decoder.py). Any other topic is deserialized into message objects, as before.
+
+    If a BlobStore (lidar_blob_store.py) is given, the packets of the 3D LiDAR topics (/velodyne_packets and /ouster_packets)
+    are written into it a scan at a time while the bag file is read, and their data frames only hold one row of metadata per
+    scan (the hash and location of its blob). Without a BlobStore, these topics are skipped.
+
+Usage:
+    Use with the parse_and_insert.py and parse_and_insert_no_db.py scripts.
+        from bag_reader import bag_to_dfs, iter_bag_batches
+        topic_key_dict = {topic : list(get_topics(topic)[1].keys()) for topic in topic_lst}
+        topic_df_dict = bag_to_dfs(bag_file, topic_key_dict)
+
+        # Or, for topics that don't fit in memory, a chunk at a time
+        for topic, df in iter_bag_batches(bag_file, topic_key_dict, chunk_rows = 100000):
+            ...
+
+Method(s):
+    1. get_key_value(msg, key)
+        Get the value for a single key (subtopic) from a message. secs, nsecs, and rosbagTimestamp come from the
+        message header, everything else is an attribute of the message.
+
+    2. get_list_series(key, values)
+        Turn the arrays of a column into a Polars List column.
+
+    3. class DictExtractor(keys)
+        The original way of extracting a topic: a dictionary per message, built with get_key_value. Kept so the
+        compiled extractor can be compared against it (see benchmark_ingest.py).
+
+    4. class CompiledExtractor(keys, fields, field_types)
+        An extractor compiled once per topic. add(msg) appends one tuple of values per message, and to_df() turns
+        them into typed columns.
+
+    5. class StructExtractor(keys, decoder, fields, field_types)
+        An extractor that keeps the serialized messages of a topic and decodes them all at once in to_df(), falling
+        back to a CompiledExtractor if they don't match the message definition.
+
+    6. get_extractor_factories(bag, topic_key_dict, compiled = True, raw = True, blob_store = None)
+        Pick the extractor for each topic. Returns a dictionary of topic : function that makes a new extractor,
+        and whether the bag file needs to be read with raw = True.
+
+    7. iter_bag_batches(bag_file, topic_key_dict, chunk_rows = 100000, compiled = True, raw = True, metrics = None, blob_store = None)
+        Read all of the requested topics in a single pass, yielding (topic, Polars data frame) every chunk_rows
+        messages of a topic, so memory use depends on chunk_rows rather than on the length of the bag file.
+
+    8. bag_to_dfs(bag_file, topic_key_dict, compiled = True, raw = True, metrics = None, blob_store = None)
+        Open a bag file once and read all of the requested topics in a single pass. Returns a dictionary of
+        topic : Polars data frame. Topics without any messages will have an empty data frame.
+
+    9. get_bag_info(bag_file, topic_lst = None)
+        Describe the topics of a bag file without reading any messages. Only the connection and index records
+        (which rosbag loads when the bag file is opened) are used, so this is fast even for 20+ GB LiDAR bags.
+        Returns a dictionary of topic : {msg_type, msg_def, fields, field_types, message_count,
+        start_time_ms, end_time_ms, duration_ms}.
+'''
+from functools import partial
+from operator import attrgetter
+import os
+import time
+
+import genpy.dynamic
+import rosbag
+import numpy as np
+import polars as pl
+
+from ingest_metrics import MemorySampler, StageRecord, log, measure
+from lidar_blob_store import PacketBlobExtractor, get_packet_layout
+from ros_struct_decoder import get_struct_decoder
+
+# Cache of message classes generated from message definitions, keyed by (message type, md5sum)
+msg_class_cache = {}
+
+# ROS primitive type : NumPy data type of its column. Arrays of these types (other than uint8[] and char[], which genpy reads as
+# bytes) become List columns. Any other type (strings, nested messages) is kept as a list.
+ros_numpy_type_dict = {'bool': np.bool_,
+                       'int8': np.int8,
+                       'uint8': np.uint8,
+                       'byte': np.int8,
+                       'char': np.uint8,
+                       'int16': np.int16,
+                       'uint16': np.uint16,
+                       'int32': np.int32,
+                       'uint32': np.uint32,
+                       'int64': np.int64,
+                       'uint64': np.uint64,
+                       'float32': np.float32,
+                       'float64': np.float64
+}
+
+'''
+Get the value for a single key (subtopic) from a message. rosbagTimestamp is kept as seconds (float) so that the column
+can be cast to the ros_record_time type later on.
+'''
+def get_key_value(msg, key):
+    if (key == 'rosbagTimestamp'):
+        value = msg.header.stamp.to_sec()
+    elif (key == 'secs'):
+        value = msg.header.stamp.secs
+    elif (key == 'nsecs'):
+        value = msg.header.stamp.nsecs
+    else:
+        value = getattr(msg, key, None)
+
+    return value
+
+'''
+Deserialize a message read with read_messages(raw = True). The last item of a raw message is its message class.
+'''
+def deserialize_raw(raw_msg):
+    msg = raw_msg[-1]()
+    msg.deserialize(raw_msg[1])
+
+    return msg
+
+'''
+Turn the arrays of a column into a Polars List column. values is either a 2D NumPy array (one row per message) or a sequence of 1D NumPy
+arrays. A 2D NumPy array is handed to Polars as one buffer (as an Array column, which is then cast to a List column).
+'''
+def get_list_series(key, values):
+    series = pl.Series(key, values)
+    if (series.dtype == pl.Array):
+        series = series.cast(pl.List(series.dtype.inner))
+
+    return series
+
+'''
+    =================================== Class DictExtractor =======================================
+    #	Purpose: The original way of extracting a topic. For every message, go through each key with
+    #            get_key_value and build a dictionary for the row.
+    #
+    #   Methods:
+    #       1. def add(self, msg)
+    #           Add one message as a row.
+    #
+    #       2. def add_raw(self, raw_msg)
+    #           Add one message read with raw = True, deserializing it first.
+    #
+    #       3. def to_df(self)
+    #           Make a Polars data frame out of the rows (an empty data frame if there are none).
+    ===============================================================================================
+'''
+class DictExtractor:
+    def __init__(self, keys):
+        self.keys = keys
+        self.rows = []
+
+    def add(self, msg):
+        self.rows.append({key : get_key_value(msg, key) for key in self.keys})
+
+    def add_raw(self, raw_msg):
+        self.add(deserialize_raw(raw_msg))
+
+    def to_df(self):
+        if (len(self.rows) > 0):
+            return pl.DataFrame(self.rows)
+
+        return pl.DataFrame()
+
+'''
+    ================================= Class CompiledExtractor =====================================
+    #	Purpose: An extractor that is compiled once per topic from its keys and the fields and field
+    #            types of its message definition.
+    #
+    #            Each key is turned into an attribute path ('secs' -> 'header.stamp.secs', 'Latitude'
+    #            -> 'Latitude'), and all of the paths are put into one operator.attrgetter. For every
+    #            message, add() makes one attrgetter call and appends the resulting tuple. rosbagTimestamp
+    #            is worked out afterwards from the secs and nsecs columns, and keys that aren't in the
+    #            message are filled with None, so nothing is decided per message.
+    #
+    #   Methods:
+    #       1. def add(self, msg)
+    #           Append one tuple of values for the message.
+    #
+    #       2. def add_raw(self, raw_msg)
+    #           Append one message read with raw = True, deserializing it first.
+    #
+    #       3. def to_df(self)
+    #           Transpose the tuples into columns. Numeric fields become NumPy arrays of the field's
+    #           type, arrays of numbers become List columns, everything else a list. Returns a Polars
+    #           data frame with the keys as columns in the same order (an empty data frame if there
+    #           are no messages).
+    ===============================================================================================
+'''
+class CompiledExtractor:
+    def __init__(self, keys, fields, field_types):
+        self.keys = keys
+        self.rows = []
+
+        has_header = ('header' in fields)
+        field_type_dict = dict(zip(fields, field_types))
+
+        # key : (position in the tuple, NumPy data type or None for a list), and key : NumPy data type of the elements of an array
+        self.column_dict = {}
+        self.array_type_dict = {}
+        path_lst = []
+
+        for key in keys:
+            if (key == 'rosbagTimestamp'):
+                continue
+            elif key in ('secs', 'nsecs'):
+                if not has_header:
+                    continue
+                path = f"header.stamp.{key}"
+                np_type = np.int64
+            elif key in field_type_dict:
+                path = key
+                np_type = ros_numpy_type_dict.get(field_type_dict[key])
+
+                base_type = field_type_dict[key].split('[')[0]
+                if ('[' in field_type_dict[key]) and (base_type in ros_numpy_type_dict) and (base_type not in ('uint8', 'char')):
+                    self.array_type_dict[key] = ros_numpy_type_dict[base_type]
+            else:
+                continue   # Not in the message, filled with None in to_df
+
+            self.column_dict[key] = (len(path_lst), np_type)
+            path_lst.append(path)
+
+        # rosbagTimestamp is worked out from secs and nsecs, so make sure both are fetched
+        self.stamp_index = None
+        if ('rosbagTimestamp' in keys) and has_header:
+            for key in ('secs', 'nsecs'):
+                if key not in self.column_dict:
+                    self.column_dict[key] = (len(path_lst), np.int64)
+                    path_lst.append(f"header.stamp.{key}")
+            self.stamp_index = (self.column_dict['secs'][0], self.column_dict['nsecs'][0])
+
+        # attrgetter returns a single value (rather than a tuple) when given one path
+        if (len(path_lst) == 1):
+            single_getter = attrgetter(path_lst[0])
+            self.getter = lambda msg: (single_getter(msg),)
+        elif (len(path_lst) > 1):
+            self.getter = attrgetter(*path_lst)
+        else:
+            self.getter = lambda msg: ()
+
+        self.add = self.make_add()
+
+    '''
+    Bind the row list and the getter once, so adding a message is a single append of a single attrgetter call.
+    '''
+    def make_add(self):
+        append = self.rows.append
+        getter = self.getter
+
+        def add(msg):
+            append(getter(msg))
+
+        return add
+
+    def add_raw(self, raw_msg):
+        self.add(deserialize_raw(raw_msg))
+
+    def to_df(self):
+        n_rows = len(self.rows)
+        if (n_rows == 0):
+            return pl.DataFrame()
+
+        # Transpose the tuples into one tuple per attribute path
+        value_lst = list(zip(*self.rows)) if (len(self.rows[0]) > 0) else []
+
+        columns = {}
+        for key in self.keys:
+            if (key == 'rosbagTimestamp') and (self.stamp_index is not None):
+                secs = np.array(value_lst[self.stamp_index[0]], dtype = np.int64)
+                nsecs = np.array(value_lst[self.stamp_index[1]], dtype = np.int64)
+                columns[key] = pl.Series(key, secs + nsecs * 10**(-9))
+            elif key in self.array_type_dict:
+                # Stack the arrays into one 2D array if they all have the same length
+                index = self.column_dict[key][0]
+                np_type = self.array_type_dict[key]
+                if (len(set(map(len, value_lst[index]))) == 1):
+                    columns[key] = get_list_series(key, np.array(value_lst[index], dtype = np_type))
+                else:
+                    columns[key] = get_list_series(key, [np.asarray(value, dtype = np_type) for value in value_lst[index]])
+            elif key in self.column_dict:
+                index, np_type = self.column_dict[key]
+                if np_type is not None:
+                    columns[key] = pl.Series(key, np.array(value_lst[index], dtype = np_type))
+                else:
+                    columns[key] = pl.Series(key, list(value_lst[index]))
+            else:
+                columns[key] = pl.Series(key, [None] * n_rows)
+
+        return pl.DataFrame(columns)
+
+'''
+    ================================== Class StructExtractor ======================================
+    #	Purpose: An extractor for topics that can be decoded straight from the serialized bytes. The
+    #            raw messages are kept as they are read, and decoded all at once by a StructDecoder
+    #            (ros_struct_decoder.py) in to_df(). The decoded columns are named by field path
+    #            (header.stamp.secs, Latitude, ...), and the keys are picked out of them the same way
+    #            as in CompiledExtractor.
+    #
+    #   Methods:
+    #       1. def add_raw(self, raw_msg)
+    #           Keep one message read with raw = True.
+    #
+    #       2. def to_df(self)
+    #           Decode the messages and make a Polars data frame with the keys as columns. If the
+    #           messages don't match the message definition, they are deserialized and run through a
+    #           CompiledExtractor instead.
+    ===============================================================================================
+'''
+class StructExtractor:
+    def __init__(self, keys, decoder, fields, field_types):
+        self.keys = keys
+        self.decoder = decoder
+        self.fields = fields
+        self.field_types = field_types
+        self.raw_msgs = []
+        self.add_raw = self.raw_msgs.append
+
+    def to_df(self):
+        n_rows = len(self.raw_msgs)
+        if (n_rows == 0):
+            return pl.DataFrame()
+
+        try:
+            column_dict = self.decoder.decode([raw_msg[1] for raw_msg in self.raw_msgs])
+
+        except ValueError as e:
+            print(f"Error: {e}, deserializing the messages instead")
+            extractor = CompiledExtractor(self.keys, self.fields, self.field_types)
+            for raw_msg in self.raw_msgs:
+                extractor.add_raw(raw_msg)
+            return extractor.to_df()
+
+        columns = {}
+        for key in self.keys:
+            if (key == 'rosbagTimestamp') and ('header.stamp.secs' in column_dict):
+                secs = column_dict['header.stamp.secs'].astype(np.int64)
+                nsecs = column_dict['header.stamp.nsecs'].astype(np.int64)
+                columns[key] = pl.Series(key, secs + nsecs * 10**(-9))
+            elif key in ('secs', 'nsecs') and (f"header.stamp.{key}" in column_dict):
+                columns[key] = pl.Series(key, column_dict[f"header.stamp.{key}"].astype(np.int64))
+            elif key in column_dict:
+                values = column_dict[key]
+                if (values.ndim > 1):
+                    columns[key] = get_list_series(key, values)
+                elif (values.dtype == object):
+                    columns[key] = get_list_series(key, values.tolist())
+                else:
+                    columns[key] = pl.Series(key, values)
+            else:
+                columns[key] = pl.Series(key, [None] * n_rows)
+
+        return pl.DataFrame(columns)
+
+'''
+Make a function for each topic that creates a new, empty extractor for it. Each topic gets a CompiledExtractor built from the
+message definition stored in the bag file (or a DictExtractor if compiled is False, for comparison). If raw is True, topics that
+can be decoded straight from the serialized bytes get a StructExtractor instead. The LiDAR packet topics get a PacketBlobExtractor,
+which writes their packets into blob_store. Their tables only hold the metadata of the blobs, so if blob_store is None they are left
+out of the dictionary and aren't read at all. Returns the dictionary of topic : function, and whether the bag file should be read
+with raw = True.
+'''
+def get_extractor_factories(bag, topic_key_dict, compiled = True, raw = True, blob_store = None):
+    factory_dict = {topic : partial(DictExtractor, keys) for topic, keys in topic_key_dict.items()}
+    read_raw = False
+
+    # Compile an extractor for each topic that is in the bag file
+    topic_info_dict = get_bag_info(bag, list(topic_key_dict.keys()))
+    for topic, topic_info in topic_info_dict.items():
+        layout = get_packet_layout(topic_info['msg_type'], topic_info['msg_def'])
+
+        if (layout is not None) and (blob_store is not None):
+            factory_dict[topic] = partial(PacketBlobExtractor, topic_key_dict[topic], blob_store, layout)
+            read_raw = True
+        elif (layout is not None):
+            print(f"\nNo LiDAR blob store was given, skipping the packets of '{topic}'.")
+            del factory_dict[topic]
+        elif compiled:
+            decoder = get_struct_decoder(topic_info['msg_type'], topic_info['msg_def']) if raw else None
+
+            if decoder is not None:
+                factory_dict[topic] = partial(StructExtractor, topic_key_dict[topic], decoder, topic_info['fields'], topic_info['field_types'])
+                read_raw = True
+            else:
+                factory_dict[topic] = partial(CompiledExtractor, topic_key_dict[topic], topic_info['fields'], topic_info['field_types'])
+
+    return factory_dict, read_raw
+
+'''
+Read all of the requested topics of a bag file in a single pass, yielding (topic, data frame) a chunk at a time. As soon as a topic
+has chunk_rows messages, they are turned into a data frame and yielded, and the topic starts over with a new extractor, so at most
+chunk_rows messages per topic are held in memory no matter how long the bag file is. Whatever is left of each topic is yielded at the
+end (a topic without any messages yields one empty data frame). With chunk_rows = None, each topic is yielded once, at the end.
+The LiDAR packet topics are skipped without a blob_store (see get_extractor_factories), and never yielded.
+
+The bag file is read with raw = True if any topic has a StructExtractor or a PacketBlobExtractor (the other topics are deserialized as
+they are read). A PacketBlobExtractor is also handed the record time of each message. blob_store is passed on to get_extractor_factories.
+
+If metrics (an IngestMetrics, see ingest_metrics.py) is given, opening the bag file is recorded as the 'open' stage, turning each
+chunk into a data frame as the 'decode' stage of its topic, and the pass through the bag file itself (less the time spent in 'decode'
+and by the caller between chunks) as the 'read' stage, all under the topic '*' except 'decode'.
+'''
+def iter_bag_batches(bag_file, topic_key_dict, chunk_rows = 100000, compiled = True, raw = True, metrics = None, blob_store = None):
+    n_messages = 0
+    n_chunks = 0
+    away_time = 0   # Time spent in 'decode' and by the caller, which isn't part of the 'read' stage
+
+    start_time = time.time()
+
+    # Opening the bag file loads its index, and the extractors are compiled from the message definitions in it
+    with measure(metrics, '*', 'open') as record:
+        bag = rosbag.Bag(bag_file)
+        record.bytes = os.path.getsize(bag_file)
+
+        try:
+            factory_dict, read_raw = get_extractor_factories(bag, topic_key_dict, compiled, raw, blob_store)
+        except Exception:
+            bag.close()
+            raise
+
+    topic_lst = list(factory_dict.keys())   # The topics that are read (skipped topics aren't in factory_dict)
+
+    read_record = StageRecord(metrics.bag if (metrics is not None) else None, '*', 'read')
+    read_start_time = time.perf_counter()
+    read_sampler = MemorySampler()
+    read_sampler.__enter__()
+
+    '''
+    Turn the messages of a topic into a data frame, recording it as the 'decode' stage of the topic.
+    '''
+    def decode(topic, extractor):
+        with measure(metrics, topic, 'decode') as record:
+            df = extractor.to_df()
+            record.rows = df.height
+            record.bytes = df.estimated_size()
+        return df
+
+    try:
+        extractor_dict = {topic : factory() for topic, factory in factory_dict.items()}
+        add_dict = {topic : (extractor.add_raw if read_raw else extractor.add) for topic, extractor in extractor_dict.items()}
+        count_dict = {topic : 0 for topic in topic_lst}
+        yielded_set = set()
+
+        # Topics whose extractors also take the record time of each message
+        timed_set = {topic for topic, factory in factory_dict.items() if getattr(factory.func, 'needs_time', False)}
+
+        # A single read_messages() call walks each chunk of the bag file once, the messages of every requested
+        # topic are handed to the matching extractor
+        for topic, msg, t in bag.read_messages(topics = topic_lst, raw = read_raw):
+            if topic in timed_set:
+                add_dict[topic](msg, t)
+            else:
+                add_dict[topic](msg)
+            n_messages += 1
+
+            if chunk_rows is not None:
+                count_dict[topic] += 1
+
+                # Hand off a full chunk and start the topic over with an empty extractor
+                if (count_dict[topic] >= chunk_rows):
+                    away_start_time = time.perf_counter()
+                    df = decode(topic, extractor_dict[topic])
+
+                    extractor = factory_dict[topic]()
+                    extractor_dict[topic] = extractor
+                    add_dict[topic] = extractor.add_raw if read_raw else extractor.add
+                    count_dict[topic] = 0
+                    yielded_set.add(topic)
+                    n_chunks += 1
+
+                    yield topic, df
+                    away_time += time.perf_counter() - away_start_time
+
+        # If any data is left for a topic, make a data frame out of it. A topic that was never yielded gets an empty data frame.
+        for topic in topic_lst:
+            if (count_dict[topic] > 0) or (topic not in yielded_set):
+                away_start_time = time.perf_counter()
+                df = decode(topic, extractor_dict[topic])
+                extractor_dict[topic] = None
+                n_chunks += 1
+
+                yield topic, df
+                away_time += time.perf_counter() - away_start_time
+
+    except Exception as e:
+        read_record.status = 'error'
+        read_record.error = f"{e}"
+        raise
+
+    finally:
+        bag.close()
+
+        read_sampler.__exit__(None, None, None)
+        if metrics is not None:
+            read_record.seconds = time.perf_counter() - read_start_time - away_time
+            read_record.rows = n_messages
+            read_record.bytes = os.path.getsize(bag_file)
+            read_record.peak_memory_bytes = read_sampler.get_peak_bytes()
+            metrics.add_record(read_record.to_dict())
+
+    total_time = time.time() - start_time
+    log(metrics, f"\nRead {n_messages} messages from {len(topic_key_dict)} topics in {bag_file} in one pass ({n_chunks} chunks): {total_time} seconds")
+
+'''
+Open a bag file once and read all of the requested topics in a single pass (see iter_bag_batches). Each topic's messages are
+turned into one Polars data frame. Returns a dictionary of topic : data frame. metrics and blob_store are passed on to iter_bag_batches.
+'''
+def bag_to_dfs(bag_file, topic_key_dict, compiled = True, raw = True, metrics = None, blob_store = None):
+    # Topics without any messages will have an empty data frame
+    topic_df_dict = {topic : pl.DataFrame() for topic in topic_key_dict}
+
+    try:
+        for topic, df in iter_bag_batches(bag_file, topic_key_dict, chunk_rows = None, compiled = compiled, raw = raw,
+                                              metrics = metrics, blob_store = blob_store):
+            topic_df_dict[topic] = df
+
+    except Exception as e:
+        print(f"Error: {e}")
+
+    return topic_df_dict   # Return the dictionary of data frames
+
+'''
+Get the message class for a connection from the message definition stored in the bag file. Generating the class only
+parses the definition text, no messages are deserialized. Classes are cached by message type and md5sum.
+'''
+def get_msg_class(connection):
+    cache_key = (connection.datatype, connection.md5sum)
+
+    if cache_key not in msg_class_cache:
+        msg_classes = genpy.dynamic.generate_dynamic(connection.datatype, connection.msg_def)
+        msg_class_cache[cache_key] = msg_classes[connection.datatype]
+
+    return msg_class_cache[cache_key]
+
+'''
+Describe the topics of a bag file without reading any messages. rosbag loads the connection records (topic, message type,
+message definition) and the index records (one entry per message with its time) when the bag file is opened, so the
+topics, fields, message counts, and time spans can all be found without decompressing a single chunk.
+
+bag_file can either be a path to a bag file or an already opened rosbag.Bag. If topic_lst is given, only those topics are
+described. Times are in milliseconds.
+'''
+def get_bag_info(bag_file, topic_lst = None):
+    topic_info_dict = {}
+
+    # Open the bag file if needed, but never close a bag file that was opened by the caller
+    if isinstance(bag_file, rosbag.Bag):
+        bag = bag_file
+        close_bag = False
+    else:
+        bag = rosbag.Bag(bag_file)
+        close_bag = True
+
+    try:
+        # rosbag does not have a public accessor for the per-connection index, so use its internal dictionaries:
+        #   bag._connections:        connection id -> connection info (topic, datatype, md5sum, msg_def)
+        #   bag._connection_indexes: connection id -> list of index entries (sorted by time)
+        for conn_id, connection in bag._connections.items():
+            topic = connection.topic
+
+            if (topic_lst is not None) and (topic not in topic_lst):
+                continue
+
+            entries = bag._connection_indexes.get(conn_id, [])
+
+            # A topic can be recorded through more than one connection, start a new entry the first time the topic is seen
+            if topic not in topic_info_dict:
+                msg_class = get_msg_class(connection)
+
+                topic_info_dict[topic] = {'msg_type': connection.datatype,
+                                          'msg_def': connection.msg_def,
+                                          'fields': list(msg_class.__slots__),
+                                          'field_types': list(msg_class._slot_types),
+                                          'message_count': 0,
+                                          'start_time_ms': None,
+                                          'end_time_ms': None,
+                                          'duration_ms': 0
+                }
+
+            topic_info = topic_info_dict[topic]
+            topic_info['message_count'] += len(entries)
+
+            # The index entries are sorted by time, so the first and last entries give the time span of this connection
+            if (len(entries) > 0):
+                start_time_ms = entries[0].time.to_nsec() // 10**6
+                end_time_ms = entries[-1].time.to_nsec() // 10**6
+
+                if (topic_info['start_time_ms'] is None) or (start_time_ms < topic_info['start_time_ms']):
+                    topic_info['start_time_ms'] = start_time_ms
+                if (topic_info['end_time_ms'] is None) or (end_time_ms > topic_info['end_time_ms']):
+                    topic_info['end_time_ms'] = end_time_ms
+
+                topic_info['duration_ms'] = topic_info['end_time_ms'] - topic_info['start_time_ms']
+
+    finally:
+        if close_bag:
+            bag.close()
+
+    return topic_info_dict   # Return the dictionary of topic information
@@ -0,0 +1,409 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    Measure how fast the steps of the ingest run, comparing the ways each step can be done. The synthetic data comes from
+    synthetic_bag.py, and every measurement is timed with run_stage from benchmark_suite.py (the best of the repeats), the
+    same way the end-to-end benchmark times its stages.
+
+    df_to_db: For every topic, a synthetic data frame with the same columns and data types as the database table
+    (make_table_df in synthetic_bag.py) is written with Database.df_to_db, once with the binary COPY path and once with the
+    CSV path, and the rows/sec of each are printed. Every write happens inside a savepoint that is rolled back afterwards,
+    and the bag file and base station rows are deleted at the end, so nothing is left behind in the database. A write that
+    fails is reported as failed rather than timed.
+
+    extract: The messages of each topic of a bag file are read into memory once, then turned into a data frame with the
+    original per-message dictionary extractor, the compiled extractor, and (for topics that can be decoded straight from
+    the serialized bytes) the struct extractor (bag_reader.py), and the messages/sec of each are printed. Reading the bag
+    file is left out of the timing, so only the extraction itself is compared. The dictionary and compiled extractors are
+    given message objects that have already been deserialized, so the struct extractor is timed from the raw messages
+    plus the time it took to deserialize them.
+
+    update_df: For every topic, a synthetic data frame shaped like the output of bag_reader.py (make_bag_df in
+    synthetic_bag.py) is edited to match its database table with the step-by-step edit update_df used to do (one data frame
+    per with_columns, rename, and cast) and with the single LazyFrame plan of DFBuilder.update_df, both with the default
+    and the streaming engine. The time and the number and size of the data frames made along the way are printed. The base
+    station ids are put in the cache up front, so no database is needed.
+
+    velodyne: Synthetic VLP-16 packets (synthetic_bag.py) are decoded into points (velodyne_decoder.py), once on their own
+    and once cut into rotations and written to .npy files in a temporary folder, and the points/sec and packets/sec of each
+    are printed.
+
+Usage:  python(3) benchmark_ingest.py df_to_db [number of rows]
+        python(3) benchmark_ingest.py extract <bag file>
+        python(3) benchmark_ingest.py update_df [number of rows]
+        python(3) benchmark_ingest.py velodyne [number of rotations]
+    - Use with get_topics.py, bag_reader.py, parse_and_insert.py, synthetic_bag.py, benchmark_suite.py, and raw_data_db_launch.sql
+      (the tables need to exist for df_to_db)
+    - Need to know before using:
+        - database connection parameters: username, password, server, port, database name
+        - number of rows per data frame (default: 100000)
+        - number of rotations for velodyne (default: 600, a minute at 10 Hz)
+
+Method(s):
+    1. benchmark_df_to_db(db, topic_lst, n_rows, repeats)
+        Write a synthetic data frame for each topic with both the binary and CSV paths of df_to_db. Returns a dictionary
+        of topic : {copy format : rows/sec}.
+
+    2. benchmark_extractors(bag_file, topic_lst, repeats)
+        Extract the messages of each topic of a bag file with the dictionary, compiled, and struct extractors. Returns
+        a dictionary of topic : {extractor : messages/sec}.
+
+    3. update_df_by_steps(df, table_name, mapping_dict, db_col_lst, bag_files_id)
+        The step-by-step edit update_df used to do, for comparison. Returns the data frame and the list of every data frame made.
+
+    4. benchmark_update_df(topic_lst, n_rows, repeats)
+        Edit a bag-shaped data frame for each topic step by step and with the lazy plan of update_df. Returns a dictionary
+        of topic : {method : (seconds, data frames made, MB made)}.
+
+    5. benchmark_velodyne(n_rotations, repeats)
+        Decode synthetic Velodyne packets, and decode and write them as rotations. Returns a dictionary of
+        method : (points, packets, seconds).
+'''
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import polars as pl
+import rosbag
+
+from bag_reader import DictExtractor, CompiledExtractor, StructExtractor, deserialize_raw, get_bag_info
+from get_topics import get_topics, get_db_schema
+import parse_and_insert
+from parse_and_insert import Database, DFBuilder
+from ros_struct_decoder import get_struct_decoder
+from synthetic_bag import make_bag_df, make_table_df, make_velodyne_packets, velodyne_packets
+from benchmark_suite import run_stage
+from velodyne_decoder import VelodyneDecoder, iter_rotations, write_rotations
+
+'''
+Write a synthetic data frame for each topic with both the binary and CSV paths of df_to_db. Each write is timed and then
+rolled back to a savepoint. A write that fails rolls back the whole transaction (see Database.df_to_db), so the savepoint is made
+again for the next one. The best of the repeats is kept. Returns a dictionary of topic : {copy format : rows/sec}, with None for a
+copy format that failed.
+'''
+def benchmark_df_to_db(db, topic_lst, n_rows, repeats = 3):
+    result_dict = {}
+
+    # Ids for the foreign keys (inserted if needed and committed, so a failed write doesn't take them with it, deleted at the end)
+    bag_files_id = db.select('bag_files', 'id', 'bag_file_name', 'benchmark_ingest.bag')
+    base_station_id = db.select('base_station_messages', 'id', 'base_station_name', 'benchmark_ingest')
+    db.commit()
+
+    for topic in topic_lst:
+        table_name, mapping_dict, db_col_lst = get_topics(topic)
+        df = make_table_df(topic, n_rows, bag_files_id, base_station_id)
+
+        if df.is_empty():
+            print(f"\nSkipping '{topic}': not every column of '{table_name}' is filled in from the bag file yet.")
+            continue
+
+        result_dict[topic] = {}
+        for copy_format in ['binary', 'csv']:
+            inserted_lst = [False]   # Whether the last write was inserted
+
+            def write():
+                inserted_lst[0] = db.df_to_db(table_name, df, db_col_lst, copy_format = copy_format)
+                if not inserted_lst[0]:
+                    return {topic : "df_to_db failed"}
+                return {topic : (df.height, df.estimated_size())}
+
+            def undo():
+                if inserted_lst[0]:
+                    db.cursor.execute("ROLLBACK TO SAVEPOINT benchmark;")
+                else:
+                    db.rollback()   # The savepoint is gone (or the write raised), start the transaction over
+                    db.cursor.execute("SAVEPOINT benchmark;")
+                inserted_lst[0] = False
+
+            db.cursor.execute("SAVEPOINT benchmark;")
+            stats = run_stage(f"df_to_db {copy_format} {topic}", write, repeats, undo)
+
+            result_dict[topic][copy_format] = (n_rows / stats['seconds']) if (len(stats['failed']) == 0) else None
+
+    # Undo the last savepoint, then delete the bag file and base station rows
+    db.rollback()
+    db.delete('bag_files', bag_files_id)
+    db.delete('base_station_messages', base_station_id)
+    db.commit()
+
+    return result_dict
+
+'''
+Extract the messages of each topic of a bag file with the dictionary, compiled, and struct extractors. The raw messages are read
+once up front so that only the extraction is timed. The dictionary and compiled extractors are timed from deserialized message
+objects, plus the time it takes to deserialize them. The best of the repeats is kept. Returns a dictionary of
+topic : {extractor : messages/sec}.
+'''
+def benchmark_extractors(bag_file, topic_lst, repeats = 3):
+    result_dict = {}
+
+    bag = rosbag.Bag(bag_file)
+    topic_info_dict = get_bag_info(bag, topic_lst)
+
+    # Read every raw message into memory first
+    raw_msg_dict = {topic : [] for topic in topic_info_dict}
+    for topic, raw_msg, _ in bag.read_messages(topics = list(topic_info_dict.keys()), raw = True):
+        raw_msg_dict[topic].append(raw_msg)
+    bag.close()
+
+    for topic, raw_msg_lst in raw_msg_dict.items():
+        if (len(raw_msg_lst) == 0):
+            continue
+
+        keys = list(get_topics(topic)[1].keys())
+        topic_info = topic_info_dict[topic]
+        decoder = get_struct_decoder(topic_info['msg_type'], topic_info['msg_def'])
+
+        # Deserialize the messages once for the extractors that need message objects
+        start_time = time.perf_counter()
+        msg_lst = [deserialize_raw(raw_msg) for raw_msg in raw_msg_lst]
+        deserialize_time = time.perf_counter() - start_time
+
+        result_dict[topic] = {}
+        for extractor_name in ['dict', 'compiled', 'struct']:
+            if (extractor_name == 'struct') and (decoder is None):
+                result_dict[topic][extractor_name] = None   # This message type can't be decoded from the raw bytes
+                continue
+
+            def extract():
+                if (extractor_name == 'dict'):
+                    extractor = DictExtractor(keys)
+                elif (extractor_name == 'compiled'):
+                    extractor = CompiledExtractor(keys, topic_info['fields'], topic_info['field_types'])
+                else:
+                    extractor = StructExtractor(keys, decoder, topic_info['fields'], topic_info['field_types'])
+
+                if (extractor_name == 'struct'):
+                    for raw_msg in raw_msg_lst:
+                        extractor.add_raw(raw_msg)
+                else:
+                    for msg in msg_lst:
+                        extractor.add(msg)
+                df = extractor.to_df()
+
+                return {topic : (df.height, df.estimated_size())}
+
+            total_time = run_stage(f"extract {extractor_name} {topic}", extract, repeats)['seconds']
+            if (extractor_name != 'struct'):
+                total_time += deserialize_time
+
+            result_dict[topic][extractor_name] = len(raw_msg_lst) / total_time
+
+    return result_dict
+
+'''
+The step-by-step edit update_df used to do: every new column, the rename, and every cast makes a new data frame. Kept here for
+comparison with the lazy plan of DFBuilder.update_df. The base station ids come from the cache in parse_and_insert.py. Returns the
+data frame and the list of every data frame made along the way.
+'''
+def update_df_by_steps(df, table_name, mapping_dict, db_col_lst, bag_files_id):
+    df_lst = []
+    exp = 10**(-9)
+
+    df = df.with_columns(pl.Series('bag_files_id', [bag_files_id] * df.height, dtype = pl.Int32))
+    df_lst.append(df)
+    df = df.with_columns((pl.col('secs') + (pl.col('nsecs') * exp)).cast(pl.Float32).alias('ros_publish_time'))
+    df_lst.append(df)
+
+    if ('GPSSecs' in df.columns):
+        df = df.with_columns((pl.col('GPSSecs') + (pl.col('GPSMicroSecs') * exp)).cast(pl.Float32).alias('gpstime'))
+        df_lst.append(df)
+
+    if ('BaseStationID' in df.columns):
+        df = df.with_columns(pl.col('BaseStationID').str.strip_chars('"'))
+        df_lst.append(df)
+
+        base_station_id_dict = dict(parse_and_insert.base_station_cache)
+        base_station_id_df = pl.DataFrame({'BaseStationID': list(base_station_id_dict.keys()),
+                                           'base_station_messages_id': list(base_station_id_dict.values())},
+                                          schema = {'BaseStationID': pl.Utf8, 'base_station_messages_id': pl.Int32})
+        df = df.join(base_station_id_df, on = 'BaseStationID', how = 'left', maintain_order = 'left').drop('BaseStationID')
+        df_lst.append(df)
+
+        base_station_value = mapping_dict.pop('BaseStationID')
+        mapping_dict['base_station_messages_id'] = [base_station_value[0], pl.Int32]
+
+    df = df.rename({original_name : new_name for original_name, (new_name, _) in mapping_dict.items()})
+    df_lst.append(df)
+
+    for new_name, new_type in mapping_dict.values():
+        df = df.with_columns(pl.col(new_name).cast(new_type))
+        df_lst.append(df)
+
+    df = df.select(db_col_lst)
+    df_lst.append(df)
+
+    return df, df_lst
+
+'''
+Edit a bag-shaped data frame for each topic step by step (update_df_by_steps) and with the lazy plan of DFBuilder.update_df, with the
+default and the streaming engine. The best time of the repeats is kept. The size of the data frames made is their estimated size, so
+columns shared between data frames are counted once per data frame. Returns a dictionary of topic : {method : (seconds, data frames
+made, MB made)}.
+'''
+def benchmark_update_df(topic_lst, n_rows, repeats = 3):
+    result_dict = {}
+
+    # Put the ids of the synthetic base stations in the cache so get_base_station_ids doesn't need the database
+    parse_and_insert.base_station_cache.update({'LTI': 1, 'Test Track': 2, 'Reber1': 3, 'Reber2': 4})
+
+    for topic in topic_lst:
+        table_name, mapping_dict, db_col_lst = get_topics(topic)
+        bag_df = make_bag_df(topic, n_rows)
+        builder = DFBuilder(None, topic, list(mapping_dict.keys()))
+
+        result_dict[topic] = {}
+        for method in ['steps', 'lazy', 'streaming']:
+            frame_lst = []   # Every data frame made by the last run
+
+            def edit():
+                if (method == 'steps'):
+                    df, df_lst = update_df_by_steps(bag_df, table_name, dict(mapping_dict), db_col_lst, 1)
+                else:
+                    df = builder.update_df(bag_df, table_name, dict(mapping_dict), db_col_lst, 1, None, streaming = (method == 'streaming'))
+                    df_lst = [df]
+
+                frame_lst[:] = df_lst
+                return {topic : (df.height, df.estimated_size())}
+
+            total_time = run_stage(f"update_df {method} {topic}", edit, repeats)['seconds']
+            result_dict[topic][method] = (total_time, len(frame_lst), sum(df.estimated_size('mb') for df in frame_lst))
+
+    return result_dict
+
+'''
+Decode n_rotations rotations of synthetic VLP-16 packets (velodyne_packets per rotation, at 10 Hz) two ways: 'decode' turns each scan
+of packets into points with VelodyneDecoder.decode, and 'rotations' also cuts them into rotations and writes each one as a .npy file
+in a temporary folder (deleted afterwards). The packets are made up front, so only the decoding is timed. The best of the repeats is
+kept. Returns a dictionary of method : (points, packets, seconds).
+'''
+def benchmark_velodyne(n_rotations, repeats = 3):
+    result_dict = {}
+
+    rng = np.random.default_rng(0)
+    packets = make_velodyne_packets(rng, n_rotations, velodyne_packets)
+    times = 1718911521 + np.arange(n_rotations * velodyne_packets).reshape(n_rotations, velodyne_packets) / (10 * velodyne_packets)
+    n_packets = n_rotations * velodyne_packets
+
+    for method in ['decode', 'rotations']:
+        folder_lst = []   # The folders of the rotations, deleted after each run
+
+        def decode():
+            decoder = VelodyneDecoder()
+
+            if (method == 'decode'):
+                n_points = sum(len(decoder.decode(packets[scan], times[scan])[0]) for scan in range(n_rotations))
+            else:
+                folder_lst.append(tempfile.mkdtemp(prefix = 'velodyne_benchmark_'))
+                scan_iter = ((packets[scan], times[scan]) for scan in range(n_rotations))
+                n_points = int(write_rotations(iter_rotations(scan_iter, decoder), folder_lst[-1])['n_points'].sum())
+
+            return {'/velodyne_packets' : (n_points, packets.nbytes)}
+
+        def clean_up():
+            while (len(folder_lst) > 0):
+                shutil.rmtree(folder_lst.pop(), ignore_errors = True)
+
+        stats = run_stage(f"velodyne {method}", decode, repeats, clean_up)
+        result_dict[method] = (stats['rows'], n_packets, stats['seconds'])
+
+    return result_dict
+
+def main():
+    if (len(sys.argv) < 2) or (sys.argv[1] not in ['df_to_db', 'extract', 'update_df', 'velodyne']):
+        print("Usage: python(3) benchmark_ingest.py df_to_db [number of rows]")
+        print("       python(3) benchmark_ingest.py extract <bag file>")
+        print("       python(3) benchmark_ingest.py update_df [number of rows]")
+        print("       python(3) benchmark_ingest.py velodyne [number of rotations]")
+        return
+
+    if (sys.argv[1] == 'velodyne'):
+        n_rotations = int(sys.argv[2]) if (len(sys.argv) == 3) else 600
+        result_dict = benchmark_velodyne(n_rotations)
+
+        # Print the points/sec and packets/sec of decoding on its own and of writing the rotations
+        print("------------------------------------------------------------------------------------------------------------------")
+        print(f"Velodyne VLP-16 decoding of {n_rotations} rotations ({n_rotations * velodyne_packets} packets):")
+        print(f"{'method':<16}{'points':>16}{'seconds':>12}{'points/sec':>16}{'packets/sec':>16}")
+        for method, (n_points, n_packets, total_time) in result_dict.items():
+            print(f"{method:<16}{n_points:>16}{total_time:>12.3f}{n_points / total_time:>16.0f}{n_packets / total_time:>16.0f}")
+        print("------------------------------------------------------------------------------------------------------------------")
+        return
+
+    topic_lst = ['/GPS_SparkFun_Front_GGA', '/GPS_SparkFun_Front_VTG',
+                 '/GPS_SparkFun_RearLeft_GGA', '/GPS_SparkFun_RearLeft_GST', '/GPS_SparkFun_RearLeft_VTG',
+                 '/GPS_SparkFun_RearRight_GGA', '/GPS_SparkFun_RearRight_GST', '/GPS_SparkFun_RearRight_VTG',
+                 '/parseEncoder', '/parseTrigger']
+
+    if (sys.argv[1] == 'extract'):
+        if (len(sys.argv) != 3):
+            print("Usage: python(3) benchmark_ingest.py extract <bag file>")
+            return
+
+        result_dict = benchmark_extractors(sys.argv[2], topic_lst)
+
+        # Print the messages/sec of both extractors for each topic
+        print("------------------------------------------------------------------------------------------------------------------")
+        print(f"Extraction of {sys.argv[2]} (messages/sec):")
+        print(f"{'topic':<32}{'dict':>16}{'compiled':>16}{'struct':>16}{'speedup':>10}")
+        for topic, rate_dict in result_dict.items():
+            best_rate = max(rate for rate in rate_dict.values() if rate is not None)
+            struct_rate = f"{rate_dict['struct']:>16.0f}" if (rate_dict['struct'] is not None) else f"{'-':>16}"
+            speedup = best_rate / rate_dict['dict']
+            print(f"{topic:<32}{rate_dict['dict']:>16.0f}{rate_dict['compiled']:>16.0f}{struct_rate}{speedup:>9.1f}x")
+        print("------------------------------------------------------------------------------------------------------------------")
+        return
+
+    # Number of rows per data frame
+    n_rows = 100000
+    if (len(sys.argv) == 3):
+        n_rows = int(sys.argv[2])
+
+    if (sys.argv[1] == 'update_df'):
+        result_dict = benchmark_update_df(topic_lst, n_rows)
+
+        # Print the time and the data frames made by each method for each topic
+        print("------------------------------------------------------------------------------------------------------------------")
+        print(f"update_df with {n_rows} rows per topic (milliseconds / data frames made / MB made):")
+        print(f"{'topic':<32}{'steps':>24}{'lazy':>24}{'streaming':>24}{'speedup':>10}")
+        for topic, method_dict in result_dict.items():
+            line = f"{topic:<32}"
+            for method in ['steps', 'lazy', 'streaming']:
+                total_time, n_frames, size_mb = method_dict[method]
+                line += f"{f'{total_time * 1000:.1f} / {n_frames} / {size_mb:.0f}':>24}"
+            speedup = method_dict['steps'][0] / min(method_dict['lazy'][0], method_dict['streaming'][0])
+            print(f"{line}{speedup:>9.1f}x")
+        print("------------------------------------------------------------------------------------------------------------------")
+        return
+
+    # Database connection parameters
+    username = "postgres"
+    password = "pass"
+    server   = "127.0.0.1"
+    port     = "5432"
+    db_name  = "testdb"
+
+    db = Database(username, password, server, port, db_name)
+
+    result_dict = benchmark_df_to_db(db, topic_lst, n_rows)
+
+    # Print the rows/sec of both paths for each topic
+    print("------------------------------------------------------------------------------------------------------------------")
+    print(f"df_to_db with {n_rows} rows per topic (rows/sec):")
+    print(f"{'topic':<32}{'binary':>16}{'csv':>16}{'speedup':>10}")
+    for topic, rate_dict in result_dict.items():
+        rate_lst = [f"{rate_dict[copy_format]:>16.0f}" if (rate_dict[copy_format] is not None) else f"{'failed':>16}" for copy_format in ['binary', 'csv']]
+        speedup = f"{rate_dict['binary'] / rate_dict['csv']:>9.1f}x" if None not in rate_dict.values() else f"{'-':>10}"
+        print(f"{topic:<32}{''.join(rate_lst)}{speedup}")
+    print("------------------------------------------------------------------------------------------------------------------")
+
+    db.disconnect()
+
+if __name__ == "__main__":
+    main()
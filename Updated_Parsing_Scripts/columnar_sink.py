@@ -0,0 +1,157 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script writes the altered data frames of each topic as a columnar dataset, next to (or instead of) the CSV files
+    written by write_csv. A CSV file has to be parsed in full every time it is read, while the dataset can be read back with
+    only the columns and the rows that are needed.
+
+    The dataset is one folder per bag file and topic, laid out as Hive partitions:
+        <root>/bag=<bag file name without '.bag'>/topic=<topic with '/' written as '_slash_'>/part-00000.parquet
+    Each file is zstd-compressed Parquet (or Arrow IPC, with file_format = 'ipc'), sorted by ros_publish_time. The Parquet
+    files are written in row groups of row_group_size rows with min/max statistics on every column, so a filter on time
+    (or on any other column) skips the row groups that can't match, and a filter on bag or topic skips whole folders.
+
+    Reading a topic (or chunk) again replaces the files that the earlier run wrote for that bag file and topic. Each file is
+    written under a temporary name and renamed once it is complete, so a reader never sees half of a file.
+
+Usage:
+    Use with the parse_and_insert.py and parse_and_insert_no_db.py scripts.
+        dataset = DatasetWriter('dataset', file_format = 'parquet')
+        dataset.write(bag_name, topic, new_df)   # Call again for the next chunk of the same topic
+
+        # Read back: only the files of the given bag files, and only the row groups and columns that are needed
+        df = (scan_dataset('dataset', '/GPS_SparkFun_Front_GGA', bag_lst = ['mapping_van_2024-06-20-15-25-21_0'])
+              .filter(pl.col('ros_publish_time') > 1718911521)
+              .select('ros_publish_time', 'latitude', 'longitude')
+              .collect())
+
+Method(s):
+    1. get_partition_folder(root, bag_name, topic)
+        Folder of one bag file and topic in the dataset.
+
+    2. class DatasetWriter(root, file_format = 'parquet', row_group_size = 128000, compression_level = 3)
+        Write the data frames of each bag file and topic into the dataset, one file per call.
+
+    3. scan_dataset(root, topic, bag_lst = None, file_format = 'parquet')
+        Plan a read of one topic of the dataset as a Polars LazyFrame, with the bag and topic as columns.
+'''
+import glob
+import os
+import threading
+
+import polars as pl
+
+# File format : extension of its files in the dataset
+dataset_format_dict = {'parquet': '.parquet',
+                       'ipc': '.arrow'}
+
+# Columns that a topic is sorted by, the first one that the data frame has is used
+sort_column_lst = ['ros_publish_time', 'ros_record_time']
+
+'''
+Get the folder of one bag file and topic in the dataset: <root>/bag=<bag file name without '.bag'>/topic=<topic with '/' written as
+'_slash_'>. The topic is written the same way as the CSV file names.
+'''
+def get_partition_folder(root, bag_name, topic):
+    bag = os.path.basename(bag_name)
+    if bag.endswith('.bag'):
+        bag = bag[:-4]
+
+    return os.path.join(root, f"bag={bag}", f"topic={topic.replace('/', '_slash_')}")
+
+'''
+    ===================================== Class DatasetWriter =====================================
+    #	Purpose: Write the data frames of each bag file and topic into a Hive-partitioned dataset of
+    #            zstd-compressed Parquet (or Arrow IPC) files, sorted by time. The first write of a
+    #            bag file and topic replaces any files left from an earlier run, the next writes
+    #            (chunks) add a file each.
+    #
+    #   Methods:
+    #       1. def write(self, bag_name, topic, df)
+    #           Sort the data frame by time and write it as the next file of its bag file and topic.
+    #           Returns the number of bytes written.
+    ===============================================================================================
+'''
+class DatasetWriter:
+    def __init__(self, root, file_format = 'parquet', row_group_size = 128000, compression_level = 3):
+        if file_format not in dataset_format_dict:
+            raise ValueError(f"Unknown dataset format '{file_format}', should be one of {list(dataset_format_dict)}")
+
+        self.root = root
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.compression_level = compression_level
+
+        self.part_count_dict = {}   # (bag_name, topic) : number of files written
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to the worker processes without the lock
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def write(self, bag_name, topic, df):
+        if df.is_empty():
+            print(f"\nThe '{topic}' data frame is empty. Nothing was written to the dataset.")
+            return 0
+
+        folder = get_partition_folder(self.root, bag_name, topic)
+        extension = dataset_format_dict[self.file_format]
+
+        with self.lock:
+            part = self.part_count_dict.get((bag_name, topic), 0)
+            self.part_count_dict[(bag_name, topic)] = part + 1
+
+            # Replace whatever an earlier run wrote for this bag file and topic
+            if (part == 0):
+                os.makedirs(folder, exist_ok = True)
+                for old_file in glob.glob(os.path.join(folder, f"*{extension}")):
+                    os.remove(old_file)
+
+        # Sort by time, so the row group statistics of the time column don't overlap
+        sort_lst = [column for column in sort_column_lst if column in df.columns][:1]
+        if (len(sort_lst) > 0):
+            df = df.sort(sort_lst)
+
+        file_name = os.path.join(folder, f"part-{part:05d}{extension}")
+        temp_file = os.path.join(folder, f".part-{part:05d}{extension}.tmp")
+
+        if (self.file_format == 'parquet'):
+            df.write_parquet(temp_file, compression = 'zstd', compression_level = self.compression_level,
+                             statistics = True, row_group_size = self.row_group_size)
+        else:
+            df.write_ipc(temp_file, compression = 'zstd')
+        os.replace(temp_file, file_name)
+
+        return os.path.getsize(file_name)
+
+'''
+Plan a read of one topic of the dataset as a Polars LazyFrame, without reading anything yet. The bag and topic partitions become
+'bag' and 'topic' columns. If bag_lst is given, only the files of those bag files (with or without '.bag') are read. Any filter or
+select added to the LazyFrame is pushed down to the files, so for Parquet only the row groups and columns that are needed are read.
+'''
+def scan_dataset(root, topic, bag_lst = None, file_format = 'parquet'):
+    extension = dataset_format_dict[file_format]
+    source = os.path.join(root, 'bag=*', f"topic={topic.replace('/', '_slash_')}", f"*{extension}")
+
+    # Bag file names are kept as text, even if they look like numbers or dates
+    hive_schema = {'bag': pl.Utf8, 'topic': pl.Utf8}
+    if (file_format == 'parquet'):
+        plan = pl.scan_parquet(source, hive_partitioning = True, hive_schema = hive_schema)
+    else:
+        plan = pl.scan_ipc(source, hive_partitioning = True, hive_schema = hive_schema)
+
+    if bag_lst is not None:
+        bag_lst = [bag[:-4] if bag.endswith('.bag') else bag for bag in bag_lst]
+        plan = plan.filter(pl.col('bag').is_in(bag_lst))
+
+    return plan
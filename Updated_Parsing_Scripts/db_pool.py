@@ -0,0 +1,193 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script keeps a small pool of PostgreSQL connections per database, so that the Database class in parse_and_insert.py
+    (and anything else in the same process, such as the worker threads of a parallel loader or repeated runs) reuses open
+    connections instead of doing a new TCP connection and authentication handshake for every job.
+
+    Each thread checks out its own connection, so threads never share a cursor or a transaction. A connection that has been
+    sitting in the pool for a while is checked with 'SELECT 1' before it is handed out, and replaced if it is broken.
+
+Usage:
+    Use with the parse_and_insert.py script.
+        pool = get_pool(username, password, server, port, db_name, min_size = 1, max_size = 4)
+        conn = pool.checkout()       # The same connection is returned until this thread checks it back in
+        ...
+        pool.checkin(commit = True)
+
+        with pool.connection() as conn:
+            ...
+
+    At the end of the program, close_pools() closes every connection.
+
+Method(s):
+    1. class ConnectionPool(username, password, server, port, db_name, min_size, max_size, health_check_interval)
+        A thread-safe pool of connections with per-thread checkout and health checks.
+
+    2. get_pool(username, password, server, port, db_name, min_size = 1, max_size = 4)
+        Get the pool for a database, creating it the first time. Pools are shared across the whole process.
+
+    3. close_pools()
+        Close every connection of every pool.
+'''
+from contextlib import contextmanager
+import threading
+import time
+
+import psycopg2
+import psycopg2.pool
+
+# Process-wide pools, keyed by (username, server, port, db_name)
+pool_dict = {}
+pool_dict_lock = threading.Lock()
+
+'''
+    ================================== Class ConnectionPool =======================================
+    #	Purpose: A thread-safe pool of connections to one database. Each thread checks out its own
+    #            connection and keeps it until it checks it back in.
+    #
+    #   Methods:
+    #       1. def checkout(self)
+    #           Get this thread's connection, taking one from the pool (waiting if all max_size are in
+    #           use) if the thread doesn't have one yet. Connections that haven't been used for
+    #           health_check_interval seconds are checked first.
+    #
+    #       2. def checkin(self, commit = True)
+    #           Commit (or roll back) this thread's connection and give it back to the pool.
+    #
+    #       3. def connection(self, commit = True)
+    #           Context manager around checkout and checkin.
+    #
+    #       4. def close(self)
+    #           Close every connection in the pool.
+    ===============================================================================================
+'''
+class ConnectionPool:
+    def __init__(self, username, password, server, port, db_name, min_size = 1, max_size = 4, health_check_interval = 30):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(min_size, max_size,
+                                                         database = db_name,
+                                                         user = username,
+                                                         password = password,
+                                                         host = server,
+                                                         port = port)
+        self.server = server
+        self.port = str(port)
+        self.db_name = db_name
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+
+        # ThreadedConnectionPool raises an error when it is empty, so wait for a free connection instead
+        self.available = threading.BoundedSemaphore(max_size)
+        self.local = threading.local()
+        self.last_used_dict = {}   # id(conn) : time the connection was last checked in
+
+    '''
+    Get this thread's connection. If the thread doesn't have one yet, wait for a free connection in the pool and check that it
+    still works before handing it out.
+    '''
+    def checkout(self):
+        conn = getattr(self.local, 'conn', None)
+        if (conn is not None):
+            if not conn.closed:
+                return conn
+
+            self.checkin(commit = False)   # The connection was lost, give its spot back before taking a new one
+
+        self.available.acquire()
+        try:
+            conn = self.pool.getconn()
+
+            # Check a connection that has been sitting in the pool for a while, replacing it if it is broken
+            last_used = self.last_used_dict.get(id(conn), time.time())
+            if conn.closed or ((time.time() - last_used > self.health_check_interval) and not self.is_healthy(conn)):
+                self.pool.putconn(conn, close = True)
+                conn = self.pool.getconn()
+
+        except Exception:
+            self.available.release()
+            raise
+
+        self.local.conn = conn
+        return conn
+
+    '''
+    Commit (or roll back) this thread's connection and give it back to the pool.
+    '''
+    def checkin(self, commit = True):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            return
+
+        self.local.conn = None
+
+        try:
+            if not conn.closed:
+                if commit:
+                    conn.commit()
+                else:
+                    conn.rollback()
+
+        finally:
+            self.last_used_dict[id(conn)] = time.time()
+            self.pool.putconn(conn, close = bool(conn.closed))
+            self.available.release()
+
+    '''
+    Context manager around checkout and checkin. Rolls back instead of committing if an error is raised.
+    '''
+    @contextmanager
+    def connection(self, commit = True):
+        conn = self.checkout()
+        try:
+            yield conn
+        except Exception:
+            self.checkin(commit = False)
+            raise
+        else:
+            self.checkin(commit = commit)
+
+    '''
+    Check whether a connection still works.
+    '''
+    def is_healthy(self, conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+            return True
+
+        except psycopg2.Error:
+            return False
+
+    '''
+    Close every connection in the pool.
+    '''
+    def close(self):
+        self.pool.closeall()
+
+'''
+Get the pool for a database, creating it the first time it is asked for. The same pool is returned for the same database for the
+rest of the process, so every Database instance (and every thread) shares it.
+'''
+def get_pool(username, password, server, port, db_name, min_size = 1, max_size = 4):
+    pool_key = (username, server, str(port), db_name)
+
+    with pool_dict_lock:
+        if pool_key not in pool_dict:
+            pool_dict[pool_key] = ConnectionPool(username, password, server, port, db_name, min_size, max_size)
+
+        return pool_dict[pool_key]
+
+'''
+Close every connection of every pool.
+'''
+def close_pools():
+    with pool_dict_lock:
+        for pool in pool_dict.values():
+            pool.close()
+
+        pool_dict.clear()
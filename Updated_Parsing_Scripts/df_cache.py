@@ -0,0 +1,273 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script keeps a local copy of the tables read out of the database by db_to_df (parse_and_insert.py), so reading the
+    same bag file again (from a notebook, or for another export) reads a file on the local disk instead of exporting the
+    whole table from the database server again.
+
+    Each entry is the rows of one table for one bag file (and one set of columns, or every column) of one database, stored
+    as a zstd-compressed Parquet file in the cache folder. The database (server, port, and database name) is part of the
+    key, since the same table and bag file id on two servers (see csv_to_servers.py) hold different rows. An index file
+    (index.json) keeps the key, size, version, and last use of every entry. Once the entries add up to more than max_mb megabytes, the least recently used ones are deleted.
+
+    An entry is only used if the table still has the same version for the bag file. The version always has the number of
+    rows of the bag file in the table (SELECT count(*)), which is still much less work for the server than exporting the
+    rows. If the table's topic is 'done' in the ingest_manifest table (see ingest_manifest.py) with that same row count, the
+    bag file hash and the time it was loaded are added, so loading the bag file again makes the entry stale. A manifest row
+    alone isn't trusted, as rows can be deleted or added outside of the ingest. A stale entry is deleted and read again
+    from the database.
+
+    A set of columns can be served from the entry with every column of the same table and bag file, if there is one, by
+    reading only those columns of the Parquet file.
+
+Usage:
+    Use with the parse_and_insert.py script.
+        cache = DataFrameCache(max_mb = 4096)   # Kept in ~/.cache/ivsg_db_to_df by default
+        df = select_cached(db, 'gps_spark_fun_front_gga', bag_id, cache = cache)
+        df = select_cached(db, 'gps_spark_fun_front_gga', bag_id, col_lst = ['ros_publish_time', 'latitude'], cache = cache)
+
+Method(s):
+    1. class DataFrameCache(folder = default_cache_folder, max_mb = 4096)
+        Read, write, and evict the cached tables, and work out the current version of a table for a bag file.
+
+    2. select_cached(db, table_name, bag_files_id, col_lst = None, cache = None)
+        Read the rows of a table for a bag file through the cache (straight from the database if cache is None).
+
+    3. get_database_name(db)
+        The server, port, and database name of a Database instance, as 'server:port/db_name'.
+'''
+import hashlib
+import json
+import os
+import threading
+import time
+
+import psycopg2
+import polars as pl
+
+from ingest_manifest import status_done
+
+# Where the cache is kept if no folder is given
+default_cache_folder = os.path.join(os.path.expanduser('~'), '.cache', 'ivsg_db_to_df')
+
+# Name of the index file in the cache folder
+index_file_name = 'index.json'
+
+'''
+    =================================== Class DataFrameCache ======================================
+    #	Purpose: Keep the rows of each table for each bag file (and set of columns) as a Parquet file
+    #            on the local disk, with an index of their versions and last use, evicting the least
+    #            recently used files once the cache is bigger than max_mb.
+    #
+    #   Methods:
+    #       1. def get_version(self, db, table_name, bag_files_id)
+    #           The current version of a table for a bag file, from the row count and the ingest manifest.
+    #
+    #       2. def get(self, database, table_name, bag_files_id, col_lst, version)
+    #           The cached data frame, or None if it isn't cached or is stale.
+    #
+    #       3. def put(self, database, table_name, bag_files_id, col_lst, version, df)
+    #           Cache a data frame, then evict the least recently used entries if needed.
+    #
+    #       4. def clear(self)
+    #           Delete every entry.
+    ===============================================================================================
+'''
+class DataFrameCache:
+    def __init__(self, folder = default_cache_folder, max_mb = 4096):
+        self.folder = folder
+        self.max_bytes = int(max_mb * 2**20)
+        self.lock = threading.Lock()
+        self.has_manifest_dict = {}   # Database : whether it has an ingest_manifest table, checked once per database
+
+        os.makedirs(folder, exist_ok = True)
+
+    '''
+    Get the key of an entry, and the name of its file (a hash of the key, so any database, table name, and columns make a valid file
+    name). database is the name from get_database_name.
+    '''
+    def get_key(self, database, table_name, bag_files_id, col_lst):
+        columns = '*' if (col_lst is None) else ','.join(sorted(col_lst))
+        key = f"{database}|{table_name}|{bag_files_id}|{columns}"
+        file_name = f"{hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]}.parquet"
+
+        return key, file_name
+
+    '''
+    Read the index file. Returns a dictionary of key : {file, database, table_name, bag_files_id, columns, version, bytes, last_used}.
+    '''
+    def load_index(self):
+        try:
+            with open(os.path.join(self.folder, index_file_name)) as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+
+    '''
+    Write the index file under a temporary name and rename it, so another process never reads half of it.
+    '''
+    def save_index(self, index_dict):
+        temp_file = os.path.join(self.folder, f".{index_file_name}.{os.getpid()}.tmp")
+        with open(temp_file, 'w') as index_file:
+            json.dump(index_dict, index_file)
+        os.replace(temp_file, os.path.join(self.folder, index_file_name))
+
+    '''
+    Get the current version of a table for a bag file: the number of rows of the bag file in the table. If the table's topic is 'done'
+    in the ingest_manifest table and its row count matches, the bag file hash and the time it was loaded are added too. A 'done' row
+    with a different row count means the table was changed outside of the ingest, so only the row count is used.
+    Query: SELECT count(*) FROM table_name WHERE bag_files_id = %s;
+           SELECT bag_file_hash, row_count, status, ingest_timestamp FROM ingest_manifest WHERE bag_files_id = %s AND table_name = %s;
+    '''
+    def get_version(self, db, table_name, bag_files_id):
+        cursor = db.cursor
+        database = get_database_name(db)
+
+        try:
+            cursor.execute(f"SELECT count(*) FROM {table_name} WHERE bag_files_id = %s;", (bag_files_id,))
+            row_count = cursor.fetchone()[0]
+
+            if database not in self.has_manifest_dict:
+                cursor.execute("SELECT to_regclass('ingest_manifest') IS NOT NULL;")
+                self.has_manifest_dict[database] = cursor.fetchone()[0]
+
+            if self.has_manifest_dict[database]:
+                cursor.execute("SELECT bag_file_hash, row_count, status, ingest_timestamp FROM ingest_manifest "
+                               "WHERE bag_files_id = %s AND table_name = %s;", (bag_files_id, table_name))
+                row = cursor.fetchone()
+                if (row is not None) and (row[2] == status_done) and (row[1] == row_count):
+                    return f"manifest:{row[0]}:{row_count}:{row[3].isoformat()}"
+
+            return f"count:{row_count}"
+
+        except psycopg2.Error as e:
+            print(f"\nUnable to get the version of '{table_name}': {e}")
+            db.rollback()
+            return None
+
+    '''
+    Get a cached data frame. The entry for col_lst is used if there is one, otherwise the columns are read out of the entry with every
+    column. An entry with a different version is deleted. Returns the data frame, or None if it isn't cached (or version is None).
+    '''
+    def get(self, database, table_name, bag_files_id, col_lst, version):
+        if version is None:
+            return None
+
+        key_lst = [self.get_key(database, table_name, bag_files_id, col_lst)[0]]
+        if col_lst is not None:
+            key_lst.append(self.get_key(database, table_name, bag_files_id, None)[0])
+
+        with self.lock:
+            index_dict = self.load_index()
+
+            for key in key_lst:
+                entry = index_dict.get(key)
+                if entry is None:
+                    continue
+
+                file_name = os.path.join(self.folder, entry['file'])
+
+                # Stale (or missing) entries are dropped
+                if (entry['version'] != version) or not os.path.exists(file_name):
+                    self.remove_entry(index_dict, key)
+                    self.save_index(index_dict)
+                    continue
+
+                plan = pl.scan_parquet(file_name)
+                if col_lst is not None:
+                    plan = plan.select(col_lst)
+                df = plan.collect()
+
+                entry['last_used'] = time.time()
+                self.save_index(index_dict)
+
+                return df
+
+        return None
+
+    '''
+    Cache a data frame as a Parquet file, then evict the least recently used entries until the cache fits in max_mb. A data frame
+    bigger than the whole cache isn't cached.
+    '''
+    def put(self, database, table_name, bag_files_id, col_lst, version, df):
+        if (version is None) or (df.estimated_size() > self.max_bytes):
+            return
+
+        key, file_name = self.get_key(database, table_name, bag_files_id, col_lst)
+        temp_file = os.path.join(self.folder, f".{file_name}.{os.getpid()}.tmp")
+
+        df.write_parquet(temp_file, compression = 'zstd')
+
+        with self.lock:
+            os.replace(temp_file, os.path.join(self.folder, file_name))
+
+            index_dict = self.load_index()
+            index_dict[key] = {'file': file_name,
+                               'database': database,
+                               'table_name': table_name,
+                               'bag_files_id': bag_files_id,
+                               'columns': col_lst,
+                               'version': version,
+                               'bytes': os.path.getsize(os.path.join(self.folder, file_name)),
+                               'last_used': time.time()}
+
+            # Evict the least recently used entries
+            total_bytes = sum(entry['bytes'] for entry in index_dict.values())
+            for old_key, entry in sorted(index_dict.items(), key = lambda item: item[1]['last_used']):
+                if (total_bytes <= self.max_bytes):
+                    break
+                if (old_key != key):
+                    total_bytes -= entry['bytes']
+                    self.remove_entry(index_dict, old_key)
+
+            self.save_index(index_dict)
+
+    '''
+    Delete an entry's file and take it out of index_dict.
+    '''
+    def remove_entry(self, index_dict, key):
+        entry = index_dict.pop(key)
+        file_name = os.path.join(self.folder, entry['file'])
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+    def clear(self):
+        with self.lock:
+            index_dict = self.load_index()
+            for key in list(index_dict.keys()):
+                self.remove_entry(index_dict, key)
+            self.save_index(index_dict)
+
+'''
+Read the rows of a table for a bag file (only the columns in col_lst, if given) through the cache. If the cache has them for this
+database at the table's current version, they are read from the local disk. Otherwise they are read from the database with db.select_multiple and cached.
+With cache = None, this is just db.select_multiple. Returns the data frame.
+'''
+def select_cached(db, table_name, bag_files_id, col_lst = None, cache = None):
+    if cache is None:
+        return db.select_multiple(table_name, 'bag_files_id', bag_files_id, col_lst)
+
+    database = get_database_name(db)
+    version = cache.get_version(db, table_name, bag_files_id)
+    df = cache.get(database, table_name, bag_files_id, col_lst, version)
+
+    if df is not None:
+        print(f"\nRead '{table_name}' for the bag file with id = {bag_files_id} from the local cache.")
+        return df
+
+    df = db.select_multiple(table_name, 'bag_files_id', bag_files_id, col_lst)
+    if not df.is_empty():
+        cache.put(database, table_name, bag_files_id, col_lst, version, df)
+
+    return df
+
+'''
+Get the name of the database a Database instance (parse_and_insert.py) reads from, from its connection pool (see db_pool.py), as
+'server:port/db_name'.
+'''
+def get_database_name(db):
+    return f"{db.pool.server}:{db.pool.port}/{db.pool.db_name}"
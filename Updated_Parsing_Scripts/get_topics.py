@@ -16,6 +16,11 @@ Method(s): get_topics(topic)
     Takes in a topic and will return the corresponding table (table_name), a mapping dictionary of the wanted ROS bag topics to the
     corresponding table column names and data types, and a list of the columns for the database table.
 
+Method(s): get_db_schema(topic)
+    Takes in a topic and will return a dictionary of every column in the database table (in the same order as db_col_lst) to its
+    Polars data type, including the columns that parse_and_insert.py adds (bag_files_id, ros_publish_time, gpstime, and
+    base_station_messages_id). Columns that are not filled in from the bag file are None.
+
 For adding in a future table:
     1. Update SQL script
         a. New CREATE TABLE
@@ -31,6 +36,7 @@ For adding in a future table:
                 bigint = pl.Int64
                 real = pl.Float32
                 float = pl.Float64
+                real[] = pl.List(pl.Float32)
     4. Make a list of the columns in the database table that need 
 
 Note: This script is applicable only for CSV files that were only written using the bag_to_csv_py3.py script, as the CSV columns match with
@@ -179,8 +185,8 @@ def get_topics(topic):
                         'scan_time' : ['scan_time', pl.Float32],
                         'range_min' : ['range_min', pl.Float32],
                         'range_max' : ['range_max', pl.Float32],
-                        'ranges' : ['ranges', pl.Utf8],
-                        'intensities' : ['intensities', pl.Utf8]
+                        'ranges' : ['ranges', pl.List(pl.Float32)],
+                        'intensities' : ['intensities', pl.List(pl.Float32)]
         }
 
         db_col_lst = ["bag_files_id", "scan_time", "time_increment",
@@ -196,15 +202,19 @@ def get_topics(topic):
         elif (topic == '/ouster_packets'):
             table_name = 'ouster_lidar'
         
+        # The packets of each scan are kept in the LiDAR blob store (see lidar_blob_store.py), only the metadata goes into the table
         mapping_dict = {'rosbagTimestamp': ['ros_record_time', pl.Float32],
                         'secs': ['ros_seconds', pl.Int64],
                         'nsecs': ['ros_nanoseconds', pl.Int64],
-                        'packets': ['packets', pl.Utf8]
+                        'hash_tag': [f'{table_name}_hash_tag', pl.Utf8],
+                        'location': [f'{table_name}_location', pl.Utf8],
+                        'file_size': [f'{table_name}_file_size', pl.Int64],
+                        'file_time': [f'{table_name}_file_time', pl.Float32]
         }
         
         db_col_lst = ["bag_files_id", 
-                      "ouster_lidar_hash_tag", "ouster_lidar_location",
-                      "ouster_lidar_file_size", "ouster_lidar_file_time",
+                      f"{table_name}_hash_tag", f"{table_name}_location",
+                      f"{table_name}_file_size", f"{table_name}_file_time",
                       "ros_seconds", "ros_nanoseconds", "ros_publish_time", "ros_record_time"
         ]
         
@@ -250,3 +260,24 @@ def get_topics(topic):
         '''
 
     return table_name, mapping_dict, db_col_lst
+
+'''
+Get the Polars data type of every column in the database table for a topic, in the same order as db_col_lst. This is the
+schema of the data frame after update_df.
+'''
+def get_db_schema(topic):
+    table_name, mapping_dict, db_col_lst = get_topics(topic)
+
+    # The data types of the columns that come from the bag file (or CSV file)
+    type_dict = {new_name : new_type for new_name, new_type in mapping_dict.values()}
+
+    # The data types of the columns that are added or changed by update_df
+    type_dict.update({'bag_files_id': pl.Int32,
+                      'ros_publish_time': pl.Float32,
+                      'gpstime': pl.Float32,
+                      'base_station_messages_id': pl.Int32
+    })
+
+    db_schema = {col : type_dict.get(col) for col in db_col_lst}
+
+    return db_schema
@@ -0,0 +1,220 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script keeps track of which topics of which bag files have been loaded into the database, so that running
+    parse_and_insert.py again over the same folder (for example, a nightly rerun over the whole archive) only does the
+    work that is left: topics that failed, topics that were never loaded, and bag files that are new or have changed.
+
+    Every (bag file, topic) pair has one row in the ingest_manifest table (see raw_data_db_launch.sql) with the bag file's
+    content hash and size, the number of rows loaded, and a status:
+        running : the topic was started but never finished (the program was stopped or crashed part way through)
+        done    : the topic was loaded and committed
+        failed  : the topic could not be loaded, the error is kept in error_message
+
+    A topic is skipped if it is 'done' and the bag file still has the same hash. Otherwise, any rows already in the table
+    for that bag file are deleted before the topic is loaded again, so a rerun never duplicates rows.
+
+    The hash covers the size of the bag file and a few samples of its bytes (the start, the middle, and the end), so even a
+    20+ GB bag file is hashed in milliseconds. Use full = True to hash every byte instead.
+
+Usage:
+    Use with the parse_and_insert.py script.
+        manifest = IngestManifest(db)
+        file_hash, file_size = get_file_hash(bag_file)
+        pending_lst = manifest.get_pending_topics(bag_id, topic_lst, file_hash)
+        for topic in pending_lst:
+            manifest.start_topic(bag_id, topic, table_name, file_hash, file_size)
+            ...
+            manifest.finish_topic(bag_id, topic, row_count)   # Or manifest.fail_topic(bag_id, topic, table_name, error)
+            db.commit()
+
+Method(s):
+    1. get_file_hash(file_name, sample_mb = 1, full = False)
+        Get the SHA-256 content hash and size of a file. Returns (hash, size).
+
+    2. class IngestManifest(db)
+        Read and update the ingest_manifest table through a Database instance (parse_and_insert.py).
+'''
+import hashlib
+import os
+
+import psycopg2
+
+# Status of a (bag file, topic) pair in the ingest_manifest table
+status_running = 'running'
+status_done = 'done'
+status_failed = 'failed'
+
+'''
+Get the SHA-256 content hash and size of a file. The size and sample_mb megabytes from the start, the middle, and the end of the file
+are hashed (the whole file if it is smaller than three samples, or if full is True). Returns (hash, size).
+'''
+def get_file_hash(file_name, sample_mb = 1, full = False):
+    file_size = os.path.getsize(file_name)
+    sample_size = int(sample_mb * 2**20)
+
+    file_hash = hashlib.sha256()
+    file_hash.update(str(file_size).encode('utf-8'))
+
+    with open(file_name, 'rb') as file:
+        if full or (file_size <= 3 * sample_size):
+            for block in iter(lambda: file.read(sample_size), b''):
+                file_hash.update(block)
+        else:
+            for offset in [0, (file_size - sample_size) // 2, file_size - sample_size]:
+                file.seek(offset)
+                file_hash.update(file.read(sample_size))
+
+    return file_hash.hexdigest(), file_size
+
+'''
+    ================================== Class IngestManifest =======================================
+    #	Purpose: Read and update the ingest_manifest table. All of the queries use the Database
+    #            instance's connection, so the manifest row of a topic is committed (or rolled back)
+    #            together with the topic's rows.
+    #
+    #   Methods:
+    #       1. def create_table(self)
+    #           Create the ingest_manifest table if it doesn't exist yet (for databases that were set
+    #           up before the table was added to raw_data_db_launch.sql).
+    #
+    #       2. def get_topic_dict(self, bag_files_id)
+    #           Get the manifest rows of a bag file. Returns a dictionary of topic : {table_name,
+    #           bag_file_hash, bag_file_size, row_count, status, error_message}.
+    #
+    #       3. def get_pending_topics(self, bag_files_id, topic_lst, file_hash)
+    #           Get the topics that still need to be loaded (not 'done', or 'done' for a different
+    #           version of the bag file).
+    #
+    #       4. def start_topic(self, bag_files_id, topic, table_name, file_hash, file_size)
+    #           Mark a topic as 'running' and delete any rows already in its table for the bag file.
+    #
+    #       5. def finish_topic(self, bag_files_id, topic, row_count)
+    #           Mark a topic as 'done' with the number of rows loaded.
+    #
+    #       6. def fail_topic(self, bag_files_id, topic, table_name, error_message)
+    #           Mark a topic as 'failed' with the error.
+    ===============================================================================================
+'''
+class IngestManifest:
+    def __init__(self, db):
+        self.db = db
+        self.create_table()
+
+    '''
+    Create the ingest_manifest table if it doesn't exist yet. This is the same table as in raw_data_db_launch.sql.
+    Query: CREATE TABLE IF NOT EXISTS ingest_manifest (...);
+    '''
+    def create_table(self):
+        try:
+            self.db.cursor.execute("""
+                CREATE TABLE IF NOT EXISTS ingest_manifest (
+                    id serial NOT NULL,
+                    bag_files_id int NOT NULL REFERENCES bag_files (id),
+                    topic varchar(100) NOT NULL,
+                    table_name varchar(50) NOT NULL,
+                    bag_file_hash varchar(64) NOT NULL,
+                    bag_file_size bigint NOT NULL,
+                    row_count bigint NOT NULL DEFAULT 0,
+                    status varchar(10) NOT NULL,
+                    error_message text NULL,
+                    ingest_timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    CONSTRAINT ingest_manifest_pk PRIMARY KEY (id),
+                    CONSTRAINT ingest_manifest_unique UNIQUE (bag_files_id, topic)
+                );""")
+            self.db.commit()
+
+        except psycopg2.Error as e:
+            print(f"\nUnable to create the ingest_manifest table: {e}")
+            self.db.rollback()
+
+    '''
+    Get the manifest rows of a bag file. Returns a dictionary of topic : {table_name, bag_file_hash, bag_file_size, row_count,
+    status, error_message}.
+    Query: SELECT topic, ... FROM ingest_manifest WHERE bag_files_id = bag_files_id;
+    '''
+    def get_topic_dict(self, bag_files_id):
+        topic_dict = {}
+        col_lst = ['table_name', 'bag_file_hash', 'bag_file_size', 'row_count', 'status', 'error_message']
+
+        try:
+            cursor = self.db.cursor
+            cursor.execute(f"SELECT topic, {', '.join(col_lst)} FROM ingest_manifest WHERE bag_files_id = %s;", (bag_files_id,))
+
+            for row in cursor.fetchall():
+                topic_dict[row[0]] = dict(zip(col_lst, row[1:]))
+
+        except psycopg2.Error as e:
+            print(f"\nUnable to select from ingest_manifest: {e}")
+            self.db.rollback()
+
+        return topic_dict
+
+    '''
+    Get the topics of topic_lst that still need to be loaded for a bag file: topics that were never started, that are 'running' or
+    'failed', or that are 'done' but for a bag file with a different hash (the bag file changed). The order of topic_lst is kept.
+    '''
+    def get_pending_topics(self, bag_files_id, topic_lst, file_hash):
+        topic_dict = self.get_topic_dict(bag_files_id)
+        pending_lst = []
+
+        for topic in topic_lst:
+            entry = topic_dict.get(topic)
+            if (entry is None) or (entry['status'] != status_done) or (entry['bag_file_hash'] != file_hash):
+                pending_lst.append(topic)
+
+        return pending_lst
+
+    '''
+    Mark a topic as 'running' (inserting its manifest row if needed) and delete any rows already in its table for the bag file, left
+    over from an earlier run that failed or from an older version of the bag file. Nothing is committed here: the delete, the new rows,
+    and finish_topic/fail_topic are all committed together.
+    Query: INSERT INTO ingest_manifest (...) VALUES (...) ON CONFLICT (bag_files_id, topic) DO UPDATE SET ...;
+           DELETE FROM table_name WHERE bag_files_id = bag_files_id;
+    '''
+    def start_topic(self, bag_files_id, topic, table_name, file_hash, file_size):
+        cursor = self.db.cursor
+
+        cursor.execute("INSERT INTO ingest_manifest (bag_files_id, topic, table_name, bag_file_hash, bag_file_size, row_count, status) "
+                       "VALUES (%s, %s, %s, %s, %s, 0, %s) "
+                       "ON CONFLICT (bag_files_id, topic) DO UPDATE SET "
+                       "table_name = EXCLUDED.table_name, bag_file_hash = EXCLUDED.bag_file_hash, "
+                       "bag_file_size = EXCLUDED.bag_file_size, row_count = 0, status = EXCLUDED.status, "
+                       "error_message = NULL, ingest_timestamp = CURRENT_TIMESTAMP;",
+                       (bag_files_id, topic, table_name, file_hash, file_size, status_running))
+
+        cursor.execute(f"DELETE FROM {table_name} WHERE bag_files_id = %s;", (bag_files_id,))
+        if (cursor.rowcount > 0):
+            print(f"\nDeleted {cursor.rowcount} rows of '{table_name}' left over from an earlier run.")
+
+    '''
+    Mark a topic as 'done' with the number of rows loaded.
+    Query: UPDATE ingest_manifest SET status = 'done', row_count = row_count WHERE bag_files_id = bag_files_id AND topic = topic;
+    '''
+    def finish_topic(self, bag_files_id, topic, row_count):
+        self.db.cursor.execute("UPDATE ingest_manifest SET status = %s, row_count = %s, ingest_timestamp = CURRENT_TIMESTAMP "
+                               "WHERE bag_files_id = %s AND topic = %s;",
+                               (status_done, row_count, bag_files_id, topic))
+
+    '''
+    Mark a topic as 'failed' with the error. The transaction may have been rolled back (taking the 'running' row with it), so the row is
+    inserted again if needed. The hash is cleared so the topic can never look finished.
+    Query: INSERT INTO ingest_manifest (...) VALUES (...) ON CONFLICT (bag_files_id, topic) DO UPDATE SET status = 'failed', ...;
+    '''
+    def fail_topic(self, bag_files_id, topic, table_name, error_message):
+        try:
+            self.db.cursor.execute("INSERT INTO ingest_manifest (bag_files_id, topic, table_name, bag_file_hash, bag_file_size, "
+                                   "row_count, status, error_message) "
+                                   "VALUES (%s, %s, %s, '', 0, 0, %s, %s) "
+                                   "ON CONFLICT (bag_files_id, topic) DO UPDATE SET "
+                                   "bag_file_hash = '', row_count = 0, status = EXCLUDED.status, error_message = EXCLUDED.error_message, "
+                                   "ingest_timestamp = CURRENT_TIMESTAMP;",
+                                   (bag_files_id, topic, table_name, status_failed, error_message))
+
+        except psycopg2.Error as e:
+            print(f"\nUnable to update ingest_manifest: {e}")
+            self.db.rollback()
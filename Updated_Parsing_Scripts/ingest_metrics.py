@@ -0,0 +1,355 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script records where the time goes during an ingest. Every stage of every topic of every bag file (opening the bag
+    file, reading and decoding the messages, transforming the data frame, resolving base stations, the COPY into the
+    database, and writing CSV files) is measured: its duration, the rows and bytes it handled, the peak memory of the
+    process while it ran, and whether it failed.
+
+    Each measurement is appended to a JSON-lines file as soon as the stage finishes, one line per stage, so hundreds of bag
+    files can be looked at afterwards (for example, with pl.read_ndjson). The totals are also written to a Prometheus
+    textfile-collector file (point it at the folder node_exporter reads with --collector.textfile.directory). The
+    Prometheus file is written to a temporary file and renamed over the old one, so node_exporter never sees a half
+    written file. To keep the number of series small, the Prometheus totals are labelled by topic and stage only; the
+    bag file of each measurement is in the JSON-lines file.
+
+    Peak memory is the highest resident set size of the process during the stage, less the resident set size at the start
+    of the stage, sampled every few milliseconds from /proc/self/statm. This includes the memory Polars allocates outside of
+    Python. Where /proc isn't available, the peak of the whole process so far is used instead.
+
+    The old per-topic console output (data frame shapes, the first rows, per-topic times) is only printed if verbose is
+    True. Otherwise print_summary() prints one table of the totals per stage at the end.
+
+Usage:
+    Use with the parse_and_insert.py and bag_reader.py scripts.
+        metrics = IngestMetrics(jsonl_file = 'ingest_metrics.jsonl', prometheus_file = 'ivsg_ingest.prom', verbose = False)
+        metrics.set_bag(bag_name)
+        with metrics.stage(topic, 'transform') as record:
+            new_df = ...
+            record.rows = new_df.height
+            record.bytes = new_df.estimated_size()
+        metrics.print_summary()
+        metrics.close()
+
+    Functions that take metrics = None can use measure(metrics, topic, stage) and log(metrics, ...), which do nothing extra
+    (and print as before) without an IngestMetrics.
+
+Method(s):
+    1. class MemorySampler(interval = 0.01)
+        Context manager that keeps track of the peak resident set size while a stage runs.
+
+    2. class StageRecord(bag, topic, stage)
+        The measurement of one stage. rows and bytes are filled in by the code being measured.
+
+    3. class IngestMetrics(jsonl_file = None, prometheus_file = None, verbose = True)
+        Record stages, write them to the JSON-lines and Prometheus files, and print a summary.
+
+    4. measure(metrics, topic, stage)
+        metrics.stage(topic, stage), or a record that is thrown away if metrics is None.
+
+    5. log(metrics, *args)
+        Print, unless metrics is an IngestMetrics with verbose = False.
+'''
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# Prefix of every Prometheus metric name
+metric_prefix = 'ivsg_ingest'
+
+# Status of a stage in the JSON-lines file
+status_ok = 'ok'
+status_error = 'error'
+
+'''
+Get the resident set size of the process in bytes from /proc/self/statm, or None if /proc isn't available.
+'''
+def get_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+'''
+Get the peak resident set size of the whole process so far in bytes (getrusage gives kilobytes on Linux and bytes on macOS).
+'''
+def get_max_rss():
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if (sys.platform == 'darwin') else max_rss * 1024
+
+'''
+    =================================== Class MemorySampler =======================================
+    #	Purpose: Keep track of the peak resident set size of the process while a stage runs. A
+    #            background thread samples /proc/self/statm every interval seconds.
+    #
+    #   Methods:
+    #       1. def __enter__(self) / def __exit__(self, ...)
+    #           Start and stop sampling.
+    #
+    #       2. def get_peak_mb(self)
+    #           Peak resident set size during the stage, less the size at the start, in megabytes.
+    #
+    #       3. def get_peak_bytes(self)
+    #           The same, in bytes.
+    ===============================================================================================
+'''
+class MemorySampler:
+    def __init__(self, interval = 0.01):
+        self.interval = interval
+        self.start_rss = 0
+        self.peak_rss = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start_rss = get_rss()
+
+        if self.start_rss is None:
+            self.start_rss = 0
+        else:
+            self.peak_rss = self.start_rss
+            self.thread = threading.Thread(target = self.sample, daemon = True)
+            self.thread.start()
+
+        return self
+
+    def __exit__(self, *args):
+        self.stop_event.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.peak_rss = max(self.peak_rss, get_rss())
+        else:
+            self.peak_rss = get_max_rss()
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, get_rss())
+
+    def get_peak_bytes(self):
+        return max(self.peak_rss - self.start_rss, 0)
+
+    def get_peak_mb(self):
+        return self.get_peak_bytes() / 2**20
+
+'''
+    ===================================== Class StageRecord =======================================
+    #	Purpose: The measurement of one stage of one topic of one bag file. The code being measured
+    #            fills in rows and bytes; the rest is filled in by IngestMetrics.stage.
+    #
+    #   Methods:
+    #       1. def to_dict(self)
+    #           The record as a dictionary (one line of the JSON-lines file).
+    ===============================================================================================
+'''
+class StageRecord:
+    def __init__(self, bag, topic, stage):
+        self.bag = bag
+        self.topic = topic
+        self.stage = stage
+        self.start_time = time.time()
+        self.seconds = 0
+        self.rows = 0
+        self.bytes = 0
+        self.peak_memory_bytes = 0
+        self.status = status_ok
+        self.error = None
+
+    def to_dict(self):
+        return {'time': datetime.fromtimestamp(self.start_time, timezone.utc).isoformat(),
+                'bag': self.bag,
+                'topic': self.topic,
+                'stage': self.stage,
+                'seconds': self.seconds,
+                'rows': self.rows,
+                'bytes': self.bytes,
+                'peak_memory_bytes': self.peak_memory_bytes,
+                'status': self.status,
+                'error': self.error}
+
+'''
+    ==================================== Class IngestMetrics ======================================
+    #	Purpose: Record the stages of an ingest and write them out. Safe to use from several threads
+    #            (the stages of a pipelined bag file run at the same time).
+    #
+    #   Methods:
+    #       1. def set_bag(self, bag)
+    #           Set the bag file that the next stages belong to.
+    #
+    #       2. def stage(self, topic, stage)
+    #           Context manager that measures one stage and yields its StageRecord. An error inside
+    #           the stage is recorded and raised again.
+    #
+    #       3. def add_record(self, record_dict)
+    #           Add a record made somewhere else (for example, by a worker process).
+    #
+    #       4. def print(self, *args)
+    #           Print only if verbose is True.
+    #
+    #       5. def write_prometheus(self)
+    #           Write the totals per topic and stage to the Prometheus textfile-collector file.
+    #
+    #       6. def print_summary(self)
+    #           Print the totals per stage.
+    #
+    #       7. def close(self)
+    #           Write the Prometheus file one last time and close the JSON-lines file.
+    ===============================================================================================
+'''
+class IngestMetrics:
+    def __init__(self, jsonl_file = None, prometheus_file = None, verbose = True):
+        self.jsonl_file = jsonl_file
+        self.prometheus_file = prometheus_file
+        self.verbose = verbose
+
+        self.bag = None
+        self.records = []     # Every record, as dictionaries
+        self.total_dict = {}  # (topic, stage) : {seconds, rows, bytes, peak_memory_bytes, runs, errors}
+        self.lock = threading.Lock()
+
+        self.jsonl = open(jsonl_file, 'a') if (jsonl_file is not None) else None
+
+    def set_bag(self, bag):
+        self.bag = bag
+
+    @contextmanager
+    def stage(self, topic, stage):
+        record = StageRecord(self.bag, topic, stage)
+        start_time = time.perf_counter()
+
+        try:
+            with MemorySampler() as sampler:
+                yield record
+
+        except Exception as e:
+            record.status = status_error
+            record.error = f"{e}"
+            raise
+
+        finally:
+            record.seconds = time.perf_counter() - start_time
+            record.peak_memory_bytes = sampler.get_peak_bytes()
+            self.add_record(record.to_dict())
+
+    def add_record(self, record_dict):
+        with self.lock:
+            self.records.append(record_dict)
+
+            # Keep the totals for the Prometheus file and the summary
+            key = (record_dict['topic'], record_dict['stage'])
+            if key not in self.total_dict:
+                self.total_dict[key] = {'seconds': 0, 'rows': 0, 'bytes': 0, 'peak_memory_bytes': 0, 'runs': 0, 'errors': 0}
+            total = self.total_dict[key]
+            total['seconds'] += record_dict['seconds']
+            total['rows'] += record_dict['rows']
+            total['bytes'] += record_dict['bytes']
+            total['peak_memory_bytes'] = max(total['peak_memory_bytes'], record_dict['peak_memory_bytes'])
+            total['runs'] += 1
+            total['errors'] += (record_dict['status'] == status_error)
+
+            if self.jsonl is not None:
+                self.jsonl.write(json.dumps(record_dict) + '\n')
+                self.jsonl.flush()
+
+    def print(self, *args):
+        if self.verbose:
+            print(*args)
+
+    def write_prometheus(self):
+        if self.prometheus_file is None:
+            return
+
+        metric_lst = [('stage_seconds_total', 'counter', 'Seconds spent in each ingest stage.', 'seconds'),
+                      ('stage_rows_total', 'counter', 'Rows handled by each ingest stage.', 'rows'),
+                      ('stage_bytes_total', 'counter', 'Bytes handled by each ingest stage.', 'bytes'),
+                      ('stage_peak_memory_bytes', 'gauge', 'Highest memory growth of the process during one run of each ingest stage.', 'peak_memory_bytes'),
+                      ('stage_runs_total', 'counter', 'Runs of each ingest stage.', 'runs'),
+                      ('stage_errors_total', 'counter', 'Runs of each ingest stage that failed.', 'errors')]
+
+        with self.lock:
+            lines = []
+            for name, metric_type, description, field in metric_lst:
+                lines.append(f"# HELP {metric_prefix}_{name} {description}")
+                lines.append(f"# TYPE {metric_prefix}_{name} {metric_type}")
+                for (topic, stage), total in sorted(self.total_dict.items()):
+                    topic_label = topic.replace('\\', '\\\\').replace('"', '\\"')
+                    lines.append(f"{metric_prefix}_{name}{{topic=\"{topic_label}\",stage=\"{stage}\"}} {total[field]}")
+
+            lines.append(f"# HELP {metric_prefix}_last_update_timestamp_seconds Time the ingest metrics were last written.")
+            lines.append(f"# TYPE {metric_prefix}_last_update_timestamp_seconds gauge")
+            lines.append(f"{metric_prefix}_last_update_timestamp_seconds {time.time()}")
+
+        # Write to a temporary file in the same folder and rename it, so the file is never seen half written
+        folder = os.path.dirname(os.path.abspath(self.prometheus_file))
+        os.makedirs(folder, exist_ok = True)
+        file_descriptor, temp_file = tempfile.mkstemp(dir = folder, prefix = '.ingest_metrics_', suffix = '.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as file:
+                file.write('\n'.join(lines) + '\n')
+            os.chmod(temp_file, 0o644)
+            os.replace(temp_file, self.prometheus_file)
+        except OSError as e:
+            print(f"\nUnable to write the Prometheus file: {e}")
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    def print_summary(self):
+        stage_dict = {}
+        with self.lock:
+            for (topic, stage), total in self.total_dict.items():
+                if stage not in stage_dict:
+                    stage_dict[stage] = {'seconds': 0, 'rows': 0, 'bytes': 0, 'peak_memory_bytes': 0, 'runs': 0, 'errors': 0}
+                for field, value in total.items():
+                    if (field == 'peak_memory_bytes'):
+                        stage_dict[stage][field] = max(stage_dict[stage][field], value)
+                    else:
+                        stage_dict[stage][field] += value
+
+        print("------------------------------------------------------------------------------------------------------------------")
+        print("Ingest stages:")
+        print(f"{'stage':<14}{'runs':>8}{'errors':>8}{'seconds':>10}{'rows':>12}{'MB':>10}{'rows/sec':>12}{'MB/sec':>10}{'peak MB':>10}")
+        for stage, total in stage_dict.items():
+            seconds = total['seconds']
+            size_mb = total['bytes'] / 2**20
+            rows_per_sec = (total['rows'] / seconds) if (seconds > 0) else 0
+            mb_per_sec = (size_mb / seconds) if (seconds > 0) else 0
+            print(f"{stage:<14}{total['runs']:>8}{total['errors']:>8}{seconds:>10.2f}{total['rows']:>12}{size_mb:>10.1f}"
+                  f"{rows_per_sec:>12.0f}{mb_per_sec:>10.1f}{total['peak_memory_bytes'] / 2**20:>10.1f}")
+        print("------------------------------------------------------------------------------------------------------------------")
+
+    def close(self):
+        self.write_prometheus()
+
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
+
+'''
+Measure a stage with metrics.stage(topic, stage). If metrics is None, the stage is run without being measured and the record it fills
+in is thrown away.
+'''
+@contextmanager
+def measure(metrics, topic, stage):
+    if metrics is None:
+        yield StageRecord(None, topic, stage)
+    else:
+        with metrics.stage(topic, stage) as record:
+            yield record
+
+'''
+Print, unless metrics is an IngestMetrics with verbose = False.
+'''
+def log(metrics, *args):
+    if (metrics is None) or metrics.verbose:
+        print(*args)
@@ -0,0 +1,291 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script profiles an ingest without having to edit main() by hand. parse_and_insert.py and parse_and_insert_no_db.py
+    take a --profile option, and the work they do is split into scopes: 'bag_to_df' (reading every topic of a bag file in
+    one pass) and one scope per topic (update_df, df_to_db, and write_csv for that topic). Each scope is profiled on its own,
+    and its results are added up across every bag file of the run.
+
+    Two profilers are available:
+        cprofile    The deterministic profiler (cProfile). Every Python call is counted, so the numbers are exact, but the
+                    ingest runs slower.
+        sample      A sampling profiler. A background thread looks at the Python stack every sample_interval seconds, so
+                    the ingest runs at close to its normal speed, which is better for long production bag files.
+    Both modes sample the stack, so every scope gets a collapsed-stack file (one 'frame;frame;frame count' line per stack)
+    that flamegraph.pl, speedscope, or inferno can turn into a flame graph. Time spent in Polars or NumPy shows up under the
+    Python function that called them.
+
+    tracemalloc also runs in both modes. At the end of each scope, the memory allocated by Python that is still held is
+    compared with the start of the scope, and the lines that allocated the most are kept. Memory allocated inside of Polars
+    (outside of Python) isn't seen by tracemalloc; see ingest_metrics.py for the peak memory of the whole process.
+
+    The files are written into the profile folder when the profiler is closed:
+        <scope>.pstats        cProfile statistics (cprofile mode only), for python -m pstats or snakeviz
+        <scope>.collapsed     collapsed stacks for a flame graph
+        <scope>.alloc.txt     the top allocation sites
+    where <scope> is 'bag_to_df' or the topic with '/' written as '_slash_', as for the CSV files.
+
+    Only the thread that made the IngestProfiler is profiled. With pipelined = 1, the transform and sink threads aren't
+    profiled (cProfile can only run on one thread at a time), and with parallel = 1, the worker processes aren't profiled,
+    so use pipelined = 0 and parallel = 0 when profiling.
+
+Usage:
+    python(3) parse_and_insert.py [<>.bag, <>.csv, or a folder] --profile[=cprofile or sample] [--profile-dir=<folder>]
+
+    Use with the parse_and_insert.py and parse_and_insert_no_db.py scripts.
+        profile_mode, profile_folder = get_profile_args(sys.argv)   # Also removes the options from sys.argv
+        profiler = IngestProfiler(profile_folder, profile_mode) if (profile_mode is not None) else None
+
+        with profile(profiler, topic):
+            new_df = polars.update_df(...)
+
+        if profiler is not None:
+            profiler.close()
+
+Method(s):
+    1. get_profile_args(argv)
+        Find the --profile and --profile-dir options and remove them from argv. Returns the profile mode (or None) and
+        the profile folder.
+
+    2. class StackSampler(thread_id, interval)
+        Background thread that counts the Python stacks of one thread, keyed by the scope they were taken in.
+
+    3. class IngestProfiler(folder, mode = 'cprofile', sample_interval = 0.005, n_top = 50)
+        Profile each scope of an ingest with cProfile and/or the stack sampler, and tracemalloc, and write the results.
+
+    4. profile(profiler, scope)
+        profiler.scope(scope), or nothing if profiler is None.
+'''
+from contextlib import contextmanager, nullcontext
+import cProfile
+from datetime import datetime
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+
+# Profilers that --profile can choose between
+profile_mode_lst = ['cprofile', 'sample']
+default_profile_mode = 'cprofile'
+
+# Number of frames tracemalloc keeps per allocation
+tracemalloc_frames = 1
+
+'''
+Find the --profile (or --profile=cprofile / --profile=sample) and --profile-dir=<folder> options and remove them from argv, so the
+scripts' own argument checks only see the file names. The folder defaults to 'profiles/<date and time>'. Returns the profile mode
+(None if --profile wasn't given) and the folder.
+'''
+def get_profile_args(argv):
+    profile_mode = None
+    profile_folder = os.path.join('profiles', datetime.now().strftime('%Y-%m-%d-%H-%M-%S'))
+    other_lst = []
+
+    for arg in argv:
+        if (arg == '--profile'):
+            profile_mode = default_profile_mode
+        elif arg.startswith('--profile='):
+            profile_mode = arg[len('--profile='):]
+            if profile_mode not in profile_mode_lst:
+                raise ValueError(f"Unknown profile mode '{profile_mode}', should be one of {profile_mode_lst}")
+        elif arg.startswith('--profile-dir='):
+            profile_folder = arg[len('--profile-dir='):]
+        else:
+            other_lst.append(arg)
+
+    argv[:] = other_lst
+
+    return profile_mode, profile_folder
+
+'''
+    ===================================== Class StackSampler ======================================
+    #	Purpose: Count the Python stacks of one thread. Every interval seconds, the stack of the
+    #            thread is taken from sys._current_frames() and counted under the scope the thread
+    #            is in at the time.
+    #
+    #   Methods:
+    #       1. def start(self) / def stop(self)
+    #           Start and stop the sampling thread.
+    #
+    #       2. def set_scope(self, scope)
+    #           Set the scope that the next samples are counted under (None to not count them).
+    ===============================================================================================
+'''
+class StackSampler:
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.scope = None
+        self.stack_count_dict = {}   # scope : {collapsed stack : count}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self.sample, daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def set_scope(self, scope):
+        self.scope = scope
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            scope = self.scope
+            frame = sys._current_frames().get(self.thread_id)
+            if (scope is None) or (frame is None):
+                continue
+
+            # Walk from the innermost frame out, then write the stack from the outermost frame in
+            frame_lst = []
+            while frame is not None:
+                code = frame.f_code
+                frame_lst.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack = ';'.join(reversed(frame_lst))
+
+            count_dict = self.stack_count_dict.setdefault(scope, {})
+            count_dict[stack] = count_dict.get(stack, 0) + 1
+
+'''
+    ==================================== Class IngestProfiler =====================================
+    #	Purpose: Profile each scope of an ingest, adding up the results of the same scope across bag
+    #            files, and write them into folder when closed. Scopes can be nested (the outer scope
+    #            is paused while the inner one runs) but only on the thread that made the profiler.
+    #
+    #   Methods:
+    #       1. def scope(self, scope)
+    #           Context manager that profiles the code inside it as part of scope.
+    #
+    #       2. def close(self)
+    #           Stop profiling and write the .pstats, .collapsed, and .alloc.txt file of every scope.
+    ===============================================================================================
+'''
+class IngestProfiler:
+    def __init__(self, folder, mode = default_profile_mode, sample_interval = 0.005, n_top = 50):
+        if mode not in profile_mode_lst:
+            raise ValueError(f"Unknown profile mode '{mode}', should be one of {profile_mode_lst}")
+
+        self.folder = folder
+        self.mode = mode
+        self.n_top = n_top
+        self.thread_id = threading.get_ident()
+
+        self.profile_dict = {}   # scope : cProfile.Profile
+        self.alloc_dict = {}     # scope : {(file, line) : [size, count]}
+        self.scope_lst = []      # Stack of the scopes that are running, innermost last
+
+        self.sampler = StackSampler(self.thread_id, sample_interval)
+        self.sampler.start()
+
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start(tracemalloc_frames)
+
+        os.makedirs(folder, exist_ok = True)
+        print(f"Profiling with {mode} into '{folder}'.")
+
+    @contextmanager
+    def scope(self, scope):
+        # Only the thread that made the profiler is profiled
+        if (threading.get_ident() != self.thread_id):
+            yield
+            return
+
+        # Pause the outer scope, so the snapshots aren't counted in either scope
+        if (len(self.scope_lst) > 0) and (self.mode == 'cprofile'):
+            self.profile_dict[self.scope_lst[-1]].disable()
+        self.sampler.set_scope(None)
+
+        start_snapshot = tracemalloc.take_snapshot()
+        self.scope_lst.append(scope)
+        self.sampler.set_scope(scope)
+
+        if (self.mode == 'cprofile'):
+            if scope not in self.profile_dict:
+                self.profile_dict[scope] = cProfile.Profile()
+            profile = self.profile_dict[scope]
+            profile.enable()
+
+        try:
+            yield
+
+        finally:
+            if (self.mode == 'cprofile'):
+                profile.disable()
+            self.sampler.set_scope(None)
+
+            self.add_allocations(scope, start_snapshot, tracemalloc.take_snapshot())
+            self.scope_lst.pop()
+
+            # Resume the outer scope
+            if (len(self.scope_lst) > 0):
+                self.sampler.set_scope(self.scope_lst[-1])
+                if (self.mode == 'cprofile'):
+                    self.profile_dict[self.scope_lst[-1]].enable()
+            else:
+                self.sampler.set_scope(None)
+
+    '''
+    Add the memory allocated by each line during a scope (and still held at its end) to the scope's allocation sites. The profiler's own
+    files are left out.
+    '''
+    def add_allocations(self, scope, start_snapshot, end_snapshot):
+        filter_lst = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+        diff_lst = end_snapshot.filter_traces(filter_lst).compare_to(start_snapshot.filter_traces(filter_lst), 'lineno')
+
+        site_dict = self.alloc_dict.setdefault(scope, {})
+        for diff in diff_lst:
+            if (diff.size_diff <= 0):
+                continue
+            frame = diff.traceback[0]
+            site = site_dict.setdefault((frame.filename, frame.lineno), [0, 0])
+            site[0] += diff.size_diff
+            site[1] += diff.count_diff
+
+    def close(self):
+        self.sampler.stop()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+        scope_set = set(self.profile_dict) | set(self.sampler.stack_count_dict) | set(self.alloc_dict)
+        for scope in sorted(scope_set):
+            file_name = os.path.join(self.folder, scope.replace('/', '_slash_'))
+
+            if scope in self.profile_dict:
+                stats = pstats.Stats(self.profile_dict[scope])
+                stats.dump_stats(f"{file_name}.pstats")
+
+            with open(f"{file_name}.collapsed", 'w') as collapsed_file:
+                for stack, count in sorted(self.sampler.stack_count_dict.get(scope, {}).items()):
+                    collapsed_file.write(f"{stack} {count}\n")
+
+            with open(f"{file_name}.alloc.txt", 'w') as alloc_file:
+                site_lst = sorted(self.alloc_dict.get(scope, {}).items(), key = lambda item: item[1][0], reverse = True)
+                alloc_file.write(f"Top {self.n_top} allocation sites of '{scope}' (memory allocated by Python and still held at the end of the scope)\n")
+                alloc_file.write(f"{'KiB':>12}{'blocks':>10}  site\n")
+                for (filename, lineno), (size, count) in site_lst[:self.n_top]:
+                    alloc_file.write(f"{size / 1024:>12.1f}{count:>10}  {filename}:{lineno}\n")
+
+        print(f"\nProfiles of {len(scope_set)} scopes written to '{self.folder}'.")
+
+        # Show the hottest functions of the whole run
+        if (len(self.profile_dict) > 0):
+            stats = pstats.Stats(*self.profile_dict.values())
+            stats.sort_stats('cumulative').print_stats(15)
+
+'''
+Profile the code inside the with block as part of scope, or just run it if profiler is None.
+'''
+def profile(profiler, scope):
+    if profiler is None:
+        return nullcontext()
+    return profiler.scope(scope)
@@ -0,0 +1,432 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script keeps the packets of the 3D LiDAR topics (/velodyne_packets and /ouster_packets) out of the database. The
+    packets of each scan are written into one file of a content-addressed blob store on the local disk (or a network share),
+    and only one row of metadata per scan goes into the velodyne_lidar / ouster_lidar table: the hash of the blob, where it
+    is in the store, its size, and the time its packets cover. The tables stay small, and a bag file of point clouds loads
+    about as fast as the disk can write.
+
+    Blobs:
+        Each scan is one blob, named by the SHA-256 hash of its bytes and sharded into two levels of folders by the first
+        four hex digits of the hash, so no folder holds more than a few thousand files:
+            <root>/3f/a2/3fa2...c1.pkt
+        The location stored in the database is the path under the root ('3f/a2/3fa2...c1.pkt'). The same scan is only ever
+        stored once, so loading a bag file again doesn't write anything new. A blob is written under a temporary name and
+        renamed once it is complete, so a reader (or another writer of the same blob) never sees half of it. Blobs are never
+        deleted by the ingest.
+
+        A blob starts with an offset index of its packets, so any packet can be read without reading the rest of the blob
+        (all little-endian):
+            'IVSGPKT1' (8 bytes), uint32 number of packets, uint32 0
+            for each packet: uint64 offset in the blob, uint32 length, float64 time (seconds)
+            the packets, one after another
+
+    Scans:
+        /velodyne_packets (velodyne_msgs/VelodyneScan): each message is one rotation of packets and becomes one scan. The
+        packets are a fixed-size array of (stamp, uint8[1206] data), so they are read from the serialized message with one
+        np.frombuffer call using a structured data type generated from the message definition, without message objects.
+
+        /ouster_packets (ouster_ros/PacketMsg): each message is one packet, without a header. The packets are gathered into
+        a scan until the frame id in the packet (the uint16 at byte 10, in the header of the first column) changes. The
+        record time of each message in the bag file is used as its time. A scan that is cut by the end of a chunk (see
+        chunk_rows in parse_and_insert.py) is stored as two blobs.
+
+    Writers:
+        Hashing and writing the blobs run on a pool of num_writers threads (hashlib and file writes let go of the GIL), while
+        the bag file is read on the main thread. At most max_pending scans wait to be written, so memory use stays bounded
+        when the disk is slower than the bag file.
+
+Usage:
+    Use with the bag_reader.py, parse_and_insert.py, and parse_and_insert_no_db.py scripts.
+        blob_store = BlobStore('lidar_blobs', num_writers = 4)
+        topic_df_dict = bag_to_dfs(bag_file, topic_key_dict, blob_store = blob_store)   # Metadata rows of /velodyne_packets
+        blob_store.close()
+
+        # Read back the packets of one scan (a memory map of the blob, nothing is read until it is used)
+        index, packets = blob_store.read_scan(hash_tag)   # packets[i] is the bytes of packet i, taken at index['time'][i]
+
+Method(s):
+    1. get_packet_layout(msg_type, msg_def)
+        Work out how to read the packets of a LiDAR message type from its message definition. Returns a PacketLayout, or None
+        if the message doesn't hold packets this script can read.
+
+    2. read_scan_message(data, layout)
+        Read the header stamp, packets, and packet times of a serialized 'scan' message (velodyne_msgs/VelodyneScan).
+
+    3. pack_scan(packets, times)
+        Put the packets of one scan and the offset index in front of them into the bytes of a blob.
+
+    4. read_scan(file_name)
+        Read a blob as its offset index and its packets, as NumPy arrays over a memory map of the file.
+
+    5. class BlobStore(root, num_writers = 4, max_pending = 64)
+        Write blobs into the sharded, content-addressed store on a pool of threads, and read them back.
+
+    6. class PacketBlobExtractor(keys, blob_store, layout)
+        A bag_reader.py extractor for the LiDAR packet topics. Each scan is handed to the BlobStore as it is read, and to_df()
+        returns one row of metadata per scan.
+
+    7. drop_packet_topics(topic_lst)
+        Leave the LiDAR packet topics out of a list of topics, for an ingest without a BlobStore.
+
+    8. get_blob_location(hash_tag)
+        Path of a blob under the root of the store: '<2 hex digits>/<2 hex digits>/<hash>.pkt'.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import struct
+import threading
+
+import numpy as np
+import polars as pl
+
+from ros_struct_decoder import parse_msg_def, resolve_type, flatten_fields
+
+# Start of every blob, and the little-endian offset index of its packets
+blob_magic = b'IVSGPKT1'
+blob_header = struct.Struct('<8sII')
+index_dtype = np.dtype([('offset', '<u8'), ('length', '<u4'), ('time', '<f8')])
+
+# Extension of the blob files
+blob_extension = '.pkt'
+
+# Topics whose packets can only be loaded through a BlobStore
+packet_topic_lst = ['/velodyne_packets', '/ouster_packets']
+
+# Serialized std_msgs/Header: uint32 seq, time stamp, then the uint32 length of frame_id
+header_struct = struct.Struct('<IIII')
+length_struct = struct.Struct('<I')
+
+# Offset of the uint16 frame id in an Ouster lidar packet (timestamp, measurement id, frame id, encoder count of the first column)
+ouster_frame_id_offset = 10
+frame_id_struct = struct.Struct('<H')
+
+'''
+    ===================================== Class PacketLayout ======================================
+    #	Purpose: How the packets of a LiDAR message type are laid out in its serialized messages.
+    #            kind is 'scan' for a message with a header and an array of fixed-size packet
+    #            messages (velodyne_msgs/VelodyneScan), with packet_dtype the structured data type of
+    #            one packet and data_field the name of its bytes, or 'packet' for a message that is a
+    #            single uint8[] packet without a header (ouster_ros/PacketMsg).
+    ===============================================================================================
+'''
+class PacketLayout:
+    def __init__(self, kind, packet_dtype = None, data_field = None):
+        self.kind = kind
+        self.packet_dtype = packet_dtype
+        self.data_field = data_field
+
+'''
+Work out how to read the packets of a LiDAR message type from its message definition (as stored in the bag file). A message with a
+Header and an array of packet messages, where every packet has a fixed size (a time stamp and a fixed-size uint8 array), is read as
+a 'scan'. A message that is just a uint8[] is read as a 'packet'. Returns a PacketLayout, or None for any other message.
+'''
+def get_packet_layout(msg_type, msg_def):
+    try:
+        msg_def_dict = parse_msg_def(msg_type, msg_def)
+        field_lst = msg_def_dict[msg_type]
+
+        if (len(field_lst) == 1) and (field_lst[0][0] == 'uint8[]'):
+            return PacketLayout('packet')
+
+        if (len(field_lst) != 2) or (resolve_type(field_lst[0][0], msg_type, msg_def_dict) != 'std_msgs/Header') or not field_lst[1][0].endswith('[]'):
+            return None
+
+        packet_type = resolve_type(field_lst[1][0][:-2], msg_type, msg_def_dict)
+        packet_fields = flatten_fields(packet_type, msg_def_dict)
+
+        # Every field has to have a fixed size, with the stamp and one uint8 array of data
+        if any(field_type == 'string' or (isinstance(field_type, tuple) and field_type[0] == 'array') for _, field_type in packet_fields):
+            return None
+
+        data_lst = [path for path, field_type in packet_fields if isinstance(field_type, tuple) and (field_type[0] == '<u1')]
+        path_set = {path for path, _ in packet_fields}
+        if (len(data_lst) != 1) or not {'stamp.secs', 'stamp.nsecs'} <= path_set:
+            return None
+
+        return PacketLayout('scan', np.dtype(packet_fields), data_lst[0])
+
+    except ValueError:
+        return None
+
+'''
+Read a serialized 'scan' message (see get_packet_layout): the header (seq, stamp, frame_id), then the uint32 number of packets and the
+packets themselves, which are read with one np.frombuffer call. Returns the secs and nsecs of the header stamp, the packets (a
+structured NumPy array of layout.packet_dtype over data), and the time of each packet in seconds.
+'''
+def read_scan_message(data, layout):
+    _, secs, nsecs, frame_id_length = header_struct.unpack_from(data, 0)
+    offset = header_struct.size + frame_id_length
+    n_packets = length_struct.unpack_from(data, offset)[0]
+
+    packets = np.frombuffer(data, dtype = layout.packet_dtype, count = n_packets, offset = offset + length_struct.size)
+    times = packets['stamp.secs'] + packets['stamp.nsecs'] * 10**(-9)
+
+    return secs, nsecs, packets, times
+
+'''
+Put the packets of one scan into the bytes of a blob: the blob header, the offset index, then the packets. packets is either a 2D NumPy
+uint8 array (one row per packet, as for the Velodyne) or a list of bytes, and times is the time of each packet in seconds.
+'''
+def pack_scan(packets, times):
+    n_packets = len(packets)
+
+    if isinstance(packets, np.ndarray):
+        lengths = np.full(n_packets, packets.shape[1], dtype = np.int64)
+        payload = np.ascontiguousarray(packets).tobytes()
+    else:
+        lengths = np.fromiter(map(len, packets), dtype = np.int64, count = n_packets)
+        payload = b''.join(packets)
+
+    index = np.empty(n_packets, dtype = index_dtype)
+    index['offset'] = blob_header.size + index_dtype.itemsize * n_packets + np.cumsum(lengths) - lengths
+    index['length'] = lengths
+    index['time'] = times
+
+    return blob_header.pack(blob_magic, n_packets, 0) + index.tobytes() + payload
+
+'''
+Read a blob as its offset index (a NumPy array of offset, length, and time) and its packets. The file is memory-mapped, so only the
+parts that are used are read from the disk. If every packet has the same length (as for the Velodyne), the packets are one 2D uint8
+array, otherwise a list of 1D uint8 arrays. Raises ValueError if the file isn't a blob.
+'''
+def read_scan(file_name):
+    data = np.memmap(file_name, dtype = np.uint8, mode = 'r')
+
+    magic, n_packets, _ = blob_header.unpack(data[:blob_header.size].tobytes())
+    if (magic != blob_magic):
+        raise ValueError(f"'{file_name}' is not a LiDAR packet blob")
+
+    index_end = blob_header.size + index_dtype.itemsize * n_packets
+    index = data[blob_header.size:index_end].view(index_dtype)
+
+    if (n_packets > 0) and (index['length'].min() == index['length'].max()):
+        packets = data[index_end:].reshape(n_packets, int(index['length'][0]))
+    else:
+        packets = [data[offset:offset + length] for offset, length in zip(index['offset'], index['length'])]
+
+    return index, packets
+
+'''
+    ====================================== Class BlobStore ========================================
+    #	Purpose: Write blobs into a sharded, content-addressed store under root on a pool of
+    #            num_writers threads, with at most max_pending blobs waiting to be written, and read
+    #            them back. Keeps count of the blobs and bytes that were new.
+    #
+    #   Methods:
+    #       1. def get_location(self, hash_tag)
+    #           Path of a blob under the root: '<2 hex digits>/<2 hex digits>/<hash>.pkt'.
+    #
+    #       2. def write(self, blob)
+    #           Hash and write one blob (if it isn't in the store already) on the calling thread.
+    #           Returns (hash_tag, location, size).
+    #
+    #       3. def submit(self, blob)
+    #           Hand a blob to the writer threads. Returns a Future of write(blob).
+    #
+    #       4. def read_scan(self, hash_tag)
+    #           The offset index and packets of a blob (see read_scan).
+    #
+    #       5. def close(self)
+    #           Wait for every blob to be written and stop the writer threads.
+    ===============================================================================================
+'''
+class BlobStore:
+    def __init__(self, root, num_writers = 4, max_pending = 64):
+        self.root = root
+        self.num_writers = num_writers
+        self.max_pending = max_pending
+
+        self.n_new = 0           # Blobs written by this process
+        self.n_existing = 0      # Blobs that were already in the store
+        self.bytes_written = 0
+
+        os.makedirs(root, exist_ok = True)
+        self.start()
+
+    def start(self):
+        self.lock = threading.Lock()
+        self.pending = threading.BoundedSemaphore(self.max_pending)
+        self.executor = ThreadPoolExecutor(max_workers = self.num_writers, thread_name_prefix = 'blob_writer')
+
+    def __getstate__(self):
+        # Sent to the worker processes without the threads, each worker starts its own and counts its own blobs
+        state = self.__dict__.copy()
+        for key in ('lock', 'pending', 'executor'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.n_new = 0
+        self.n_existing = 0
+        self.bytes_written = 0
+        self.start()
+
+    def get_location(self, hash_tag):
+        return get_blob_location(hash_tag)
+
+    def write(self, blob):
+        hash_tag = hashlib.sha256(blob).hexdigest()
+        location = self.get_location(hash_tag)
+        file_name = os.path.join(self.root, location)
+
+        if os.path.exists(file_name):
+            with self.lock:
+                self.n_existing += 1
+            return hash_tag, location, len(blob)
+
+        # Write under a temporary name, then rename, so the blob appears all at once
+        os.makedirs(os.path.dirname(file_name), exist_ok = True)
+        temp_file = f"{file_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'wb') as blob_file:
+            blob_file.write(blob)
+        os.replace(temp_file, file_name)
+
+        with self.lock:
+            self.n_new += 1
+            self.bytes_written += len(blob)
+
+        return hash_tag, location, len(blob)
+
+    def submit(self, blob):
+        # Wait here if max_pending blobs haven't been written yet
+        self.pending.acquire()
+
+        try:
+            future = self.executor.submit(self.write, blob)
+        except Exception:
+            self.pending.release()
+            raise
+
+        future.add_done_callback(lambda _: self.pending.release())
+
+        return future
+
+    def read_scan(self, hash_tag):
+        return read_scan(os.path.join(self.root, self.get_location(hash_tag)))
+
+    def close(self):
+        self.executor.shutdown(wait = True)
+        print(f"\nLiDAR blob store '{self.root}': {self.n_new} new blobs ({self.bytes_written / 2**20:.1f} MB), "
+              f"{self.n_existing} already stored.")
+
+'''
+    ================================= Class PacketBlobExtractor ===================================
+    #	Purpose: An extractor (see bag_reader.py) for the LiDAR packet topics, read with raw = True.
+    #            The packets of each scan are packed into a blob and handed to the BlobStore as soon as
+    #            the scan is complete, so only the metadata of each scan is kept in memory.
+    #
+    #   Methods:
+    #       1. def add_raw(self, raw_msg, t)
+    #           Read the packets of one serialized message. t is its record time in the bag file.
+    #
+    #       2. def to_df(self)
+    #           Wait for the blobs to be written, and return one row per scan with the keys as columns:
+    #           rosbagTimestamp, secs, nsecs, hash_tag, location, file_size, and file_time (the seconds
+    #           between the first and last packet of the scan).
+    ===============================================================================================
+'''
+class PacketBlobExtractor:
+    # iter_bag_batches hands this extractor the record time of each message too
+    needs_time = True
+
+    def __init__(self, keys, blob_store, layout):
+        self.keys = keys
+        self.blob_store = blob_store
+        self.layout = layout
+
+        self.secs_lst = []
+        self.nsecs_lst = []
+        self.duration_lst = []
+        self.future_lst = []
+
+        # Packets of the Ouster frame that is being gathered
+        self.frame_id = None
+        self.frame_packet_lst = []
+        self.frame_time_lst = []
+        self.frame_stamp = None
+
+    def add_raw(self, raw_msg, t):
+        data = raw_msg[1]
+
+        if (self.layout.kind == 'scan'):
+            secs, nsecs, packets, times = read_scan_message(data, self.layout)
+            self.add_scan(secs, nsecs, pack_scan(packets[self.layout.data_field], times), times)
+
+        else:
+            length = length_struct.unpack_from(data, 0)[0]
+            packet = data[length_struct.size:length_struct.size + length]
+            frame_id = frame_id_struct.unpack_from(packet, ouster_frame_id_offset)[0] if (length >= ouster_frame_id_offset + 2) else None
+
+            # A new frame id starts a new scan
+            if (frame_id != self.frame_id) and (len(self.frame_packet_lst) > 0):
+                self.flush_frame()
+
+            if (len(self.frame_packet_lst) == 0):
+                self.frame_stamp = (t.secs, t.nsecs)
+            self.frame_id = frame_id
+            self.frame_packet_lst.append(packet)
+            self.frame_time_lst.append(t.secs + t.nsecs * 10**(-9))
+
+    '''
+    Pack the gathered Ouster packets into a scan.
+    '''
+    def flush_frame(self):
+        times = np.array(self.frame_time_lst)
+        self.add_scan(self.frame_stamp[0], self.frame_stamp[1], pack_scan(self.frame_packet_lst, times), times)
+
+        self.frame_packet_lst = []
+        self.frame_time_lst = []
+
+    def add_scan(self, secs, nsecs, blob, times):
+        self.secs_lst.append(secs)
+        self.nsecs_lst.append(nsecs)
+        self.duration_lst.append(float(times.max() - times.min()) if (len(times) > 0) else 0.0)
+        self.future_lst.append(self.blob_store.submit(blob))
+
+    def to_df(self):
+        if (len(self.frame_packet_lst) > 0):
+            self.flush_frame()
+
+        if (len(self.future_lst) == 0):
+            return pl.DataFrame()
+
+        # Wait for the blobs in order (raises the first error of any writer)
+        hash_lst, location_lst, size_lst = zip(*[future.result() for future in self.future_lst])
+
+        secs = np.array(self.secs_lst, dtype = np.int64)
+        nsecs = np.array(self.nsecs_lst, dtype = np.int64)
+        column_dict = {'rosbagTimestamp': pl.Series(secs + nsecs * 10**(-9)),
+                       'secs': pl.Series(secs),
+                       'nsecs': pl.Series(nsecs),
+                       'hash_tag': pl.Series(hash_lst, dtype = pl.Utf8),
+                       'location': pl.Series(location_lst, dtype = pl.Utf8),
+                       'file_size': pl.Series(size_lst, dtype = pl.Int64),
+                       'file_time': pl.Series(self.duration_lst, dtype = pl.Float32)}
+
+        return pl.DataFrame({key : column_dict[key].alias(key) for key in self.keys})
+
+'''
+Get the path of a blob under the root of the store from its hash: two levels of folders named by the first four hex digits, then the
+hash itself ('3f/a2/3fa2...c1.pkt').
+'''
+def get_blob_location(hash_tag):
+    return os.path.join(hash_tag[:2], hash_tag[2:4], f"{hash_tag}{blob_extension}")
+
+'''
+Leave the LiDAR packet topics out of a list of topics. Their tables only hold the metadata of the blobs, so without a BlobStore there
+is nothing to load for them. Returns the topics that are left.
+'''
+def drop_packet_topics(topic_lst):
+    skipped_lst = [topic for topic in topic_lst if topic in packet_topic_lst]
+    if (len(skipped_lst) > 0):
+        print(f"\nNo LiDAR blob store was given (to_blob_store = 0), skipping {skipped_lst}.")
+
+    return [topic for topic in topic_lst if topic not in packet_topic_lst]
@@ -24,11 +24,32 @@ Purpose: The purpose of this script is to utilize the Polars and Pandas library
             ----------------------
             4. df  -> db    (DONE)
             5. df  -> csv   (DONE)
+            6. df  -> Parquet / Arrow IPC dataset   (DONE)
 
-Usage:  python(3) parse_and_insert.py
+Usage:  python(3) parse_and_insert.py [<>.bag, <>.csv, or a folder of '.bag' or '.csv' files] [--profile[=cprofile or sample]]
+                                     [--profile-dir=<folder>]
     - Use with get_topics.py and raw_data_db_launch.sql
     - Need to know before using:
         - from_db, from_bag, from_csv, to_csv, to_db: 0 if no and 1 if yes
+        - use_cache: 1 to keep the tables read from the database (from_db) in a local Parquet cache of at most cache_mb
+          megabytes in cache_folder, so reading the same bag file again doesn't export the tables again (see df_cache.py)
+        - to_dataset: 1 to also write each topic into a Parquet (or Arrow IPC, with dataset_format = 'ipc') dataset in
+          dataset_folder, partitioned by bag file and topic (see columnar_sink.py)
+        - to_blob_store: 1 to write the packets of the LiDAR packet topics (/velodyne_packets, /ouster_packets) into the
+          content-addressed blob store in blob_folder with blob_workers writer threads, so only one row of metadata per
+          scan goes into the database (see lidar_blob_store.py)
+        - incremental: 1 to skip the topics of bag files that are already in the database (see ingest_manifest.py)
+        - chunk_rows: 0 to read each topic of a bag file whole, or the number of messages per chunk for topics that
+          don't fit in memory (such as /sick_lms_5xx/scan and the LiDAR packet topics)
+        - pipelined: 1 to decode, alter, and write a bag file's topics (or chunks) on separate threads that overlap
+        - metrics_file: JSON-lines file that the duration, rows, bytes, and peak memory of every stage of every topic of
+          every bag file are appended to (see ingest_metrics.py), or None
+        - prometheus_file: Prometheus textfile-collector file for node_exporter (a '.prom' file in the folder given to
+          --collector.textfile.directory), or None
+        - verbose: 1 to print the data frames and timing of every topic as before, 0 to only print a summary per stage
+        - --profile: run under cProfile (or the sampling profiler with --profile=sample) and tracemalloc, writing a .pstats,
+          a collapsed-stack (flame graph), and an allocation site file for 'bag_to_df' and for each topic into
+          --profile-dir (see ingest_profiler.py). Use with parallel = 0 and pipelined = 0
         - topic_lst: ['/GPS_SparkFun_Front_GGA', '/GPS_SparkFun_Front_VTG', 
                       '/GPS_SparkFun_RearLeft_GGA', '/GPS_SparkFun_RearLeft_GST', '/GPS_SparkFun_RearLeft_VTG',
                       '/GPS_SparkFun_RearRight_GGA', '/GPS_SparkFun_RearRight_GST', '/GPS_SparkFun_RearRight_VTG',
@@ -36,6 +57,11 @@ Usage:  python(3) parse_and_insert.py
         - database connection parameters: username, password, server, port, database name
         - if you're reading from the database or from CSV files, you need to know
           either the corresponding bag file name OR id
+        - CSV files are named after their topic ('_slash_parseEncoder.csv'), and split files can have anything before the first
+          '_slash_' or after the topic name ('part1_slash_parseEncoder_0001.csv'). Every CSV file of the same topic (for example,
+          in a folder of thousands of split CSV files) is read together in one parallel scan
+        - given a folder, its sub-folders are read too. A sub-folder of CSV files is read as the bag file it is named after, as
+          write_csv does ('mapping_van_2024-06-20-15-25-21_0/_slash_parseEncoder.csv')
 
 Packages to Install:
     (May need to use: python -m pip install <package-name> --break-system-packages)
@@ -55,13 +81,19 @@ To-Do:
     2. Integrate velodyne parsing functions
 '''
 
-from io import StringIO 
+from io import StringIO, BytesIO
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import threading
 import os
 import sys
 import csv
 import time
 import datetime
+import itertools
+import traceback
 import warnings
 import pdb
 
@@ -72,19 +104,53 @@ import polars as pl
 import numpy as np
 
 # Keep track of the differences between the ROS topics and database table topics
-from get_topics import get_topics                           
+from get_topics import get_topics
+from db_pool import get_pool, close_pools
+from bag_reader import bag_to_dfs, iter_bag_batches, get_bag_info
+from ingest_manifest import IngestManifest, get_file_hash, status_done
+from ingest_metrics import IngestMetrics, measure, log
+from ingest_profiler import IngestProfiler, get_profile_args, profile
+from columnar_sink import DatasetWriter
+from lidar_blob_store import BlobStore, drop_packet_topics
+from df_cache import DataFrameCache, default_cache_folder, select_cached
+from pipeline import Stage, run_pipeline, print_pipeline_report
+from pg_copy import can_encode_binary, iter_batches, iter_binary_copy, iter_csv_copy, CopyStream, copy_read_size
+from pg_copy import get_polars_schema, CopyOutParser, array_text_to_list, format_array_columns
 
 # Using Pandas yielded an error -> ignore this error
 warnings.simplefilter("ignore", category = FutureWarning)   
 
+# Process-wide cache of base station name : base_station_messages id. There are only a handful of base stations, so this
+# cache lasts across topics and bag files. Once it holds more than base_station_cache_size names, the least recently
+# used name is evicted. Only committed ids are cached: ids found during a transaction are kept by the Database until
+# commit() (see Database.pending_base_station_dict), so a rolled back insert never leaves a stale id behind.
+base_station_cache = OrderedDict()
+base_station_cache_size = 256
+
+# Polars data type of a mapping_dict column : data type to read it from a CSV file with. Numbers are read at full width and
+# narrowed to the database types by update_df, so values such as gpstime are worked out before any precision is lost.
+# Arrays (pl.List) aren't in here, so they are read as text and parsed into List columns by update_df.
+csv_type_dict = {pl.Int32: pl.Int64,
+                 pl.Int64: pl.Int64,
+                 pl.Float32: pl.Float64,
+                 pl.Float64: pl.Float64,
+                 pl.Utf8: pl.Utf8
+}
+
 '''
     ====================================== Class Database =========================================
     #	Purpose: Create a class Database to access the SQL database and perform
     #   simple queries related to creating data frames (df).
     #
+    #   Connections come from a process-wide pool (see db_pool.py) shared by every Database
+    #   instance for the same database. Each thread checks out its own connection and cursor
+    #   the first time it uses self.conn or self.cursor, so parallel topic and bag loaders can
+    #   share a small pool instead of connecting again for every job.
+    #
     #   Methods:
-    #       1. def __init__(self, username, password, server, port, db_name)
-    #           Establish a connection to the SQL database and create a cursor.
+    #       1. def __init__(self, username, password, server, port, db_name, min_conn = 1, max_conn = 4)
+    #           Get the connection pool for the SQL database (creating it with min_conn to max_conn
+    #           connections the first time), then check out a connection and create a cursor.
     #           Takes a username, password, server, port, and database name as inputs.
     #
     #       2. def insert_and_return(self, table_name, col_lst, val_lst)
@@ -98,46 +164,104 @@ warnings.simplefilter("ignore", category = FutureWarning)
     #           this row.
     #           Query: SELECT col1 FROM table_name WHERE col2 = 'val';
     # 
-    #       4. def select_multiple(self, table_name, col, val)
+    #       4. def select_many(self, table_name, col1, col2, val_lst)
+    #           Same as select, but for a list of values in one round trip. Any values that are not
+    #           in the table yet are inserted. Returns a dictionary of val : col1.
+    #           Query: WITH input (val) AS (VALUES ...), inserted AS (INSERT ... ON CONFLICT DO NOTHING RETURNING ...)
+    #                  SELECT col1, col2 FROM inserted UNION ALL SELECT col1, col2 FROM table_name JOIN input;
+    #
+    #       5. def select_multiple_batches(self, table_name, col, val, batch_function, batch_mb = 64, col_lst = None)
+    #           Used for reading from the database. Stream the rows of a table where the bag file has a
+    #           certain id out with COPY, parsing them straight into Polars data frames a batch at a time.
+    #           Each batch is handed to batch_function, so memory use stays flat. Returns the number of rows.
+    #           Only the columns in col_lst are read, if given.
+    #           Query: COPY (SELECT * FROM table_name WHERE bag_file_id = val) TO STDOUT WITH CSV
+    #
+    #       6. def select_multiple(self, table_name, col, val, col_lst = None)
     #           Used for reading from the database. Select multiple rows from a table
     #           where the bag file has a certain name. Create a data frame out of these rows.
-    #           Query: SELECT * FROM table_name WHERE bag_file_id = val;
+    #           Query: COPY (SELECT * FROM table_name WHERE bag_file_id = val) TO STDOUT WITH CSV
     #    
-    #       5. def df_to_db(self, table_name, df, db_col_lst)
-    #           Quickly insert a data frame into the database. Convert the data frame into a CSV
-    #           string, then use copy_expert.
-    #           Query: COPY table_name (db_col_lst) FROM STDIN WITH CSV HEADER NULL AS 'NULL'
-    #                  cursor.copy_expert(sql = query, file = csv_buffer)
+    #       7. def df_to_db(self, table_name, df, db_col_lst, copy_format = 'binary', max_buffer_mb = 64)
+    #           Quickly insert a data frame (or an iterator of record batches) into the database. The rows
+    #           are encoded a batch at a time while copy_expert reads them, so at most max_buffer_mb of
+    #           encoded data is in memory. By default, use the PostgreSQL binary COPY format (see pg_copy.py).
+    #           If the data can't be written in the binary format, or the binary COPY fails, fall back to CSV.
+    #           Returns True if the data was inserted (or there was nothing to insert) and False otherwise.
+    #           Query: COPY table_name (db_col_lst) FROM STDIN WITH (FORMAT binary)
+    #                  COPY table_name (db_col_lst) FROM STDIN WITH CSV HEADER NULL AS 'NULL'
+    #                  cursor.copy_expert(sql = query, file = stream)
     # 
-    #       6. def delete(self, table_name, id)
+    #       8. def delete(self, table_name, id)
     #           A simple method to delete a row from a table.
     #           Query: DELETE FROM table_name WHERE id = id;
     #
-    #       7. def disconnect(self)
+    #       9. def commit(self)
+    #           Commit this thread's connection, then add the base station ids found in the
+    #           transaction to the process-wide cache.
+    #
+    #       10. def rollback(self)
+    #           Roll back this thread's connection and forget the base station ids found in the
+    #           transaction.
+    #
+    #       11. def disconnect(self)
     #           Disconnect from the database by closing the cursor, committing the connection,
-    #           and closing the connection.
+    #           and giving this thread's connection back to the pool.
     #
     # 	Author: Sadie Duncan
     # 	Date:   08/09/2024
     ===============================================================================================
 '''
 class Database:
-    # Upon initialization of the database instance, establish a connection to the SQL 
-    # database and create a cursor.
-    def __init__(self, username, password, server, port, db_name):
+    # Upon initialization of the database instance, get the connection pool for the SQL
+    # database, then check out a connection and create a cursor.
+    def __init__(self, username, password, server, port, db_name, min_conn = 1, max_conn = 4):
         try:
-            self.conn = psycopg2.connect(database = db_name,
-                                        user = username,
-                                        password = password,
-                                        host = server,
-                                        port = port)
-            
-            self.cursor = self.conn.cursor()
+            self.pool = get_pool(username, password, server, port, db_name,
+                                 min_size = min_conn, max_size = max_conn)
+            self.local = threading.local()   # Each thread's cursor
+
+            self.cursor   # Check out this thread's connection and create its cursor
             print("PostgreSQL connection is open.")
             
         except psycopg2.Error as e:
             print(f"\nUnable to connect to the database: {e}")
     
+    '''
+    This thread's connection, checked out from the pool the first time it is used.
+    '''
+    @property
+    def conn(self):
+        return self.pool.checkout()
+
+    '''
+    This thread's cursor. A new cursor is created if the thread doesn't have one yet, or if its connection changed.
+    '''
+    @property
+    def cursor(self):
+        conn = self.conn
+        cursor = getattr(self.local, 'cursor', None)
+
+        if (cursor is None) or cursor.closed or (cursor.connection is not conn):
+            cursor = conn.cursor()
+            self.local.cursor = cursor
+
+        return cursor
+
+    '''
+    Base station name : id of the base stations found (or inserted) during this thread's current transaction. These move into
+    base_station_cache on commit() and are dropped on rollback().
+    '''
+    @property
+    def pending_base_station_dict(self):
+        pending_dict = getattr(self.local, 'pending_base_station_dict', None)
+
+        if pending_dict is None:
+            pending_dict = {}
+            self.local.pending_base_station_dict = pending_dict
+
+        return pending_dict
+
     '''
     Insert a new row into a specific table. Accepts a table to insert to, the columns where data will be 
     added, and the values to add to those columns as inputs. Returns the id of this newly created entry.
@@ -163,7 +287,7 @@ class Database:
 
         except psycopg2.Error as e:
             print(f"\nUnable to insert into the database: {e}")
-            conn.rollback()
+            self.rollback()
 
     '''
     Select a singular row from a specific table and return the id of this row.
@@ -195,67 +319,179 @@ class Database:
 
         except psycopg2.Error as e:
             print(f"\nUnable to select from the database: {e}")
-            conn.rollback()
+            self.rollback()
 
     '''
-    Used for reading from the database. Select multiple rows from a table where the bag file has a certain name.
-    Create a data frame out of these rows. Return the data frame.
-    Query: SELECT * FROM table_name WHERE bag_file_id = val;
+    Same as select, but for a whole list of values in a single round trip. Values that are not in the table yet are inserted
+    (col2 needs a UNIQUE constraint, such as base_station_name or bag_file_name). Because the inserted rows are not visible to
+    the rest of the same statement, the new ids come from the RETURNING clause and the existing ids from a join.
+    Returns a dictionary of val : col1.
+    Query: WITH input (val) AS (VALUES (val1), (val2), ...),
+                inserted AS (INSERT INTO table_name (col2) SELECT val FROM input ON CONFLICT (col2) DO NOTHING RETURNING col1, col2)
+           SELECT col1, col2 FROM inserted
+           UNION ALL
+           SELECT table_name.col1, table_name.col2 FROM table_name JOIN input ON table_name.col2 = input.val;
     '''
-    def select_multiple(self, table_name, col, val):
+    def select_many(self, table_name, col1, col2, val_lst):
+        return_dict = {}
+
+        if (len(val_lst) == 0):
+            return return_dict
+
         try:
             cursor = self.cursor
             conn = self.conn
 
-            # Build and execute query
-            select_query = f"SELECT * FROM {table_name} WHERE {col} = {val};"
-            cursor.execute(select_query)
+            # Build and execute the query, passing the values as parameters
+            vals = ', '.join(['(%s)'] * len(val_lst))
+            select_query = (f"WITH input (val) AS (VALUES {vals}), "
+                            f"inserted AS (INSERT INTO {table_name} ({col2}) SELECT val FROM input "
+                            f"ON CONFLICT ({col2}) DO NOTHING RETURNING {col1}, {col2}) "
+                            f"SELECT {col1}, {col2} FROM inserted "
+                            f"UNION ALL "
+                            f"SELECT {table_name}.{col1}, {table_name}.{col2} FROM {table_name} "
+                            f"JOIN input ON {table_name}.{col2} = input.val;")
+            cursor.execute(select_query, list(val_lst))
+
+            # Each returned row is (col1, col2), turn these into a dictionary of col2 : col1
+            for return_id, val in cursor.fetchall():
+                return_dict[val] = return_id
 
-            # Create rows of data out of the selected items
-            rows = cursor.fetchall()
+        except psycopg2.Error as e:
+            print(f"\nUnable to select from the database: {e}")
+            self.rollback()
+
+        return return_dict   # Return the dictionary of value : id
+
+    '''
+    Used for reading from the database. Stream the rows of a table where the bag file has a certain id out of the database with
+    COPY ... TO STDOUT, and parse the CSV text straight into Polars data frames of about batch_mb megabytes each. The column
+    types come from the table itself (a LIMIT 0 query), so nothing is inferred. Each batch is handed to batch_function as
+    soon as it is parsed, so a whole table can be exported without holding it in memory. If col_lst is given, only those columns
+    are read. Returns the number of rows read.
+    Query: SELECT * FROM table_name WHERE col = val LIMIT 0;
+           COPY (SELECT * FROM table_name WHERE col = val) TO STDOUT WITH CSV
+    '''
+    def select_multiple_batches(self, table_name, col, val, batch_function, batch_mb = 64, col_lst = None):
+        n_rows = 0
+
+        try:
+            cursor = self.cursor
+            conn = self.conn
 
-            # Create a list of columns using the cursor.description
-            columns = [header[0] for header in cursor.description]
+            # Build the query
+            columns = '*' if (col_lst is None) else ', '.join(col_lst)
+            select_query = cursor.mogrify(f"SELECT {columns} FROM {table_name} WHERE {col} = %s", (val,)).decode('utf-8')
 
-            # Create a Pandas data frame out of the above. Then transform it into a Polars data frame
-            pd_df = pd.DataFrame(rows, columns = columns)
-            df = pl.from_pandas(pd_df)
+            # Get the columns and their data types without reading any rows
+            cursor.execute(f"{select_query} LIMIT 0;")
+            schema = get_polars_schema(cursor.description)
+
+            # Use copy_expert to stream the rows out, parsing them into Polars data frames along the way
+            parser = CopyOutParser(schema, batch_function, batch_mb)
+            cursor.copy_expert(sql = f"COPY ({select_query}) TO STDOUT WITH CSV", file = parser, size = copy_read_size)
+            parser.close()
+            n_rows = parser.n_rows
 
         except psycopg2.Error as e:
-            df = pl.DataFrame()
             print(f"\nUnable to select from the database: {e}")
-            conn.rollback()
+            self.rollback()
+
+        return n_rows   # Return the number of rows read
+
+    '''
+    Used for reading from the database. Select multiple rows from a table where the bag file has a certain name.
+    Create a data frame out of these rows (read in batches with select_multiple_batches), with only the columns in col_lst if
+    given. Return the data frame.
+    Query: COPY (SELECT * FROM table_name WHERE bag_file_id = val) TO STDOUT WITH CSV
+    '''
+    def select_multiple(self, table_name, col, val, col_lst = None):
+        batch_lst = []
+        self.select_multiple_batches(table_name, col, val, batch_lst.append, col_lst = col_lst)
+
+        # Put the batches together into one data frame (an empty data frame if nothing was found)
+        if (len(batch_lst) > 0):
+            df = pl.concat(batch_lst, rechunk = False)
+        else:
+            df = pl.DataFrame()
 
         return df   # Return the data frame
 
     '''
-    Quickly insert a data frame into the database by converting the data frame into a CSV string, then using copy_expert.
-    Query: COPY table_name (db_col_lst) FROM STDIN WITH CSV HEADER NULL AS 'NULL'
-           cursor.copy_expert(sql = query, file = csv_buffer)
+    Quickly insert a data frame into the database using copy_expert. df can either be a Polars data frame or an iterator of
+    Polars data frames / Arrow record batches (for example, a topic that is read in chunks). copy_format is either 'binary'
+    or 'csv'.
+
+    Nothing is encoded up front. The data is split into batches of at most max_buffer_mb megabytes, and a file-like CopyStream
+    encodes the next batch only when copy_expert asks for more, so memory use does not grow with the size of the table.
+
+    With 'binary', values are sent in the PostgreSQL binary COPY format as typed bytes instead of being formatted into text
+    and parsed again (which is slower and rounds floats). The column types must match the table (update_df takes care of
+    this). The binary COPY runs inside a savepoint: if the data can't be written in the binary format, or the database
+    rejects it, the CSV path is used instead without losing the rest of the transaction. An iterator can only be read once,
+    so in that case the CSV retry is only possible for a data frame. Every batch of an iterator must have the same columns and
+    types as the first one; a batch that doesn't stops the COPY (see iter_same_schema in pg_copy.py) and nothing is inserted.
+    Returns True if the data was inserted (or there was nothing to insert) and False otherwise.
+    Query: COPY table_name (db_col_lst) FROM STDIN WITH (FORMAT binary)
+           COPY table_name (db_col_lst) FROM STDIN WITH CSV HEADER NULL AS 'NULL'
+           cursor.copy_expert(sql = query, file = stream)
     '''
-    def df_to_db(self, table_name, df, db_col_lst):
-        try:
-            cursor = self.cursor
-            conn = self.conn
+    def df_to_db(self, table_name, df, db_col_lst, copy_format = 'binary', max_buffer_mb = 64):
+        cursor = self.cursor
+        conn = self.conn
+
+        query_fillin = f"{table_name} ({', '.join(db_col_lst)})"
 
-            # Convert the data frame into a Pandas data frame and then into a CSV string to work with copy_expert
-            pd_df = df.to_pandas()
-            csv_buffer = StringIO()
-            pd_df.to_csv(csv_buffer, index = False, header = True, sep = ",")
-            csv_buffer.seek(0)           # Rewind the buffer to the beginning for reading
-            # print(csv_buffer.read())   # For simple debugging, print the CSV string to ensure it's not empty
+        # Look at the first batch to decide whether the binary format can be used, then put it back in front of the rest
+        batches = iter_batches(df, max_buffer_mb)
+        first_batch = next(batches, None)
+        if first_batch is None:
+            print(f"\nThe data frame is empty. Nothing was inserted into {table_name}.")
+            return True
+
+        batches = itertools.chain([first_batch], batches)
+
+        if (copy_format == 'binary') and can_encode_binary(first_batch):
+            try:
+                # Stream the batches in the binary COPY format
+                binary_stream = CopyStream(iter_binary_copy(batches))
+
+                # Build the query
+                query = f"COPY {query_fillin} FROM STDIN WITH (FORMAT binary)"
+
+                # Use copy_expert to transport the data into the database
+                cursor.execute("SAVEPOINT df_to_db;")
+                cursor.copy_expert(sql = query, file = binary_stream, size = copy_read_size)
+                cursor.execute("RELEASE SAVEPOINT df_to_db;")
+                print(f"\nThe data frame has successfully been inserted into {table_name}.")
+                return True
+
+            except psycopg2.Error as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT df_to_db;")
+
+                if not isinstance(df, pl.DataFrame):
+                    print(f"\nUnable to write the data frame into the database: {e}")
+                    return False
+
+                print(f"\nUnable to write the data frame into the database with binary COPY, trying CSV: {e}")
+                batches = iter_batches(df, max_buffer_mb)
+
+        try:
+            # Stream the batches as CSV text to work with copy_expert
+            csv_stream = CopyStream(iter_csv_copy(batches))
 
             # Build the query
-            query_fillin = f"{table_name} ({', '.join(db_col_lst)})"
             query = f"COPY {query_fillin} FROM STDIN WITH CSV HEADER NULL AS 'NULL'"
 
             # Use copy_expert to transport the data into the database
-            cursor.copy_expert(sql = query, file = csv_buffer)
+            cursor.copy_expert(sql = query, file = csv_stream, size = copy_read_size)
             print(f"\nThe data frame has successfully been inserted into {table_name}.")
+            return True
 
         except psycopg2.Error as e:
             print(f"\nUnable to write the data frame into the database: {e}")
-            conn.rollback()
+            self.rollback()
+            return False
 
     '''
     Method to delete a row from a table.
@@ -271,18 +507,41 @@ class Database:
 
         except psycopg2.Error as e:
             print(f"\nUnable to delete from the database: {e}")
-            conn.rollback()
+            self.rollback()
     
     '''
-    Disconnect from the database by closing the cursor, committing the connection, and closing the connection.
+    Commit this thread's connection.
+    '''
+    def commit(self):
+        self.conn.commit()
+
+        # The base station rows are committed now, so their ids are safe to share with other transactions
+        pending_dict = self.pending_base_station_dict
+        base_station_cache.update(pending_dict)
+        pending_dict.clear()
+
+        while (len(base_station_cache) > base_station_cache_size):
+            base_station_cache.popitem(last = False)
+
+    '''
+    Roll back this thread's connection. Any base station ids found during the transaction may belong to rows that were just
+    rolled back, so they are forgotten.
+    '''
+    def rollback(self):
+        self.conn.rollback()
+        self.pending_base_station_dict.clear()
+
+    '''
+    Disconnect from the database by closing the cursor, committing the connection, and giving this thread's connection back to
+    the pool (the connection stays open for the next job). Use close_pools() to close every connection.
     '''
     def disconnect(self):
         cursor = self.cursor
-        conn = self.conn
 
         cursor.close()
-        conn.commit()
-        conn.close()
+        self.local.cursor = None
+        self.commit()
+        self.pool.checkin(commit = True)
         print("PostgreSQL connection is closed.")
 
 
@@ -293,94 +552,65 @@ class Database:
     #            or the database.
     #
     #    Methods:
-    #       1. def __init__(self, file_name, topic, keys)
+    #       1. def __init__(self, file_name, topic, keys, metrics = None)
     #           Initialize the file name, topic, and list of keys that you will be using to
-    #           create/alter the data frame.
+    #           create/alter the data frame. If given an IngestMetrics, the base station lookup is
+    #           recorded as the 'base_station' stage of the topic.
     #
     #       2. def bag_to_df(self)
     #           Transform a bag file into a Polars data frame. Go through certain topics and each message
     #           in that topic to get the data that will be added to the data frame.
     #
     #        3. def csv_to_df(self)
-    #           Transform a CSV file into a Pandas and then Polars data frame. Only add certain columns
-    #           from the CSV file to the data frame to match with the SQL table.
+    #           Transform a CSV file (or several CSV files of the same topic) into a Polars data frame. Only
+    #           add certain columns from the CSV file to the data frame to match with the SQL table.
+    #
+    #       4. def scan_csv(self)
+    #           Plan the read of the CSV files as a Polars LazyFrame, with the columns and data types taken
+    #           from the mapping_dict, without reading anything yet.
     # 
-    #       4. def update_df(self, df, table_name, mapping_dict, db_col_lst, bag_files_id, db)
+    #       5. def update_df(self, df, table_name, mapping_dict, db_col_lst, bag_files_id, db, streaming = False)
     #           Edit a data frame to have the same columns, same column data types, and same column names
     #           as the corresponding database table. Information such as bag_files_id and ros_publish_time are
-    #           added here.
+    #           added here. The edit is one LazyFrame plan that is run once (optionally with the streaming
+    #           engine).
+    #
+    #       6. def build_update_plan(self, df, table_name, mapping_dict, db_col_lst, bag_files_id, db)
+    #           Build the LazyFrame plan of update_df: the new columns, the base station join, and one
+    #           projection that renames, casts, and reorders every column.
     #
     # 	Author: Sadie Duncan
     # 	Date:   08/08/2024
     ===============================================================================================
 '''
 class DFBuilder:
-    def __init__(self, file_name, topic, keys):
+    def __init__(self, file_name, topic, keys, metrics = None):
         self.file_name = file_name
         self.topic = topic
         self.keys = keys
+        self.metrics = metrics
     
     '''
     Transform a bag file into a Polars data frame. Go through certain topics and each message in that topic to get the data that will be added to the data frame.
     '''
     def bag_to_df(self):
-        try:
-            bag_file = self.file_name
-            topic = self.topic
-            keys = self.keys
-
-            bag = rosbag.Bag(bag_file)   
-            data = []   # Append rows of data here, then transform this list into a Polars data frame
-
-            # Go through each message for a specific topic, to get a new row of data
-            for _, msg, _ in bag.read_messages(topics = [topic]):
-                row = {}
-                # Go through each key as secs, nsecs, and rosbagTimestamp need to be handled differently
-                for key in keys:
-                    if (key == 'rosbagTimestamp'):
-                        value = msg.header.stamp
-                    elif (key == 'secs'):
-                        value = msg.header.stamp.secs
-                    elif (key == 'nsecs'):
-                        value = msg.header.stamp.nsecs
-                    else:
-                        value = getattr(msg, key, None)
-
-                    # From each key, you'll get a corresponding value (as seen above). Add this as a new entry to the row dictionary.
-                    row[key] = value
-
-                data.append(row)
+        bag_file = self.file_name
+        topic = self.topic
+        keys = self.keys
 
-            # If any data was found, then make a data frame out of this data frame. Otherwise, create an empty data frame.
-            if data:
-                df = pl.DataFrame(data)
-
-            else:
-                df = pl.DataFrame()
-
-        except Exception as e:
-            print(f"Error: {e}")
-            df = pl.DataFrame()
+        # Read just this one topic with the single-pass reader, then take its data frame
+        topic_df_dict = bag_to_dfs(bag_file, {topic : keys})
+        df = topic_df_dict[topic]
 
         return df   # Return the data frame
 
     '''
-    Transform a CSV file into a Pandas and then Polars data frame. Only add certain columns from the CSV file to the data frame to match with the SQL table.
+    Transform a CSV file (or several CSV files of the same topic) into a Polars data frame. Only add certain columns from the CSV file to the data frame to match with the SQL table.
     '''
     def csv_to_df(self):
         try:
-            csv_file = self.file_name
-            keys = self.keys
-
-            # Using Pandas to create a data frame from certain columns from the CSV file
-            df_pandas = pd.read_csv(csv_file, sep = ',', usecols = keys)
-            # print(df_pandas.columns.tolist())   # For simple debugging uses, check if data was added to the data frame
-
-            # Drop any emtpy rows
-            df_pandas = df_pandas.dropna(how = 'all')
-
-            # Convert to Polars to continue handling
-            df = pl.from_pandas(df_pandas)
+            df = self.scan_csv().collect()
+            # print(df.columns)   # For simple debugging uses, check if data was added to the data frame
 
         except Exception as e:
             print(f"Error: {e}")
@@ -388,101 +618,127 @@ class DFBuilder:
 
         return df
 
+    '''
+    Plan the read of the CSV files as a Polars LazyFrame without reading anything yet. self.file_name can be a CSV file, a list of CSV files, or a glob
+    pattern ('folder/*.csv'); several files are parsed in parallel into one data frame. The data type of each column comes from the mapping_dict
+    (see csv_type_dict) rather than being guessed from the data, only the columns in self.keys are parsed, and empty rows are dropped. The plan can
+    be handed straight to update_df, so the CSV files are read and altered in the same pass.
+    '''
+    def scan_csv(self):
+        mapping_dict = get_topics(self.topic)[1]
+        schema = {key : csv_type_dict.get(mapping_dict[key][1], pl.Utf8) for key in self.keys if key in mapping_dict}
+
+        plan = pl.scan_csv(self.file_name, separator = ',', schema_overrides = schema)
+        plan = plan.select(self.keys)
+
+        # Drop any empty rows
+        plan = plan.filter(~pl.all_horizontal(pl.all().is_null()))
+
+        return plan
+
     '''
     Edit a data frame to have the same columns, same column data types, and same column names as the corresponding database table. Information such as bag_files_id
-    and ros_publish_time are added now.
+    and ros_publish_time are added now. The whole edit is one LazyFrame plan (see build_update_plan) that is run once, so the data frame is only
+    copied once no matter how many columns are added, renamed, or cast. df can also be a LazyFrame (such as the plan from scan_csv), which is then
+    read and altered in the same pass. With streaming = True, the plan is run with the streaming engine, which works through the data frame in
+    pieces.
     '''
-    def update_df(self, df, table_name, mapping_dict, db_col_lst, bag_files_id, db):
+    def update_df(self, df, table_name, mapping_dict, db_col_lst, bag_files_id, db, streaming = False):
         try:
-            # Create a new column for the bag_file_id, which should be the same as bags are read one at a time
-            bag_file_column = pl.Series('bag_files_id', [bag_files_id] * df.height, dtype =  pl.Int32)
-            df = df.with_columns(bag_file_column)
-            print("\tNew column for bag_files_id added.")
-
-            # Add a column for ros_publish_time: ros_time = secs + nsecs * 10^-9
-            exp = 10**(-9)
-            ros_time_column = ((pl.col('secs') + (pl.col('nsecs') * exp)).cast(pl.Float32).alias('ros_publish_time'))
-            df = df.with_columns(ros_time_column)
-            print("\tNew column for ros_publish_time added.")
-
-            if (table_name == 'gps_spark_fun_rear_left_gga' or table_name == 'gps_spark_fun_rear_right_gga' or table_name == 'gps_spark_fun_front_gga' or
-                table_name == 'gps_spark_fun_rear_left_gst' or table_name == 'gps_spark_fun_rear_right_gst' or table_name == 'gps_spark_fun_front_gst'):
-                # Add a column for gpstime: gpstime = gpssecs + gpsnsecs * 10^-9
-                gpstime_column = ((pl.col('GPSSecs') + (pl.col('GPSMicroSecs') * exp)).cast(pl.Float32).alias('gpstime'))
-                df = df.with_columns(gpstime_column)
-                print("\tNew column for gpstime added.")
-
-                # GGA sensor has a column for base station - access the database for this to get the id of the base station
-                if (table_name == 'gps_spark_fun_rear_left_gga' or table_name == 'gps_spark_fun_rear_right_gga' or table_name == 'gps_spark_fun_front_gga'):
-                    base_station_id_lst = []
-                    
-                    # Make a list out of all of the values in the 'BaseStationID' column
-                    base_station_column = df.select(pl.col('BaseStationID'))
-                    base_station_lst = base_station_column.to_series().str.strip_chars('"').to_list()
-
-                    # For each base station in this list, find the corresponding id in the database (will insert if not already there),
-                    # then add this to another list of all of the ids
-                    for base_station in base_station_lst:
-                        base_station_id = db.select('base_station_messages', 'id', 'base_station_name', base_station)
-                        base_station_id_lst.append(base_station_id)
-                    
-                    # Add a column to the database of the list of base station ids
-                    base_station_id_column = pl.Series('base_station_messages_id', base_station_id_lst)
-                    df = df.with_columns(base_station_id_column)
-
-                    # Drop the original 'BaseStationID' column from the data frame
-                    df = df.drop('BaseStationID')
-
-                    # Update the mapping_dict by replacing 'BaseStationID' with 'base_station_messages_id', keeping the original value
-                    #   1. Find the key in the mapping_dict corresponding to 'BaseStationID', use this key to get the corresponding value
-                    #   2. Delete the old key and add the new key with the same value
-                    base_station_key = list(mapping_dict.keys())[-1]
-                    base_station_value = mapping_dict[base_station_key]
-
-                    del mapping_dict[base_station_key]
-                    mapping_dict.update({'base_station_messages_id' : base_station_value})
-
-                    print("\tNew column for base_station_ids added.")
-
-            '''
-            # Simple Debugging: Check How Data Frame Has Changed
-            print("Updated Columns")
-            print(df.columns)
-            #print(df.head(2))
-            print(db_col_lst)
-            ''
-            print(len(df.columns))
-            print(len(db_col_lst))
-            '''
-
-            # Ensure uniformity between the data frame columns and the db table columns. Change the names and reorder to match the db table
-            if (len(db_col_lst) == len(df.columns)):
-                # Since the values in the mapping_dict are a list, create a new dictionary made of the same key but with the value being 1
-                # of the items from the original value list
-
-                # Rename the columns
-                name_map = {original_name : new_name[0] for original_name, new_name in mapping_dict.items()}
-                df = df.rename(name_map)
-
-                # Ensure that columns have the same data types
-                type_map = {new_name[0] : new_type for new_name, (new_name, new_type) in mapping_dict.items()}
-                for name, type in type_map.items():
-                    if name in df.columns:
-                        df = df.with_columns([pl.col(name).cast(type)])
-
-                # Reorder the columns to match with the db table layout
-                new_column_order = db_col_lst
-                df = df.select(new_column_order)
-                # print(list(df.columns))   # Simple debugging, check whether columns match
-            
+            plan = self.build_update_plan(df, table_name, mapping_dict, db_col_lst, bag_files_id, db)
+
+            # Run the plan once
+            if streaming:
+                df = plan.collect(engine = 'streaming')
             else:
-                raise Exception("Error, the number of data frame columns is not the same as the number of database table columns.")
+                df = plan.collect()
+            log(self.metrics, f"\tNew columns added, and the columns renamed, cast, and reordered to match '{table_name}'.")
 
             return df
 
         except Exception as e:
             print(f"Error creating data frame: {e}")
 
+    '''
+    Build the edit of update_df as one Polars LazyFrame plan, without running it:
+        1. New columns: bag_files_id (the same for every row, as bags are read one at a time), ros_publish_time = secs + nsecs * 10^-9,
+           and for the GGA and GST sensors, gpstime = gpssecs + gpsmicrosecs * 10^-9.
+        2. GGA sensors: the base station names are joined to their base_station_messages ids, which replace the 'BaseStationID' column.
+           Only the distinct names are read ahead of time, to look up (or insert) their ids. If df is a LazyFrame (such as the plan from
+           scan_csv), it is read once here and the rest of the plan runs on the data frame, so the CSV files aren't read twice.
+        3. One projection renames every column, casts it to the data type in the mapping_dict, and puts the columns in the order of
+           db_col_lst.
+    Returns the LazyFrame.
+    '''
+    def build_update_plan(self, df, table_name, mapping_dict, db_col_lst, bag_files_id, db):
+        plan = df.lazy()
+        exp = 10**(-9)
+
+        # Add a column for bag_files_id and a column for ros_publish_time: ros_time = secs + nsecs * 10^-9
+        new_column_lst = [pl.lit(bag_files_id, dtype = pl.Int32).alias('bag_files_id'),
+                          ((pl.col('secs') + (pl.col('nsecs') * exp)).cast(pl.Float32).alias('ros_publish_time'))]
+
+        if (table_name == 'gps_spark_fun_rear_left_gga' or table_name == 'gps_spark_fun_rear_right_gga' or table_name == 'gps_spark_fun_front_gga' or
+            table_name == 'gps_spark_fun_rear_left_gst' or table_name == 'gps_spark_fun_rear_right_gst' or table_name == 'gps_spark_fun_front_gst'):
+            # Add a column for gpstime: gpstime = gpssecs + gpsnsecs * 10^-9
+            new_column_lst.append((pl.col('GPSSecs') + (pl.col('GPSMicroSecs') * exp)).cast(pl.Float32).alias('gpstime'))
+
+        plan = plan.with_columns(new_column_lst)
+
+        # GGA sensor has a column for base station - access the database for this to get the id of the base station
+        if (table_name == 'gps_spark_fun_rear_left_gga' or table_name == 'gps_spark_fun_rear_right_gga' or table_name == 'gps_spark_fun_front_gga'):
+            # Both the names and the rows are needed, so read the CSV files once rather than once for each
+            if isinstance(df, pl.LazyFrame):
+                plan = plan.collect().lazy()
+
+            # Find the distinct names as they are in the bag file (with quotes), then the id of each one without its quotes (inserting
+            # any new ones) through the process-wide cache. Only the few distinct names have their quotes stripped, not every row.
+            with measure(self.metrics, self.topic, 'base_station') as record:
+                raw_name_lst = plan.select(pl.col('BaseStationID').drop_nulls().unique()).collect().to_series().to_list()
+                base_station_id_dict = get_base_station_ids(db, list({raw_name.strip('"') for raw_name in raw_name_lst}))
+                record.rows = len(raw_name_lst)
+
+            # Join the ids onto the data frame by the names with quotes, keeping the original row order, then drop the original
+            # 'BaseStationID' column
+            base_station_id_df = pl.DataFrame({'BaseStationID': raw_name_lst,
+                                               'base_station_messages_id': [base_station_id_dict.get(raw_name.strip('"')) for raw_name in raw_name_lst]},
+                                              schema = {'BaseStationID': pl.Utf8, 'base_station_messages_id': pl.Int32})
+            plan = plan.join(base_station_id_df.lazy(), on = 'BaseStationID', how = 'left', maintain_order = 'left')
+            plan = plan.drop('BaseStationID')
+
+            # Update the mapping_dict by replacing 'BaseStationID' with 'base_station_messages_id', keeping the original column name
+            #   1. Find the key in the mapping_dict corresponding to 'BaseStationID', use this key to get the corresponding value
+            #   2. Delete the old key and add the new key with the same column name. The ids are integers (int in the
+            #      database), so the data type is changed to Int32
+            base_station_key = list(mapping_dict.keys())[-1]
+            base_station_value = mapping_dict[base_station_key]
+
+            del mapping_dict[base_station_key]
+            mapping_dict.update({'base_station_messages_id' : [base_station_value[0], pl.Int32]})
+
+        # Ensure uniformity between the data frame columns and the db table columns (the schema is known without running the plan)
+        schema = plan.collect_schema()
+        if (len(db_col_lst) != len(schema)):
+            raise Exception("Error, the number of data frame columns is not the same as the number of database table columns.")
+
+        # Rename, cast, and reorder the columns to match the db table layout in one projection. Columns that are not in the
+        # mapping_dict (bag_files_id, ros_publish_time, gpstime) already have their database names and types. Arrays read from a
+        # CSV file are text, which is parsed into a List column rather than cast.
+        source_dict = {new_name : (original_name, new_type) for original_name, (new_name, new_type) in mapping_dict.items()}
+
+        column_lst = []
+        for name in db_col_lst:
+            if name in source_dict:
+                original_name, new_type = source_dict[name]
+                if (new_type == pl.List) and (schema[original_name] == pl.Utf8):
+                    column_lst.append(array_text_to_list(original_name, new_type).alias(name))
+                else:
+                    column_lst.append(pl.col(original_name).cast(new_type).alias(name))
+            else:
+                column_lst.append(pl.col(name))
+
+        return plan.select(column_lst)
+
 
 
 '''
@@ -496,13 +752,21 @@ class DFBuilder:
     #           Helpful for either debugging or for later uses when more tables will be added to
     #           the database.
     #
-    #       2. def db_to_df(to_csv, db, bag_name, bag_id, topic_lst)
+    #       2. def get_base_station_ids(db, base_station_lst)
+    #           Find the base_station_messages id of each base station name. Names that are in the
+    #           process-wide cache are not looked up again, the rest are found (or inserted) in a
+    #           single round trip with db.select_many.
+    #
+    #       3. def db_to_df(to_csv, db, bag_name, bag_id, topic_lst, metrics = None, profiler = None, cache = None)
     #           Given a list of topics and a bag name/id, get the corresponding table names
     #           for each topic, then access the database and create data frames out of the tables.
-    #           If writing to a CSV file, call that function here. Time how long it takes to
-    #           construct the data frame.
+    #           If writing to a CSV file, stream each table into its CSV file a batch at a time.
+    #           Record how long it takes to construct the data frame as the 'select' stage. If given a
+    #           DataFrameCache, tables that haven't changed since they were last read come from the local
+    #           disk instead (see df_cache.py).
     #
-    #       3. def bag_csv_to_df(db, files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv, to_db)
+    #       4. def bag_csv_to_df(db, files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv, to_db, manifest = None, chunk_rows = 0,
+    #                            pipelined = 0, metrics = None, profiler = None, dataset = None, blob_store = None)
     #           Both bag file and csv require the same logic/have the same needs to create data frames and
     #           then both need to be altered, hence why the two are combined.
     #
@@ -514,10 +778,40 @@ class DFBuilder:
     #           Then build the proper data frame. Alter the data frame to add in new columns,
     #           reorder the columns, and change the column names.
     #           
-    #           If writing to a CSV file or the database, call those functions here.
-    #           Time how long it takes to do all of this.
+    #           If writing to a CSV file, the database, or a dataset (a DatasetWriter), call those functions
+    #           here. Record how long each of these stages takes (see ingest_metrics.py), and profile reading the
+    #           bag file and each topic if given an IngestProfiler (see ingest_profiler.py). If given a
+    #           BlobStore, the LiDAR packets are written into it (see lidar_blob_store.py).
+    #
+    #           If given an IngestManifest, topics that are already in the database for this version of the
+    #           bag file are skipped, and each topic is committed on its own along with its manifest row.
+    #
+    #           If chunk_rows is more than 0 or pipelined is 1, a bag file is handed to bag_to_df_chunked instead.
+    #
+    #       5. def get_pending_topics(manifest, bag_file, bag_name, bag_id, topic_lst)
+    #           Hash a bag file and find the topics that aren't in the database yet for this version of it.
+    #
+    #       6. def bag_to_df_chunked(db, bag_file, bag_name, bag_id, topic_lst, to_csv, to_db, chunk_rows, manifest = None,
+    #                                    pipelined = 0, queue_size = 4, metrics = None, profiler = None, dataset = None,
+    #                                    blob_store = None)
+    #           Read a bag file a chunk of chunk_rows messages at a time. Each chunk is altered and written to
+    #           the database and/or appended to its CSV file, so memory use depends on chunk_rows rather than
+    #           on the length of the bag file. With pipelined = 1, decoding, altering, and writing run on
+    #           separate threads joined by bounded queues, so they overlap. Prints each stage's utilization.
     # 
-    #       4. def write_csv(folder, topic, df)
+    #       7. def ingest_bag_worker(bag_file, db_params, topic_lst, to_csv, to_db, incremental = 0, chunk_rows = 0, pipelined = 0,
+    #                                dataset = None, blob_store = None)
+    #           Ingest a single bag file in a worker process, with its own database connection and its own
+    #           bag_files id. Errors are caught and returned so one bag file can't stop the others. The
+    #           stage metrics of the bag file are returned too.
+    #
+    #       8. def ingest_bags_parallel(bag_files, db_params, topic_lst, to_csv, to_db, num_workers, incremental = 0, chunk_rows = 0,
+    #                                   pipelined = 0, metrics = None, dataset = None, blob_store = None)
+    #           Spread many bag files across a pool of worker processes. Print the progress as each bag file
+    #           finishes, then one combined throughput and failure report. The workers' stage metrics are
+    #           added to metrics.
+    #
+    #       9. def write_csv(folder, topic, df)
     #           Write a CSV file for a given topic with a corresponding data frame. Create a new
     #           folder to store each of these CSV files for the same bag file if it doesn't
     #           already exist.
@@ -527,69 +821,147 @@ class DFBuilder:
     ===============================================================================================
 '''
 '''
-Read a bag file to find out all of the topics and subtopics in that bag file.
+Read a bag file to find out all of the topics and subtopics in that bag file. Only the bag file's connection and index
+records are used, so no messages need to be read.
 '''
 def get_bag_file_topics(bag_file, topic_lst):
     # Make both a dictionary to store topics and subtopics and a list to store topics
     topic_key_dict = {}
     all_topics_lst = []
 
-    bag = rosbag.Bag(bag_file)
-    for topic, msg, t in bag.read_messages():
-        if topic not in all_topics_lst:
-            all_topics_lst.append(topic)                         # Adding to the topics list
-
-        if topic in all_topics_lst:
-            if msg.__slots__ not in topic_key_dict.items():
-                topic_key_dict.update({topic : msg.__slots__})   # Adding topics : subtopics to the dictionary
+    # Only the connection and index records are read, the messages themselves are never deserialized
+    topic_info_dict = get_bag_info(bag_file)
+    for topic, topic_info in topic_info_dict.items():
+        all_topics_lst.append(topic)                                  # Adding to the topics list
+        topic_key_dict.update({topic : topic_info['fields']})        # Adding topics : subtopics to the dictionary
 
     # Printing these lists and dictionaries
     print(f"Listing all topics from {bag_file}: \n{all_topics_lst}")
 
     print(f"\nListing all topics and keys from {bag_file}:")
     for topic, keys in topic_key_dict.items():
-        print(f"{topic}: {keys}")
+        topic_info = topic_info_dict[topic]
+        print(f"{topic} ({topic_info['msg_type']}, {topic_info['message_count']} messages over {topic_info['duration_ms']} ms): {keys}")
 
     return topic_key_dict   # Return the dictionary in case there is any useful information
 
 
+'''
+Find the base_station_messages id of each base station name. Names in the process-wide cache (or already found in this
+transaction) are used as is, while all of the other names are found (or inserted) in a single round trip. Newly found ids are
+only added to the process-wide cache once db.commit() is called, because the rows may still be rolled back. The cache keeps the
+most recently used names, evicting the oldest once it holds more than base_station_cache_size names. Returns a dictionary of
+base station name : id.
+'''
+def get_base_station_ids(db, base_station_lst):
+    base_station_id_dict = {}
+
+    for base_station in base_station_lst:
+        if base_station in base_station_cache:
+            base_station_cache.move_to_end(base_station)   # Mark as most recently used
+            base_station_id_dict[base_station] = base_station_cache[base_station]
+
+    # Look up every name that is not already known in one round trip, keeping the ids until the transaction is committed
+    missing_lst = [base_station for base_station in base_station_lst if base_station not in base_station_id_dict]
+    if (len(missing_lst) > 0):
+        pending_dict = db.pending_base_station_dict
+
+        new_lst = [base_station for base_station in missing_lst if base_station not in pending_dict]
+        if (len(new_lst) > 0):
+            pending_dict.update(db.select_many('base_station_messages', 'id', 'base_station_name', new_lst))
+
+        for base_station in missing_lst:
+            if base_station in pending_dict:
+                base_station_id_dict[base_station] = pending_dict[base_station]
+
+    return base_station_id_dict
+
 '''
 Given a list of topics and a bag name/id, get the corresponding table names for each topic, then access the database and
-create data frames out of the tables. If writing to a CSV file, call that function here.
+create data frames out of the tables. If writing to a CSV file, each batch read from the database is appended to the CSV file right
+away, so the whole table never has to be in memory. Reading each table (and writing its CSV file) is recorded in metrics as the
+'select' stage, and profiled as the topic's scope if given an IngestProfiler (profiler).
+
+If given a DataFrameCache (cache), each table is read through the local cache (see df_cache.py): a table that hasn't changed for the
+bag file since it was cached is read from the local disk, otherwise it is read from the database whole and cached. The CSV files are
+then written from the data frame rather than a batch at a time.
 '''
-def db_to_df(to_csv, db, bag_name, bag_id, topic_lst):
+def db_to_df(to_csv, db, bag_name, bag_id, topic_lst, metrics = None, profiler = None, cache = None):
     df_count = 0   # Keep track of the number of data frames created 
 
+    if metrics is not None:
+        metrics.set_bag(bag_name)
+
     for topic in topic_lst:
         topic_start_time = time.time()
                     
-        print("------------------------------------------------------------------------------------------------------------------")
-        print(f"\nStarting on '{topic}':")
+        log(metrics, "------------------------------------------------------------------------------------------------------------------")
+        log(metrics, f"\nStarting on '{topic}':")
 
         # For each topic, create a data frame based off of the bag_file id - will create a data frame of all the data from 
         # the same bag file id
         table_name, mapping_dict, db_col_lst = get_topics(topic)
         col = "bag_files_id"
         val = bag_id
-        df = db.select_multiple(table_name, col, val)
 
-        print(f"\nTotal size of '{table_name}' for the bag file with id = {bag_id}: {df.shape}")
-        print(f"Displaying the first 3 rows of '{table_name}:")
-        print(df.head(3))
-        
         # Write a CSV file
-        if (to_csv == 1):                   
+        if (to_csv == 1):
             folder = bag_name[:-4]         # Getting the folder name by cutting off the '.bag'
-            write_csv(folder, topic, df)   # Calling the write_csv function
+            filename = f"{folder}/{topic.replace('/', '_slash_')}.csv"
+            os.makedirs(folder, exist_ok = True)
+
+            if os.path.exists(filename):   # Make sure the same file hasn't been written already
+                print(f"\n'{filename}' has already been written.")
+            elif cache is not None:
+                # Read the table through the local cache, then write the whole data frame
+                with profile(profiler, topic), measure(metrics, topic, 'select') as record:
+                    df = select_cached(db, table_name, bag_id, cache = cache)
+                    format_array_columns(df).write_csv(filename)
+                    record.rows = df.height
+                    record.bytes = os.path.getsize(filename)
+
+                log(metrics, f"\nTotal number of rows of '{table_name}' for the bag file with id = {bag_id}: {df.height}")
+                log(metrics, f"Displaying the first 3 rows of '{table_name}:")
+                log(metrics, df.head(3))
+                log(metrics, f"\n'{filename}' has been successfully written with {df.height} rows.")
+            else:
+                first_batch_lst = []
+
+                # Each batch is appended to the CSV file as soon as it is read, so the table is never held in memory
+                with profile(profiler, topic), measure(metrics, topic, 'select') as record, open(filename, 'wb') as csv_file:
+                    def write_batch(batch):
+                        format_array_columns(batch).write_csv(csv_file, include_header = (len(first_batch_lst) == 0))
+                        if (len(first_batch_lst) == 0):
+                            first_batch_lst.append(batch.head(3))
+
+                    n_rows = db.select_multiple_batches(table_name, col, val, write_batch)
+                    record.rows = n_rows
+                    record.bytes = csv_file.tell()
+
+                log(metrics, f"\nTotal number of rows of '{table_name}' for the bag file with id = {bag_id}: {n_rows}")
+                if (len(first_batch_lst) > 0):
+                    log(metrics, f"Displaying the first 3 rows of '{table_name}:")
+                    log(metrics, first_batch_lst[0])
+                log(metrics, f"\n'{filename}' has been successfully written with {n_rows} rows.")
+
+        else:
+            with profile(profiler, topic), measure(metrics, topic, 'select') as record:
+                df = select_cached(db, table_name, val, cache = cache)
+                record.rows = df.height
+                record.bytes = df.estimated_size()
+
+            log(metrics, f"\nTotal size of '{table_name}' for the bag file with id = {bag_id}: {df.shape}")
+            log(metrics, f"Displaying the first 3 rows of '{table_name}:")
+            log(metrics, df.head(3))
 
         topic_end_time = time.time()
         topic_total_time = topic_end_time - topic_start_time
-        print(f"\nTime to create a data frame for '{topic} ': {topic_total_time} seconds")
-        print("------------------------------------------------------------------------------------------------------------------")
+        log(metrics, f"\nTime to create a data frame for '{topic} ': {topic_total_time} seconds")
+        log(metrics, "------------------------------------------------------------------------------------------------------------------")
 
         df_count += 1   # Increase the count of the number of data frames created by 1
     
-    print(f"Total number of data frames created: {df_count}")
+    log(metrics, f"Total number of data frames created: {df_count}")
 
 '''
 Both bag file and csv have the same needs to create data frames and then both need to be altered, use the same function for both.
@@ -600,9 +972,37 @@ will come from the given CSV files - create a dictionary matching each CSV file
 Looping through each topic, determine topics and other important information. Then build the proper data frame. Alter the
 data frame to add in new columns, reorder the columns, and change the column names.
 
-If writing to a CSV file or the database, call those functions here.
+If writing to a CSV file or the database, call those functions here. Returns the total number of rows in the updated data frames.
+
+If given an IngestManifest (manifest), reading a bag file is incremental: the bag file's content hash is compared with the
+ingest_manifest table, and only the topics that aren't 'done' for this version of the bag file are read. Before a topic is loaded,
+any of its rows left over from an earlier run are deleted, and once it is loaded, its rows and its manifest row are committed
+together. A topic that fails is rolled back and marked 'failed' so the next run retries it, and the other topics carry on. A topic
+without any messages in the bag file (see get_bag_info) is skipped, and marked 'done' with 0 rows so it isn't retried on every run.
+
+If chunk_rows is more than 0, a bag file is read a chunk at a time with bag_to_df_chunked instead. The same goes for pipelined = 1
+(with whole topics if chunk_rows is 0), so that writing one topic or chunk overlaps with reading the next.
+
+If given an IngestMetrics (metrics), every stage of every topic is recorded: reading the bag file ('open', 'read', and 'decode', see
+bag_reader.py), update_df ('transform', which includes reading the CSV files, and 'base_station' for the GGA topics), df_to_db
+('copy'), and write_csv ('csv_write'). The per-topic prints only show if metrics.verbose is True. If given an IngestProfiler
+(profiler), reading the bag file is profiled as the 'bag_to_df' scope, and the rest of each topic as the topic's scope.
+
+If given a DatasetWriter (dataset), each updated data frame is also written into the Parquet / Arrow IPC dataset, recorded as the
+'dataset_write' stage. If given a BlobStore (blob_store), the packets of the LiDAR packet topics are written into it while the bag
+file is read, and their tables only get the metadata of each scan (see lidar_blob_store.py).
 '''
-def bag_csv_to_df(db, files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv, to_db):
+def bag_csv_to_df(db, files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv, to_db, manifest = None, chunk_rows = 0, pipelined = 0,
+                  metrics = None, profiler = None, dataset = None, blob_store = None):
+    if metrics is not None:
+        metrics.set_bag(bag_name)
+
+    # Topics that don't fit in memory are read, altered, and written a chunk at a time
+    if (from_bag == 1) and ((chunk_rows > 0) or (pipelined == 1)):
+        return bag_to_df_chunked(db, files, bag_name, bag_id, topic_lst, to_csv, to_db,
+                                 chunk_rows if (chunk_rows > 0) else None, manifest, pipelined, metrics = metrics, profiler = profiler,
+                                 dataset = dataset, blob_store = blob_store)
+
     topic_file_dict = {}
 
     # Create a dictionary where the key is the topic and the value is the bag file
@@ -612,18 +1012,53 @@ def bag_csv_to_df(db, files, bag_name, bag_id, topic_lst, from_bag, from_csv, to
             bag_file_name = files
             topic_file_dict.update({topic : bag_file_name})
     
-    # Create a dictionary where the value is the CSV file name and the CSV file name is edited to create a topic key
+    # Create a dictionary where the value is the list of CSV files of a topic. The topic is in the CSV file name from the first '_slash_'
+    # on (turning '_slash_' back into '/'), but split files can have more after it ('_slash_parseEncoder_0001.csv'), so take the
+    # longest topic of topic_lst that the name starts with. CSV files of any other topic are skipped
     elif (from_csv == 1):
+        encoded_topic_lst = sorted(((topic.replace('/', '_slash_'), topic) for topic in topic_lst), key = lambda item: len(item[0]), reverse = True)
+
         for file_name in files:
             path = Path(file_name)
-            topic = path.stem
-            topic = topic.replace('_slash_', '/')   # Basically turning '/' into '_slash_'
-            topic_file_dict.update({topic : file_name})
+            start = path.stem.find('_slash_')
+            name = path.stem[start:] if (start >= 0) else ''
+
+            topic = None
+            for encoded_topic, topic_name in encoded_topic_lst:
+                # The topic has to end at the end of the name or at a separator, so '/parseEncoder' doesn't match '_slash_parseEncoder2'
+                if name.startswith(encoded_topic) and not name[len(encoded_topic):len(encoded_topic) + 1].isalnum():
+                    topic = topic_name
+                    break
+
+            if topic is None:
+                print(f"\nSkipping '{file_name}', it isn't named after any topic in the topic list.")
+                continue
+
+            topic_file_dict.setdefault(topic, []).append(str(path))
     
     else:
         raise Exception("Error: Something wrong with selected files.")
     
     df_count = 0   # Keep track of the number of data frames created
+    row_count = 0  # Keep track of the number of rows in the updated data frames
+    failed_lst = []
+
+    # Only keep the topics that haven't been loaded for this version of the bag file
+    use_manifest = (manifest is not None) and (from_bag == 1) and (to_db == 1)
+    if use_manifest:
+        pending_lst, file_hash, file_size = get_pending_topics(manifest, files, bag_name, bag_id, list(topic_file_dict.keys()))
+        topic_file_dict = {topic : topic_file_dict[topic] for topic in pending_lst}
+        if (len(topic_file_dict) == 0):
+            return row_count
+
+    # For a bag file, read every topic in a single pass through the bag file rather than one pass per topic
+    if (from_bag == 1):
+        topic_key_dict = {topic : list(get_topics(topic)[1].keys()) for topic in topic_file_dict}
+        with profile(profiler, 'bag_to_df'):
+            topic_df_dict = bag_to_dfs(files, topic_key_dict, metrics = metrics, blob_store = blob_store)
+
+        # Topics that aren't in the bag file at all have no entry
+        message_count_dict = {topic : topic_info['message_count'] for topic, topic_info in get_bag_info(files, list(topic_file_dict)).items()}
 
     # Go through each topic one at a time (or each CSV file)
     for topic, file in topic_file_dict.items():
@@ -634,49 +1069,397 @@ def bag_csv_to_df(db, files, bag_name, bag_id, topic_lst, from_bag, from_csv, to
         mapping_dict = {}
         db_col_lst = []
                     
-        print("------------------------------------------------------------------------------------------------------------------")
-        print(f"\nStarting on '{topic}':")
+        log(metrics, "------------------------------------------------------------------------------------------------------------------")
+        log(metrics, f"\nStarting on '{topic}':")
 
         # Determine relevant information based off of the topic
         table_name, mapping_dict, db_col_lst = get_topics(topic)
         key_lst = list(mapping_dict.keys())
 
-        polars = DFBuilder(file_name = file, topic = topic, keys = key_lst)   # Create an instance of the DFBuilder class
+        try:
+            # Mark the topic as running and clear out anything left over from an earlier run
+            if use_manifest:
+                manifest.start_topic(bag_id, topic, table_name, file_hash, file_size)
 
-        # Create the proper data frame
-        if (from_bag == 1):
-            df = polars.bag_to_df()
-            print("\nOriginal data frame created.\n")
-        
-        else:
-            df = polars.csv_to_df()
-            print("\nOriginal data frame created.\n")
+            # A topic without any messages has nothing to load, it is done rather than failed
+            if (from_bag == 1) and (message_count_dict.get(topic, 0) == 0):
+                print(f"\n'{topic}' has no messages in '{bag_name}', skipping it.")
+                if use_manifest:
+                    manifest.finish_topic(bag_id, topic, 0)
+                    db.commit()
+                continue
 
-        # Update the data frame to add new columns, reorder the columns, and change the column names.
-        new_df = polars.update_df(df = df, table_name = table_name,
-                                  mapping_dict = mapping_dict, db_col_lst = db_col_lst,
-                                  bag_files_id = bag_id, db = db)
+            polars = DFBuilder(file_name = file, topic = topic, keys = key_lst, metrics = metrics)   # Create an instance of the DFBuilder class
 
-        print(f"\nTotal size of updated '{topic}' data frame: {new_df.shape}")
-        print(f"Displaying the first 3 rows of updated '{topic}' data frame: ")
-        print(new_df.head(3))
+            # Create the proper data frame
+            if (from_bag == 1):
+                df = topic_df_dict[topic]
+                log(metrics, "\nOriginal data frame created.\n")
 
-        # Write to the database and write CSV files 
-        if (to_db == 1):
-            db.df_to_db(table_name, new_df, db_col_lst)
-        
-        if (to_csv == 1): 
-            folder = bag_name[:-4]
-            write_csv(folder, topic, new_df)
+            else:
+                # Only plan the read, the CSV files are read and altered together by update_df
+                df = polars.scan_csv()
+                log(metrics, f"\nOriginal data frame planned from {len(file)} CSV file(s).\n")
+
+            # Update the data frame to add new columns, reorder the columns, and change the column names.
+            with profile(profiler, topic), measure(metrics, topic, 'transform') as record:
+                new_df = polars.update_df(df = df, table_name = table_name,
+                                          mapping_dict = mapping_dict, db_col_lst = db_col_lst,
+                                          bag_files_id = bag_id, db = db)
+                if new_df is None:
+                    raise Exception(f"Unable to update '{topic}'")
+                record.rows = new_df.height
+                record.bytes = new_df.estimated_size()
+
+            log(metrics, f"\nTotal size of updated '{topic}' data frame: {new_df.shape}")
+            log(metrics, f"Displaying the first 3 rows of updated '{topic}' data frame: ")
+            log(metrics, new_df.head(3))
+
+            # Write to the database and write CSV files
+            if (to_db == 1):
+                with profile(profiler, topic), measure(metrics, topic, 'copy') as record:
+                    inserted = db.df_to_db(table_name, new_df, db_col_lst)
+                    if inserted:
+                        record.rows = new_df.height
+                        record.bytes = new_df.estimated_size()
+                    else:
+                        record.status = 'error'
+                        record.error = f"Unable to write '{table_name}' into the database"
+                if use_manifest and not inserted:
+                    raise Exception(f"Unable to write '{table_name}' into the database")
+
+            if (to_csv == 1):
+                folder = bag_name[:-4]
+                with profile(profiler, topic), measure(metrics, topic, 'csv_write') as record:
+                    write_csv(folder, topic, new_df)
+                    record.rows = new_df.height
+
+            if dataset is not None:
+                with profile(profiler, topic), measure(metrics, topic, 'dataset_write') as record:
+                    record.bytes = dataset.write(bag_name, topic, new_df)
+                    record.rows = new_df.height
+
+            # Commit the topic's rows together with its manifest row
+            if use_manifest:
+                manifest.finish_topic(bag_id, topic, new_df.height)
+                db.commit()
+
+        except Exception as e:
+            if not use_manifest:
+                raise
+
+            # Undo whatever was written for this topic, then record the failure so the next run retries it
+            print(f"\nError: '{topic}' failed: {e}")
+            db.rollback()
+            manifest.fail_topic(bag_id, topic, table_name, f"{e}\n{traceback.format_exc()}")
+            db.commit()
+            failed_lst.append(topic)
+            continue
 
         topic_end_time = time.time()
         topic_total_time = topic_end_time - topic_start_time
-        print(f"\nTime to read/write '{topic} ': {topic_total_time} seconds")
-        print("------------------------------------------------------------------------------------------------------------------")
+        log(metrics, f"\nTime to read/write '{topic} ': {topic_total_time} seconds")
+        log(metrics, "------------------------------------------------------------------------------------------------------------------")
 
         df_count += 1   # Increase the count of the number of data frames created by 1
+        row_count += new_df.height
     
-    print(f"Total number of data frames created: {df_count}")
+    log(metrics, f"Total number of data frames created: {df_count}")
+    if (len(failed_lst) > 0):
+        print(f"Topics that failed and will be retried on the next run: {failed_lst}")
+
+    return row_count
+
+'''
+Hash a bag file and find the topics of topic_lst that aren't in the database yet for this version of the bag file (see
+ingest_manifest.py). Returns the list of topics still to load, the hash, and the size of the bag file.
+'''
+def get_pending_topics(manifest, bag_file, bag_name, bag_id, topic_lst):
+    file_hash, file_size = get_file_hash(bag_file)
+    pending_lst = manifest.get_pending_topics(bag_id, topic_lst, file_hash)
+
+    skipped_count = len(topic_lst) - len(pending_lst)
+    if (skipped_count > 0):
+        print(f"\nSkipping {skipped_count} topics of '{bag_name}' that are already in the database.")
+
+    return pending_lst, file_hash, file_size
+
+'''
+Read a bag file a chunk at a time. iter_bag_batches reads every topic in a single pass and hands over a data frame each time a topic
+has chunk_rows messages (or once per topic if chunk_rows is None). Each chunk is altered with update_df (with its own copy of the mapping_dict, since update_df changes it) and
+then appended to the database table and/or the topic's CSV file, so only about chunk_rows messages per topic are ever in memory.
+Returns the total number of rows written.
+
+The work is split into three stages (see pipeline.py): decode (reading the bag file), transform (update_df), and sink (df_to_db and
+the CSV files). With pipelined = 0, each chunk goes through all three before the next one is read. With pipelined = 1, each stage
+runs on its own thread, joined by queues of at most queue_size chunks, so the COPY of one chunk overlaps with decoding and
+transforming the next ones. Either way, the utilization of each stage is printed at the end to show the bottleneck.
+
+Threads each check out their own connection from the pool. The transform thread commits after each chunk, so any new base
+stations it inserts can be seen by the sink thread's connection. The chunks of every topic are written in the sink's transaction.
+With an IngestManifest, the pending topics are marked as running before the bag file is read and are all committed as done at the
+end. If anything fails, the whole bag file is rolled back and every pending topic is marked as failed, so the next run starts the
+bag file over.
+
+If given an IngestMetrics (metrics), each chunk's 'decode', 'transform', 'copy', and 'csv_write' stages are recorded, and the rows
+written per topic and the pipeline report are only printed if metrics.verbose is True. If given an IngestProfiler (profiler),
+decoding is profiled as the 'bag_to_df' scope and the transform and sink of each chunk as its topic's scope (with pipelined = 0).
+If given a DatasetWriter (dataset), each chunk is also written into the dataset as a file of its own. blob_store is passed on to
+iter_bag_batches.
+'''
+def bag_to_df_chunked(db, bag_file, bag_name, bag_id, topic_lst, to_csv, to_db, chunk_rows, manifest = None, pipelined = 0, queue_size = 4,
+                      metrics = None, profiler = None, dataset = None, blob_store = None):
+    use_manifest = (manifest is not None) and (to_db == 1)
+    if use_manifest:
+        topic_lst, file_hash, file_size = get_pending_topics(manifest, bag_file, bag_name, bag_id, topic_lst)
+        if (len(topic_lst) == 0):
+            return 0
+
+    # The other threads use their own connections, which can only see the bag_files row once it is committed
+    if (pipelined == 1):
+        db.commit()
+
+    # Determine relevant information based off of each topic
+    topic_info_dict = {topic : get_topics(topic) for topic in topic_lst}
+    topic_key_dict = {topic : list(mapping_dict.keys()) for topic, (table_name, mapping_dict, db_col_lst) in topic_info_dict.items()}
+    builder_dict = {topic : DFBuilder(file_name = bag_file, topic = topic, keys = keys, metrics = metrics) for topic, keys in topic_key_dict.items()}
+
+    row_count_dict = {topic : 0 for topic in topic_lst}
+    csv_file_dict = {}   # topic : open CSV file that the chunks are appended to
+
+    # Stage 1 (decode): the non-empty chunks of the bag file
+    def decode_chunks():
+        with profile(profiler, 'bag_to_df'):
+            for topic, df in iter_bag_batches(bag_file, topic_key_dict, chunk_rows, metrics = metrics, blob_store = blob_store):
+                if not df.is_empty():
+                    yield topic, df
+
+    # Stage 2 (transform): update the chunk to add new columns, reorder the columns, and change the column names
+    def transform_chunk(item):
+        topic, df = item
+        table_name, mapping_dict, db_col_lst = topic_info_dict[topic]
+
+        with profile(profiler, topic), measure(metrics, topic, 'transform') as record:
+            new_df = builder_dict[topic].update_df(df = df, table_name = table_name,
+                                                   mapping_dict = dict(mapping_dict), db_col_lst = db_col_lst,
+                                                   bag_files_id = bag_id, db = db)
+            if new_df is None:
+                raise Exception(f"Unable to update a chunk of '{topic}'")
+            record.rows = new_df.height
+            record.bytes = new_df.estimated_size()
+
+        if (pipelined == 1):
+            db.commit()   # Let the sink thread's connection see any new base stations
+
+        return topic, new_df
+
+    def finish_transform(error):
+        if (pipelined == 1):
+            db.disconnect()   # Give this thread's connection back to the pool
+
+    # Stage 3 (sink): append the chunk to the database table and the CSV file
+    def start_sink():
+        if use_manifest:
+            for topic, (table_name, mapping_dict, db_col_lst) in topic_info_dict.items():
+                manifest.start_topic(bag_id, topic, table_name, file_hash, file_size)
+
+        # Open a CSV file for each topic, skipping files that were already written (and LiDAR topics, as in write_csv)
+        if (to_csv == 1):
+            folder = bag_name[:-4]
+            os.makedirs(folder, exist_ok = True)
+
+            for topic in topic_lst:
+                filename = f"{folder}/{topic.replace('/', '_slash_')}.csv"
+                if topic in ['/sick_lms500/scan', '/velodyne_points']:
+                    continue
+                elif os.path.exists(filename):
+                    print(f"\n'{filename}' has already been written.")
+                else:
+                    csv_file_dict[topic] = open(filename, 'wb')
+
+    def sink_chunk(item):
+        topic, new_df = item
+        table_name, mapping_dict, db_col_lst = topic_info_dict[topic]
+
+        if (to_db == 1):
+            with profile(profiler, topic), measure(metrics, topic, 'copy') as record:
+                if not db.df_to_db(table_name, new_df, db_col_lst):
+                    raise Exception(f"Unable to write a chunk of '{topic}' into '{table_name}'")
+                record.rows = new_df.height
+                record.bytes = new_df.estimated_size()
+
+        if topic in csv_file_dict:
+            with profile(profiler, topic), measure(metrics, topic, 'csv_write') as record:
+                csv_file = csv_file_dict[topic]
+                start_position = csv_file.tell()
+                format_array_columns(new_df).write_csv(csv_file, include_header = (row_count_dict[topic] == 0))
+                record.rows = new_df.height
+                record.bytes = csv_file.tell() - start_position
+
+        if dataset is not None:
+            with profile(profiler, topic), measure(metrics, topic, 'dataset_write') as record:
+                record.bytes = dataset.write(bag_name, topic, new_df)
+                record.rows = new_df.height
+
+        row_count_dict[topic] += new_df.height
+        log(metrics, f"\n{new_df.height} rows of '{topic}' written ({row_count_dict[topic]} so far)")
+
+    def finish_sink(error):
+        for csv_file in csv_file_dict.values():
+            csv_file.close()
+
+        if (error is None) and use_manifest:
+            # Every topic is done, commit them together with their manifest rows
+            for topic, row_count in row_count_dict.items():
+                manifest.finish_topic(bag_id, topic, row_count)
+            db.commit()
+
+        elif (error is not None) and use_manifest:
+            # Undo the whole bag file, then record the failure so the next run retries it
+            print(f"\nError: '{bag_name}' failed: {error}")
+            db.rollback()
+            for topic, (table_name, mapping_dict, db_col_lst) in topic_info_dict.items():
+                manifest.fail_topic(bag_id, topic, table_name, f"{error}")
+            db.commit()
+
+        elif (error is not None) and (pipelined == 1):
+            db.rollback()
+
+        if (pipelined == 1):
+            db.disconnect()   # Commit this thread's connection and give it back to the pool
+
+    source = Stage('decode', decode_chunks())
+    stage_lst = [Stage('transform', transform_chunk, on_finish = finish_transform),
+                 Stage('sink', sink_chunk, on_start = start_sink, on_finish = finish_sink)]
+
+    try:
+        stats_lst, total_time = run_pipeline(source, stage_lst, queue_size = queue_size, threaded = (pipelined == 1))
+
+    except Exception as e:
+        if not use_manifest:
+            raise
+        return sum(row_count_dict.values())   # The failure was already recorded in the manifest
+
+    if (metrics is None) or metrics.verbose:
+        print("------------------------------------------------------------------------------------------------------------------")
+        for topic, row_count in row_count_dict.items():
+            print(f"'{topic}': {row_count} rows")
+        print(f"Time to read/write '{bag_name}': {total_time} seconds")
+        print_pipeline_report(stats_lst, total_time)
+
+    return sum(row_count_dict.values())
+
+'''
+Ingest a single bag file in a worker process. Each worker has its own database connection (kept in the worker's pool for its
+next bag file) and finds the bag_files id for its own bag file. Any error is caught and reported back, so one bad bag file
+doesn't stop the others. Returns a dictionary describing how the bag file went (status, rows, bytes, time, error, and the list of
+stage metrics recorded for the bag file, which the parent process adds to its own IngestMetrics).
+
+If incremental is 1, the worker uses the ingest manifest (see bag_csv_to_df), so topics that are already loaded are skipped and
+each topic is committed on its own. Topics that fail are recorded in the manifest and reported as a failure of the bag file.
+
+A BlobStore (blob_store) is sent to the worker without its writer threads, so the worker starts its own and stops them once the bag
+file is done.
+'''
+def ingest_bag_worker(bag_file, db_params, topic_lst, to_csv, to_db, incremental = 0, chunk_rows = 0, pipelined = 0, dataset = None,
+                      blob_store = None):
+    start_time = time.time()
+    result = {'bag_file': bag_file, 'status': 'done', 'rows': 0, 'bytes': 0, 'time': 0, 'error': None, 'metrics': []}
+    db = None
+
+    # Kept in memory and sent back with the result, the parent process writes the files
+    metrics = IngestMetrics(verbose = False)
+
+    try:
+        result['bytes'] = os.path.getsize(bag_file)
+
+        db = Database(**db_params)
+        bag_id = db.select('bag_files', 'id', 'bag_file_name', bag_file)
+        print(f"Now reading '{bag_file}' (id = {bag_id}):")
+
+        manifest = IngestManifest(db) if ((incremental == 1) and (to_db == 1)) else None
+        result['rows'] = bag_csv_to_df(db, bag_file, bag_file, bag_id, topic_lst, 1, 0, to_csv, to_db, manifest, chunk_rows, pipelined,
+                                       metrics = metrics, dataset = dataset, blob_store = blob_store)
+
+        # Topics that failed were already rolled back and recorded, report them as a failure of the bag file
+        if manifest is not None:
+            failed_lst = [topic for topic, entry in manifest.get_topic_dict(bag_id).items()
+                          if (topic in topic_lst) and (entry['status'] != status_done)]
+            if (len(failed_lst) > 0):
+                result['status'] = 'failed'
+                result['error'] = f"Topics that failed: {failed_lst}"
+
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{e}\n{traceback.format_exc()}"
+
+        # Don't commit anything from a bag file that failed part way through
+        if (db is not None) and hasattr(db, 'pool'):
+            db.rollback()
+
+    finally:
+        if (db is not None) and hasattr(db, 'pool'):
+            db.disconnect()
+        if blob_store is not None:
+            blob_store.close()
+
+    result['time'] = time.time() - start_time
+    result['metrics'] = metrics.records
+
+    return result
+
+'''
+Ingest many bag files at once, spreading them across a pool of num_workers worker processes (see ingest_bag_worker). Print the
+progress as each bag file finishes, then one combined report of the throughput and any failures. Returns the list of results.
+
+The worker processes are started with 'spawn' rather than 'fork', so they don't inherit this process's database connection or
+Polars' thread pool. The stage metrics of each bag file are added to metrics (an IngestMetrics) as the bag file finishes.
+'''
+def ingest_bags_parallel(bag_files, db_params, topic_lst, to_csv, to_db, num_workers, incremental = 0, chunk_rows = 0, pipelined = 0,
+                         metrics = None, dataset = None, blob_store = None):
+    start_time = time.time()
+    result_lst = []
+
+    print(f"\nIngesting {len(bag_files)} bag files with {num_workers} worker processes.")
+
+    with ProcessPoolExecutor(max_workers = num_workers, mp_context = multiprocessing.get_context('spawn')) as executor:
+        future_dict = {executor.submit(ingest_bag_worker, bag_file, db_params, topic_lst, to_csv, to_db, incremental, chunk_rows, pipelined, dataset,
+                                       blob_store) : bag_file
+                       for bag_file in bag_files}
+
+        for count, future in enumerate(as_completed(future_dict), start = 1):
+            bag_file = future_dict[future]
+
+            # A worker process that dies (rather than raising an error) only fails its own bag file
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'bag_file': bag_file, 'status': 'failed', 'rows': 0, 'bytes': 0, 'time': 0, 'error': str(e), 'metrics': []}
+
+            if metrics is not None:
+                for record_dict in result['metrics']:
+                    metrics.add_record(record_dict)
+                metrics.write_prometheus()
+
+            result_lst.append(result)
+            print(f"[{count}/{len(bag_files)}] {result['status']}: '{bag_file}' "
+                  f"({result['rows']} rows, {result['bytes'] / 10**6:.1f} MB) in {result['time']:.1f} seconds")
+
+    # Combined report
+    total_time = time.time() - start_time
+    done_lst = [result for result in result_lst if result['status'] == 'done']
+    failed_lst = [result for result in result_lst if result['status'] == 'failed']
+    total_rows = sum(result['rows'] for result in done_lst)
+    total_mb = sum(result['bytes'] for result in done_lst) / 10**6
+
+    print("------------------------------------------------------------------------------------------------------------------")
+    print(f"Bag files ingested: {len(done_lst)} of {len(bag_files)} ({len(failed_lst)} failed) in {total_time:.1f} seconds")
+    print(f"Throughput: {total_rows / total_time:.0f} rows/sec, {total_mb / total_time:.1f} MB/sec ({total_rows} rows, {total_mb:.1f} MB)")
+    for result in failed_lst:
+        print(f"\nFailed: '{result['bag_file']}'\n{result['error']}")
+    print("------------------------------------------------------------------------------------------------------------------")
+
+    return result_lst
 
 '''
 Write a CSV file for a given topic with a corresponding data frame. Create a new folder to store each of these CSV files for the same
@@ -685,8 +1468,8 @@ bag file if it doesn't already exist.
 def write_csv(folder, topic, df):
     os.makedirs(folder, exist_ok = True)   # Make a new folder if one doesn't already exists
 
-    # For handling LiDAR sensors - DO THIS LATER
-    if topic == '/sick_lms500/scan' or topic == '/velodyne_points' or topic == '/velodyne_packets':
+    # For handling LiDAR sensors - DO THIS LATER (the LiDAR packet topics only hold the metadata of each scan, so they are written)
+    if topic == '/sick_lms500/scan' or topic == '/velodyne_points':
                 # filename = f"{folder}/{topic.replace('/', '_slash_')}.txt"
                 filename = 'pass'    
     else:
@@ -698,7 +1481,7 @@ def write_csv(folder, topic, df):
             if df.is_empty():            # If the data frame is empty, there must be an error
                 print(f"\nThe {filename} data frame is empty. csv file was not written.")
             else:
-                pd_df = df.to_pandas()   # Convert the data frame to Pandas to be easier to write
+                pd_df = format_array_columns(df).to_pandas()   # Convert the data frame to Pandas to be easier to write (arrays as '{...}' text)
                 pd_df.to_csv(filename, index = False, header = True)   # Write the CSV file
                 print(f"\n'{filename}.csv' has been successfully written with {df.shape[0]} rows and {df.shape[1]} columns.")
 
@@ -718,17 +1501,20 @@ def write_csv(folder, topic, df):
     #           corresponding bag file name OR id. Establish what both are here - take what you know and
     #           access the database to find the corresponding id or name so that you will have both the name
     #           AND id.
-    #       6.  If you are reading from the database - use the db_to_df function.
+    #       6.  If you are reading from the database - use the db_to_df function (through the local cache, if
+    #           use_cache is 1).
     #               a. If you are writing to a CSV file, write the CSV files.
-    #       7.  If you are reading from a bag file, handle each bag file one at a time, find the
-    #           bag file id from its name, and use bag_csv_to_df
+    #       7.  If you are reading from a bag file, handle each bag file one at a time (or spread them
+    #           across worker processes with ingest_bags_parallel), find the bag file id from its name,
+    #           and use bag_csv_to_df. If incremental, topics already in the database are skipped.
     #               a. If you are writing to a CSV file, write the CSV files.
     #               b. If writing to the database, write to the database while in this function.
     #       8.  If reading from CSV files, recall the corresponding bag file name and id, then use bag_csv_to_df
     #               a. If you are writing to a CSV file, write the CSV files.
     #               b. If writing to the database, write to the database while in this function.
     #       9.  Disconnect from the database.
-    #       10. Calculate the total runtime.
+    #       10. Print the totals of each stage, and write the metrics files (and the profiles, with --profile).
+    #       11. Calculate the total runtime.
     #
     # 	Author: Sadie Duncan
     # 	Date:   08/07/2024
@@ -737,6 +1523,9 @@ def write_csv(folder, topic, df):
 def main():
     start_time = time.time()   # Start timing the runtime
 
+    # Take out the --profile options before the file arguments are checked
+    profile_mode, profile_folder = get_profile_args(sys.argv)
+
     # Determine plans: whether the df is coming from the db, a bag file, or a CSV file and if the df is being written to a CSV file or to the db 
     from_db = 1
     from_bag = 0
@@ -744,9 +1533,51 @@ def main():
     to_csv = 1
     to_db = 0
 
+    # Whether to also write each topic into a columnar dataset (0 if no and 1 if yes), where, and as 'parquet' or 'ipc'
+    to_dataset = 0
+    dataset_folder = 'dataset'
+    dataset_format = 'parquet'
+
+    # Whether to write the LiDAR packets into a content-addressed blob store (0 if no and 1 if yes), where, and with how many
+    # writer threads. The tables of the LiDAR packet topics then only hold the metadata of each scan (see lidar_blob_store.py).
+    to_blob_store = 0
+    blob_folder = 'lidar_blobs'
+    blob_workers = 4
+
+    # Whether to keep the tables read from the database in a local cache (0 if no and 1 if yes), where, and its size in megabytes.
+    # Tables are read again from the database once they change (see df_cache.py).
+    use_cache = 0
+    cache_folder = default_cache_folder   # ~/.cache/ivsg_db_to_df
+    cache_mb = 4096
+
+    # Whether to ingest the bag files in parallel (0 if no and 1 if yes), and how many worker processes to use
+    parallel = 0
+    num_workers = os.cpu_count()
+
+    # Whether to skip the topics of bag files that are already in the database (0 if no and 1 if yes). Topics that failed or
+    # never finished, and bag files that changed, are loaded again (see ingest_manifest.py).
+    incremental = 1
+
+    # Number of messages per chunk when reading a bag file (0 to read each topic whole). Use chunks for topics that don't fit
+    # in memory, such as /sick_lms_5xx/scan and the LiDAR packet topics, so memory use depends on the chunk size.
+    chunk_rows = 0
+
+    # Whether to decode, alter, and write each bag file on separate threads that overlap (0 if no and 1 if yes)
+    pipelined = 0
+
+    # Where to record the duration, rows, bytes, and peak memory of every stage (see ingest_metrics.py): a JSON-lines file, and a
+    # Prometheus textfile-collector file for node_exporter (None to skip either). With verbose = 0, only a summary is printed.
+    metrics_file = 'ingest_metrics.jsonl'
+    prometheus_file = None   # For example, '/var/lib/node_exporter/textfile_collector/ivsg_ingest.prom'
+    verbose = 0
+
     # Declare and initialize multiple variables
     bag_files = []
     csv_files = []
+    folder = None   # The folder given as the argument, if any
+
+    # For testing, only this bag file is read (None to read every bag file). Every bag file in a folder given as the argument is read
+    test_bag_file = 'mapping_van_2024-06-20-15-25-21_0.bag'
 
     # Most important topics currently: encoder, trigger, and GPS SparkFun sensors
     # Still to incorporate: velodyne and sick LiDAR
@@ -773,21 +1604,33 @@ def main():
         file = [sys.argv[1]]
         file_type = file[0][-4:]
 
+        # Gave a folder: read every '.bag' or '.csv' file in it and in its sub-folders (such as a folder of CSV files per bag file)
+        if os.path.isdir(file[0]):
+            folder = file[0]
+            test_bag_file = None
+            if (from_bag == 1):
+                bag_files = sorted(os.path.join(root, f) for root, dirs, files in os.walk(folder) for f in files if f[-4:] == ".bag" and len(f) != 4)
+                print(f"Reading {len(bag_files)} bag files in '{folder}'.")
+            elif (from_csv == 1):
+                csv_files = sorted(os.path.join(root, f) for root, dirs, files in os.walk(folder) for f in files if f[-4:] == ".csv")
+                print(f"Reading {len(csv_files)} CSV files in '{folder}'.")
+
         # Check that you were not given the wrong type of file (ie. '.txt')
-        if file[0] in os.listdir("."):
+        elif file[0] in os.listdir("."):
             if (file_type == ".bag"):
-                bag_files = [file]   # Using this file as the bag file to read
+                bag_files = file   # Using this file as the bag file to read
             elif (file_type == ".csv"):
-                csv_files = [file]   # Using this file as the CSV file to read
+                csv_files = file   # Using this file as the CSV file to read
             else:
                 # If else, you gave the wrong type of file, exit the program
                 print(f"Not a valid file type: {sys.argv}")
                 sys.exit(1)
+
+            print(f"Reading 1 file: {file[0]}")
+
         else:
             print(f"File does not exist: {sys.argv}")
             sys.exit(1)
-
-        print(f"Reading 1 file: {file[0]}")
         
     elif (len(sys.argv) == 1):
         # Check the directory to see what '.bag' or '.csv' files there are to read - store these in a list
@@ -820,10 +1663,22 @@ def main():
     port     = "5432"
     db_name  = "testdb"
 
+    metrics = IngestMetrics(jsonl_file = metrics_file, prometheus_file = prometheus_file, verbose = (verbose == 1))
+    profiler = IngestProfiler(profile_folder, profile_mode) if (profile_mode is not None) else None
+    dataset = DatasetWriter(dataset_folder, dataset_format) if (to_dataset == 1) else None
+    blob_store = BlobStore(blob_folder, blob_workers) if (to_blob_store == 1) else None
+
+    # The LiDAR packet topics can only be loaded into a blob store, so leave them out without one
+    if (blob_store is None) and (from_bag == 1):
+        topic_lst = drop_packet_topics(topic_lst)
+
     # Connecting to the database
     if db_name is not None:
         db = Database(username, password, server, port, db_name)
 
+    # The worker processes each open their own connection with the same parameters
+    db_params = {'username': username, 'password': password, 'server': server, 'port': port, 'db_name': db_name}
+
     '''
     If you're reading from the database or from CSV files, you need to know either the corresponding bag file name OR id.
     Take what you know and access the database to find the corresponding id or name so that you will have both the name AND id.
@@ -850,30 +1705,67 @@ def main():
     # Read from the database 
     if (from_db == 1):
         print(f"Now reading '{bag_file_name}' (id = {bag_file_id}):")
-        db_to_df(to_csv, db, bag_file_name, bag_file_id, topic_lst)   # Create a data frame
+        cache = DataFrameCache(cache_folder, cache_mb) if (use_cache == 1) else None
+        db_to_df(to_csv, db, bag_file_name, bag_file_id, topic_lst, metrics, profiler, cache)   # Create a data frame
 
     # Read from either a bag file or CSV file
     elif ((from_bag == 1) or (from_csv == 1)):
-        if (from_bag == 1):
+        if (from_bag == 1) and (parallel == 1):
+            # Spread the bag files across a pool of worker processes, each finding its own bag file id
+            if profiler is not None:
+                print("The worker processes are not profiled, use parallel = 0 to profile the ingest.")
+            ingest_bags_parallel(bag_files, db_params, topic_lst, to_csv, to_db, num_workers, incremental, chunk_rows, pipelined, metrics,
+                                 dataset, blob_store)
+
+        elif (from_bag == 1):
+            # Keep track of which topics of which bag files are already in the database
+            manifest = IngestManifest(db) if ((incremental == 1) and (to_db == 1)) else None
+
             # If you are reading from a bag file, handle each bag file one at a time, find the bag file id from its name
             for bag_file in bag_files:
                 bag_name = bag_file
                 bag_id = db.select('bag_files', 'id', 'bag_file_name', bag_file)
                 # print(f"Now reading '{bag_file}', which has an ID of {bag_id}:")
                 # bag_csv_to_df(db, bag_file, from_bag, from_csv, topic_lst, to_csv, to_db)                          # Create a data frame
-                if (bag_file == 'mapping_van_2024-06-20-15-25-21_0.bag'):   # For testing
+                if (test_bag_file is None) or (os.path.basename(bag_file) == test_bag_file):   # For testing
                     print(f"Now reading '{bag_name}' (id = {bag_id}):")
-                    bag_csv_to_df(db, bag_file, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv, to_db)      # Create a data frame
+                    bag_csv_to_df(db, bag_file, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv, to_db, manifest, chunk_rows, pipelined,
+                                  metrics, profiler, dataset, blob_store)   # Create a data frame
+                    metrics.write_prometheus()
 
         else:
-            # If reading from CSV files, recall the corresponding bag file name and id, then use bag_csv_to_df
-            print(f"For {bag_file_name} (id = {bag_file_id}):")
-            bag_csv_to_df(db, csv_files, bag_file_name, bag_file_id, topic_lst, from_bag, from_csv, to_csv, to_db)   # Create a data frame
+            # If reading from CSV files, recall the corresponding bag file name and id, then use bag_csv_to_df. The CSV files of each
+            # sub-folder of the folder given are read as the bag file the sub-folder is named after (see write_csv)
+            csv_folder_dict = {}
+            for csv_file in csv_files:
+                csv_folder_dict.setdefault(os.path.dirname(csv_file), []).append(csv_file)
+
+            for csv_folder, folder_csv_files in csv_folder_dict.items():
+                if (folder is not None) and (os.path.normpath(csv_folder) != os.path.normpath(folder)):
+                    csv_bag_name = f"{os.path.basename(csv_folder)}.bag"
+                    csv_bag_id = db.select(table, 'id', 'bag_file_name', csv_bag_name)
+                else:
+                    csv_bag_name = bag_file_name
+                    csv_bag_id = bag_file_id
+
+                print(f"For {csv_bag_name} (id = {csv_bag_id}):")
+                bag_csv_to_df(db, folder_csv_files, csv_bag_name, csv_bag_id, topic_lst, from_bag, from_csv, to_csv, to_db, metrics = metrics,
+                              profiler = profiler, dataset = dataset)   # Create a data frame
 
     else:
         print("\nError: Not given any instructions to execute.")
 
     db.disconnect()                                   # Disconnect from the database
+    close_pools()                                     # Close the pooled connections
+
+    if blob_store is not None:
+        blob_store.close()                            # Wait for the last LiDAR blobs to be written
+
+    metrics.print_summary()                           # Print the totals of each stage
+    metrics.close()                                   # Write the Prometheus file and close the metrics file
+
+    if profiler is not None:
+        profiler.close()                              # Write the profile of each scope
     
     end_time = time.time()
     total_time = end_time - start_time
@@ -21,11 +21,20 @@ Purpose: The purpose of this script is to utilize the Polars and Pandas library
             2. csv -> df    (DONE)
             ----------------------
             3. df  -> csv   (DONE)
+            4. df  -> Parquet / Arrow IPC dataset   (DONE)
 
-Usage:  python(3) parse_and_insert.py
+Usage:  python(3) parse_and_insert_no_db.py [<>.bag or <>.csv] [--profile[=cprofile or sample]] [--profile-dir=<folder>]
     - Use with get_topics.py and raw_data_db_launch.sql
     - Need to know before using:
         - from_bag, from_csv, to_csv: 0 if no and 1 if yes
+        - to_dataset: 1 to also write each topic into a Parquet (or Arrow IPC, with dataset_format = 'ipc') dataset in
+          dataset_folder, partitioned by bag file and topic (see columnar_sink.py)
+        - to_blob_store: 1 to write the packets of the LiDAR packet topics (/velodyne_packets, /ouster_packets) into the
+          content-addressed blob store in blob_folder, so their data frames only hold the metadata of each scan (see
+          lidar_blob_store.py)
+        - --profile: run under cProfile (or the sampling profiler with --profile=sample) and tracemalloc, writing a .pstats,
+          a collapsed-stack (flame graph), and an allocation site file for 'bag_to_df' and for each topic into
+          --profile-dir (see ingest_profiler.py)
         - topic_lst: ['/GPS_SparkFun_Front_GGA', '/GPS_SparkFun_Front_VTG', 
                       '/GPS_SparkFun_RearLeft_GGA', '/GPS_SparkFun_RearLeft_GST', '/GPS_SparkFun_RearLeft_VTG',
                       '/GPS_SparkFun_RearRight_GGA', '/GPS_SparkFun_RearRight_GST', '/GPS_SparkFun_RearRight_VTG',
@@ -65,7 +74,12 @@ import numpy as np
 import hashlib
 
 # Keep track of the differences between the ROS topics and database table topics
-from get_topics import get_topics  
+from get_topics import get_topics
+from bag_reader import bag_to_dfs, get_bag_info
+from ingest_profiler import IngestProfiler, get_profile_args, profile
+from columnar_sink import DatasetWriter
+from lidar_blob_store import BlobStore, drop_packet_topics
+from pg_copy import array_text_to_list, format_array_columns
 from parseCamera import parseCamera                         
 
 # Using Pandas yielded an error -> ignore this error
@@ -111,44 +125,14 @@ class DFBuilder:
     Transform a bag file into a Polars data frame. Go through certain topics and each message in that topic to get the data that will be added to the data frame.
     '''
     def bag_to_df(self):
-        try:
-            bag_file = self.file_name
-            topic = self.topic
-            keys = self.keys
-            
-            bag = rosbag.Bag(bag_file)
-            data = []   # Append rows of data here, then transform this list into a Polars data frame
-
-            # Go through each message for a specific topic, to get a new row of data
-            for topic, msg, t in bag.read_messages(topics = [topic]):
-                row = {}
-                # Go through each key as secs, nsecs, and rosbagTimestamp need to be handled differently
-                for key in keys:
-                    if (key == 'rosbagTimestamp'):
-                        value = msg.header.stamp
-                    elif (key == 'secs'):
-                        value = msg.header.stamp.secs
-                    elif (key == 'nsecs'):
-                        value = msg.header.stamp.nsecs
-                    else:
-                        value = getattr(msg, key, None)
-
-                    # From each key, you'll get a corresponding value (as seen above). Add this as a new entry to the row dictionary.
-                    row[key] = value
-
-                data.append(row)
-
-            # If any data was found, then make a data frame out of this data frame. Otherwise, create an empty data frame.
-            if (len(data) > 0):
-                df = pl.DataFrame(data)
+        bag_file = self.file_name
+        topic = self.topic
+        keys = self.keys
 
-            else:
-                df = pl.DataFrame()
+        # Read just this one topic with the single-pass reader, then take its data frame
+        topic_df_dict = bag_to_dfs(bag_file, {topic : keys})
+        df = topic_df_dict[topic]
 
-        except Exception as e:
-            print(f"Error: {e}")
-            df = pl.DataFrame()
-        
         return df   # Return the data frame
 
     '''
@@ -254,11 +238,14 @@ class DFBuilder:
                 name_map = {original_name : new_name[0] for original_name, new_name in mapping_dict.items()}
                 df = df.rename(name_map)
 
-                # Ensure that columns have the same data types
+                # Ensure that columns have the same data types. Arrays read from a CSV file are text, which is parsed rather than cast
                 type_map = {new_name[0] : new_type for new_name, (new_name, new_type) in mapping_dict.items()}
                 for name, type in type_map.items():
                     if name in df.columns:
-                        df = df.with_columns([pl.col(name).cast(type)])
+                        if (type == pl.List) and (df.schema[name] == pl.Utf8):
+                            df = df.with_columns([array_text_to_list(name, type)])
+                        else:
+                            df = df.with_columns([pl.col(name).cast(type)])
 
                 # Reorder the columns to match with the db table layout
                 new_column_order = db_col_lst
@@ -286,7 +273,8 @@ class DFBuilder:
     #           Helpful for either debugging or for later uses when more tables will be added to
     #           the database.
     #
-    #       2. def bag_csv_to_df(files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv)
+    #       2. def bag_csv_to_df(files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv, profiler = None, dataset = None,
+    #                            blob_store = None)
     #           Both bag file and csv require the same logic/have the same needs to create data frames and
     #           then both need to be altered, hence why the two are combined.
     #
@@ -311,28 +299,27 @@ class DFBuilder:
     ===============================================================================================
 '''
 '''
-Read a bag file to find out all of the topics and subtopics in that bag file.
+Read a bag file to find out all of the topics and subtopics in that bag file. Only the bag file's connection and index
+records are used, so no messages need to be read.
 '''
 def get_bag_file_topics(bag_file, topic_lst):
     # Make both a dictionary to store topics and subtopics and a list to store topics
     topic_key_dict = {}
     all_topics_lst = []
 
-    bag = rosbag.Bag(bag_file)
-    for topic, msg, t in bag.read_messages():
-        if topic not in all_topics_lst:
-            all_topics_lst.append(topic)                         # Adding to the topics list
-
-        if topic in all_topics_lst:
-            if msg.__slots__ not in topic_key_dict.items():
-                topic_key_dict.update({topic : msg.__slots__})   # Adding topics : subtopics to the dictionary
+    # Only the connection and index records are read, the messages themselves are never deserialized
+    topic_info_dict = get_bag_info(bag_file)
+    for topic, topic_info in topic_info_dict.items():
+        all_topics_lst.append(topic)                                  # Adding to the topics list
+        topic_key_dict.update({topic : topic_info['fields']})        # Adding topics : subtopics to the dictionary
 
     # Printing these lists and dictionaries
     print(f"\nListing all topics from {bag_file}: \n{all_topics_lst}")
 
     print(f"\nListing all topics and keys from {bag_file}:")
     for topic, keys in topic_key_dict.items():
-        print(f"{topic}: {keys}")
+        topic_info = topic_info_dict[topic]
+        print(f"{topic} ({topic_info['msg_type']}, {topic_info['message_count']} messages over {topic_info['duration_ms']} ms): {keys}")
 
     return topic_key_dict   # Return the dictionary in case there is any useful information
 
@@ -349,10 +336,8 @@ def parse_camera_bags(cam_files):
             print(f"This folder already exists: {folder}")
             pass
 
-        topic_lst = []
-        for topic, msg, t in bag.read_messages():
-            if topic not in topic_lst:
-                topic_lst.append(topic)                         # Adding to the topics list
+        # Get the list of topics from the bag file's connection records rather than reading every message
+        topic_lst = list(get_bag_info(bag).keys())
         
         print(f"\nFor {file}, the following {len(topic_lst)} will be parsed: {topic_lst}")
 
@@ -373,9 +358,12 @@ will come from the given CSV files - create a dictionary matching each CSV file
 Looping through each topic, determine topics and other important information. Then build the proper data frame. Alter the
 data frame to add in new columns, reorder the columns, and change the column names.
 
-If writing to a CSV file, call those functions here.
+If writing to a CSV file, call those functions here. If given an IngestProfiler (profiler), reading the bag file is profiled as the
+'bag_to_df' scope, and the rest of each topic as the topic's scope. If given a DatasetWriter (dataset), each updated data frame is
+also written into the Parquet / Arrow IPC dataset. If given a BlobStore (blob_store), the packets of the LiDAR packet topics are
+written into it while the bag file is read (see lidar_blob_store.py).
 '''
-def bag_csv_to_df(files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv):
+def bag_csv_to_df(files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv, profiler = None, dataset = None, blob_store = None):
     topic_file_dict = {}
 
     # Create a dictionary where the key is the topic and the value is the bag file
@@ -398,6 +386,12 @@ def bag_csv_to_df(files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv
     
     df_count = 0   # Keep track of the number of data frames created
 
+    # For a bag file, read every topic in a single pass through the bag file rather than one pass per topic
+    if (from_bag == 1):
+        topic_key_dict = {topic : list(get_topics(topic)[1].keys()) for topic in topic_file_dict}
+        with profile(profiler, 'bag_to_df'):
+            topic_df_dict = bag_to_dfs(files, topic_key_dict, blob_store = blob_store)
+
     # Go through each topic one at a time (or each CSV file)
     for topic, file in topic_file_dict.items():
         topic_start_time = time.time()
@@ -418,16 +412,18 @@ def bag_csv_to_df(files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv
 
         # Create the proper data frame
         if (from_bag == 1):
-            df = polars.bag_to_df()
+            df = topic_df_dict[topic]
             print("\nOriginal data frame created.\n")
         
         else:
-            df = polars.csv_to_df()
+            with profile(profiler, topic):
+                df = polars.csv_to_df()
             print("\nOriginal data frame created.\n")
         
 
         # Update the data frame to add new columns, reorder the columns, and change the column names.
-        new_df = polars.update_df(df, table_name, mapping_dict, db_col_lst, bag_id)
+        with profile(profiler, topic):
+            new_df = polars.update_df(df, table_name, mapping_dict, db_col_lst, bag_id)
 
         print(f"\nTotal size of updated '{topic}' data frame: {new_df.shape}")
         print(f"Displaying the first 3 rows of updated '{topic}' data frame: ")
@@ -435,7 +431,12 @@ def bag_csv_to_df(files, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv
         
         if (to_csv == 1): 
             folder = bag_name[:-4]
-            write_csv(folder, topic, new_df)
+            with profile(profiler, topic):
+                write_csv(folder, topic, new_df)
+
+        if dataset is not None:
+            with profile(profiler, topic):
+                dataset.write(bag_name, topic, new_df)
 
         topic_end_time = time.time()
         topic_total_time = topic_end_time - topic_start_time
@@ -453,8 +454,8 @@ bag file if it doesn't already exist.
 def write_csv(folder, topic, df):
     os.makedirs(folder, exist_ok = True)   # Make a new folder if one doesn't already exists
 
-    # For handling LiDAR sensors - DO THIS LATER
-    if topic == '/sick_lms500/scan' or topic == '/velodyne_points' or topic == '/velodyne_packets':
+    # For handling LiDAR sensors - DO THIS LATER (the LiDAR packet topics only hold the metadata of each scan, so they are written)
+    if topic == '/sick_lms500/scan' or topic == '/velodyne_points':
                 # filename = f"{folder}/{topic.replace('/', '_slash_')}.txt"
                 filename = 'pass'    
     else:
@@ -466,7 +467,7 @@ def write_csv(folder, topic, df):
             if df.is_empty():            # If the data frame is empty, there must be an error
                 print(f"\nThe {filename} data frame is empty. csv file was not written.")
             else:
-                pd_df = df.to_pandas()   # Convert the data frame to Pandas to be easier to write
+                pd_df = format_array_columns(df).to_pandas()   # Convert the data frame to Pandas to be easier to write (arrays as '{...}' text)
                 pd_df.to_csv(filename, index = False, header = True)   # Write the CSV file
                 print(f"\n'{filename}' has been successfully written with {df.shape[0]} rows and {df.shape[1]} columns.")
 
@@ -488,7 +489,8 @@ def write_csv(folder, topic, df):
     #               a. If you are writing to a CSV file, write the CSV files.
     #       7. If reading from CSV files, recall the corresponding bag file name and id, then use bag_csv_to_df
     #               a. If you are writing to a CSV file, write the CSV files.
-    #       8. Calculate the total runtime.
+    #       8. Write the profiles (with --profile).
+    #       9. Calculate the total runtime.
     #
     # 	Author: Sadie Duncan
     # 	Date:   08/07/2024
@@ -497,12 +499,29 @@ def write_csv(folder, topic, df):
 def main():
     start_time = time.time()   # Start timing the runtime
 
+    # Take out the --profile options before the file arguments are checked
+    profile_mode, profile_folder = get_profile_args(sys.argv)
+    profiler = IngestProfiler(profile_folder, profile_mode) if (profile_mode is not None) else None
+
     # Determine plans: whether the df is coming from a bag file, or a CSV file and if the df is being written to a CSV file 
     cam_flag = 1
     from_bag = 0
     from_csv = 0
     to_csv = 0
 
+    # Whether to also write each topic into a columnar dataset (0 if no and 1 if yes), where, and as 'parquet' or 'ipc'
+    to_dataset = 0
+    dataset_folder = 'dataset'
+    dataset_format = 'parquet'
+    dataset = DatasetWriter(dataset_folder, dataset_format) if (to_dataset == 1) else None
+
+    # Whether to write the LiDAR packets into a content-addressed blob store (0 if no and 1 if yes), where, and with how many
+    # writer threads (see lidar_blob_store.py)
+    to_blob_store = 0
+    blob_folder = 'lidar_blobs'
+    blob_workers = 4
+    blob_store = BlobStore(blob_folder, blob_workers) if (to_blob_store == 1) else None
+
     # Declare and initialize multiple variables
     bag_files = []
     csv_files = []
@@ -515,6 +534,10 @@ def main():
                  '/GPS_SparkFun_RearRight_GGA', '/GPS_SparkFun_RearRight_GST', '/GPS_SparkFun_RearRight_VTG',
                  '/parseEncoder', '/parseTrigger']
 
+    # The LiDAR packet topics can only be loaded into a blob store, so leave them out without one
+    if (blob_store is None) and (from_bag == 1):
+        topic_lst = drop_packet_topics(topic_lst)
+
     # Check system arguments
     if (len(sys.argv) > 2):
         # Too many arguments given, stop the program
@@ -601,7 +624,7 @@ def main():
         for bag_file in bag_files:
             bag_name = bag_file
             print(f"\nNow reading '{bag_name}' (id = {bag_id}). The following {len(topic_lst)} topics will be parsed: \n{topic_lst}:")
-            bag_csv_to_df(bag_file, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv)              # Create a data frame
+            bag_csv_to_df(bag_file, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv, profiler, dataset, blob_store)    # Create a data frame
             '''if (bag_file == 'mapping_van_2024-06-24-02-18-35_0.bag'):   # For testing
                 print(f"\nNow reading '{bag_name}' (id = {bag_id}). The following {len(topic_lst)} topics will be parsed: \n{topic_lst}:")
                 # bag_csv_to_df(bag_file, bag_name, bag_id, topic_lst, from_bag, from_csv, to_csv)      # Create a data frame'''
@@ -614,11 +637,17 @@ def main():
 
         # If reading from CSV files, recall the corresponding bag file name and id, then use bag_csv_to_df
         print(f"\nFor {bag_file_name} (id = {bag_file_id}):")
-        bag_csv_to_df(csv_files, bag_file_name, bag_file_id, topic_lst, from_bag, from_csv, to_csv)   # Create a data frame
+        bag_csv_to_df(csv_files, bag_file_name, bag_file_id, topic_lst, from_bag, from_csv, to_csv, profiler, dataset)   # Create a data frame
 
     else:
         print("\nError: Not given any instructions to execute.")
 
+    if blob_store is not None:
+        blob_store.close()   # Wait for the last LiDAR blobs to be written
+
+    if profiler is not None:
+        profiler.close()   # Write the profile of each scope
+
     end_time = time.time()
     total_time = end_time - start_time
     print(f"\nTotal Runtime: {total_time} seconds")   # Calculate the total runtime
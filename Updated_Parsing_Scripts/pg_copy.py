@@ -0,0 +1,539 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script encodes Polars data frames into the PostgreSQL binary COPY format, so that Database.df_to_db in
+    parse_and_insert.py can send typed values straight to the database. With COPY ... CSV, every float is formatted into
+    text by Python and then parsed back again by PostgreSQL, which is the main cost of the GPS and encoder loads and also
+    rounds the values. In the binary format, a real is just its 4 bytes (big-endian).
+
+    Array columns (real[] and float[], such as the ranges and intensities of /sick_lms_5xx/scan) are Polars List columns.
+    In the binary format, an array is a small header (number of dimensions, whether it has NULLs, the element type OID,
+    and the size and lower bound of its one dimension) followed by an int32 length and the value of each element. The
+    arrays are encoded from the flat NumPy array of every element at once, never one scan at a time in Python.
+
+    Binary COPY format (https://www.postgresql.org/docs/current/sql-copy.html):
+        Header:  'PGCOPY\n\377\r\n\0' + int32 flags (0) + int32 header extension length (0)
+        Rows:    int16 number of fields, then for each field an int32 length (-1 for NULL) followed by the value
+        Trailer: int16 -1
+
+    This script also lets a COPY be streamed, so the whole table never has to be encoded in memory at once. The data frame
+    (or an iterator of record batches) is split into batches that fit in a given number of megabytes, and a file-like
+    object (CopyStream) encodes the next batch only when copy_expert asks for more data.
+
+    For reading, COPY (SELECT ...) TO STDOUT writes CSV text into a CopyOutParser, which parses it straight into Polars
+    data frames a batch at a time (no Python tuples or Pandas data frames in between). Arrays come out as '{1.5,2,NaN}'
+    text, which is split and cast by Polars (array_text_to_list) rather than in Python.
+
+Usage:
+    Use with the parse_and_insert.py script.
+        if can_encode_binary(df):
+            buffer = BytesIO(encode_binary_copy(df))
+            cursor.copy_expert(sql = "COPY table_name (cols) FROM STDIN WITH (FORMAT binary)", file = buffer)
+
+        Streaming, with at most ~64 MB of encoded data in memory:
+            stream = CopyStream(iter_binary_copy(iter_batches(df, max_buffer_mb = 64)))
+            cursor.copy_expert(sql = "COPY table_name (cols) FROM STDIN WITH (FORMAT binary)", file = stream, size = copy_read_size)
+
+        Reading, handing each parsed batch to a function:
+            parser = CopyOutParser(get_polars_schema(cursor.description), batch_function)
+            cursor.copy_expert(sql = "COPY (SELECT ...) TO STDOUT WITH CSV", file = parser, size = copy_read_size)
+            parser.close()
+
+    The data frame column types have to match the database column types exactly (the get_topics mapping_dict already
+    does this: int = pl.Int32, bigint = pl.Int64, real = pl.Float32, float = pl.Float64, char/varchar/text = pl.Utf8,
+    real[] = pl.List(pl.Float32), float[] = pl.List(pl.Float64)).
+
+Method(s):
+    1. can_encode_binary(df)
+        Check whether every column of the data frame has a type that can be written in the binary format.
+
+    2. get_array_size(series)
+        Get the number of elements of every array in a List column, or None if they don't all have the same number (or
+        there are NULLs).
+
+    3. get_array_dtype(inner_type, size)
+        The structured NumPy data type of a binary array with size elements.
+
+    4. encode_array_column(series)
+        Encode a List column into the binary array format, returning the length and the bytes of every field.
+
+    5. encode_binary_rows(df)
+        Encode the rows of a data frame (without the header or trailer) into bytes. Uses NumPy for every column, so there is
+        no Python work per row.
+
+    6. encode_binary_copy(df)
+        Encode a whole data frame, including the header and trailer.
+
+    7. iter_batches(data, max_buffer_mb)
+        Split a data frame, or an iterator of data frames / Arrow record batches, into data frames small enough that one
+        encoded batch stays under max_buffer_mb megabytes.
+
+    8. format_array_columns(df)
+        Write the List columns of a data frame as PostgreSQL array text ('{1.5,2,NaN}'), so it can be written as CSV.
+
+    9. iter_binary_copy(batches) and iter_csv_copy(batches)
+        Encode batches one at a time, yielding the bytes of a binary COPY (header, rows, trailer) or a CSV COPY (header
+        line, rows) as they are needed. Every batch has to have the same schema as the first one (see iter_same_schema).
+
+    10. class CopyStream(chunks)
+        A read-only file-like object over an iterator of bytes, for copy_expert. Only the chunk being read is kept in memory.
+
+    11. get_polars_schema(description)
+        Turn a cursor.description into a dictionary of column name : Polars data type, using the PostgreSQL type OIDs.
+
+    12. array_text_to_list(column, dtype)
+        A Polars expression that parses array text ('{1.5,2,NaN}', or '(1.5, 2.0, nan)' as written by bag_to_csv_py3.py)
+        into a List column.
+
+    13. class CopyOutParser(schema, batch_function, batch_mb)
+        A write-only file-like object for COPY ... TO STDOUT WITH CSV. Whenever batch_mb megabytes of CSV text have been
+        written, the complete lines are parsed into a Polars data frame and handed to batch_function.
+'''
+import struct
+
+import numpy as np
+import polars as pl
+
+# Header and trailer of the binary COPY format
+binary_copy_header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+binary_copy_trailer = struct.pack('>h', -1)
+
+# Errors raised while encoding a batch that the encoders don't expect (a value out of range for its column, or an odd data type),
+# for callers that pull the encoded chunks themselves rather than through copy_expert
+encode_error_types = (ValueError, TypeError, OverflowError, KeyError, struct.error, pl.exceptions.PolarsError)
+
+# Number of bytes copy_expert reads from a CopyStream at a time
+copy_read_size = 1024 * 1024
+
+# PostgreSQL type OID : Polars data type, for reading (any other type is read as text)
+pg_type_dict = {16: pl.Boolean,      # boolean
+                20: pl.Int64,        # bigint
+                21: pl.Int16,        # smallint
+                23: pl.Int32,        # int
+                700: pl.Float32,     # real
+                701: pl.Float64,     # float
+                25: pl.Utf8,         # text
+                1042: pl.Utf8,       # char
+                1043: pl.Utf8,       # varchar
+                1021: pl.List(pl.Float32),   # real[]
+                1022: pl.List(pl.Float64)    # float[]
+}
+
+# Polars data type : big-endian NumPy data type of the PostgreSQL binary value
+binary_type_dict = {pl.Int16: '>i2',     # smallint
+                    pl.Int32: '>i4',     # int
+                    pl.Int64: '>i8',     # bigint
+                    pl.Float32: '>f4',   # real
+                    pl.Float64: '>f8',   # float
+                    pl.Boolean: '?'      # boolean
+}
+
+# Polars data type of an array's elements : (big-endian NumPy data type, PostgreSQL type OID of the elements)
+binary_array_type_dict = {pl.Float32: ('>f4', 700),   # real[]
+                          pl.Float64: ('>f8', 701)    # float[]
+}
+
+'''
+Check whether every column of the data frame has a type that can be written in the binary format.
+'''
+def can_encode_binary(df):
+    for dtype in df.dtypes:
+        if (dtype == pl.List):
+            if dtype.inner not in binary_array_type_dict:
+                return False
+        elif (dtype not in binary_type_dict) and (dtype != pl.Utf8):
+            return False
+
+    return True
+
+'''
+Get the number of elements of every array in a List column, if they all have the same (non-zero) number of elements and there are no
+NULL arrays or elements. Returns None otherwise. Such a column has the same layout in every row, like a column of numbers.
+'''
+def get_array_size(series):
+    if (series.null_count() > 0):
+        return None
+
+    counts = series.list.len()
+    if (counts.min() != counts.max()) or (counts.min() == 0):
+        return None
+
+    if (series.explode().null_count() > 0):
+        return None
+
+    return int(counts.min())
+
+'''
+Get the structured NumPy data type of a binary array with size elements: the header (1 dimension, no NULLs, the element type OID,
+the size, and a lower bound of 1), then an int32 length and the value of each element.
+'''
+def get_array_dtype(inner_type, size):
+    np_type = binary_array_type_dict[inner_type][0]
+    element_dtype = np.dtype([('length', '>i4'), ('value', np_type)])
+
+    return np.dtype([('ndim', '>i4'), ('has_null', '>i4'), ('element_oid', '>i4'), ('size', '>i4'), ('lower_bound', '>i4'),
+                     ('elements', element_dtype, (size,))])
+
+'''
+Encode a List column into the binary array format, for any mix of array sizes, NULL arrays, and NULL elements. Returns the data length of
+every field (-1 for NULL) and the bytes of the non-NULL fields, the same as the other columns in encode_binary_rows.
+
+The elements of every array are taken as one flat NumPy array. Each element becomes its int32 length and value (only the length for a
+NULL element), and each array gets a header (an empty array has no dimensions, so its header is only 12 bytes). The headers and the
+elements are then scattered into place with NumPy indexing, in the same way as the fields of a row.
+'''
+def encode_array_column(series):
+    n_rows = series.len()
+    np_type, element_oid = binary_array_type_dict[series.dtype.inner]
+    np_type = np.dtype(np_type)
+    element_size = 4 + np_type.itemsize
+
+    is_null = series.is_null().to_numpy()
+    counts = series.list.len().fill_null(0).to_numpy().astype(np.int64)
+    row_index = np.repeat(np.arange(n_rows), counts)
+
+    # Elements: int32 length (-1 for NULL), then the value (left out for NULL)
+    elements = series.explode(empty_as_null = False, keep_nulls = False)
+    element_null = elements.is_null().to_numpy()
+    values = elements.fill_null(0).to_numpy().astype(np_type)
+
+    element_bytes = np.empty((len(values), element_size), dtype = np.uint8)
+    element_bytes[:, :4] = np.where(element_null, -1, np_type.itemsize).astype('>i4').view(np.uint8).reshape(-1, 4)
+    element_bytes[:, 4:] = values.view(np.uint8).reshape(-1, np_type.itemsize)
+    element_keep = np.ones(element_bytes.shape, dtype = bool)
+    element_keep[element_null, 4:] = False
+    element_len = element_keep.sum(axis = 1)
+
+    body_len = np.bincount(row_index, weights = element_len, minlength = n_rows).astype(np.int64)
+    has_null = np.bincount(row_index, weights = element_null, minlength = n_rows) > 0
+
+    # Header: number of dimensions, has NULLs, element type OID, size, lower bound (the last two are left out for an empty array)
+    header = np.empty((n_rows, 5), dtype = '>i4')
+    header[:, 0] = (counts > 0)
+    header[:, 1] = has_null
+    header[:, 2] = element_oid
+    header[:, 3] = counts
+    header[:, 4] = 1
+    header_keep = np.ones((n_rows, 20), dtype = bool)
+    header_keep[counts == 0, 12:] = False
+    header_keep[is_null] = False
+    header_len = header_keep.sum(axis = 1)
+
+    data_len = np.where(is_null, -1, header_len + body_len).astype(np.int64)
+
+    # Starting position of every array, and of every element, in the payload
+    sizes = np.maximum(data_len, 0)
+    row_start = np.cumsum(sizes) - sizes
+    element_start = np.cumsum(element_len) - element_len
+    body_start = np.cumsum(body_len) - body_len
+    element_pos = (row_start + header_len)[row_index] + element_start - body_start[row_index]
+
+    payload = np.empty(int(sizes.sum()), dtype = np.uint8)
+    payload[(row_start[:, None] + np.arange(20))[header_keep]] = header.view(np.uint8).reshape(n_rows, 20)[header_keep]
+    payload[(element_pos[:, None] + np.arange(element_size))[element_keep]] = element_bytes[element_keep]
+
+    return data_len, payload
+
+'''
+Encode the rows of a data frame (without the header or trailer) into bytes.
+
+If every column has a fixed size and there are no NULLs, every row has the same layout, so a NumPy structured array
+(int16 field count, then an int32 length and the value for each column) is filled one column at a time. Array columns have a
+fixed size too if every array has the same number of elements (as in a scan of a 2D LiDAR).
+
+Otherwise (text columns, arrays of different sizes, or NULLs), the length of each field is worked out first. From those lengths, the
+position of every field in the output is known, and the bytes of each column are scattered into place with NumPy indexing.
+'''
+def encode_binary_rows(df):
+    n_rows = df.height
+    n_cols = df.width
+
+    if (n_rows == 0):
+        return b''
+
+    columns = df.get_columns()
+    has_text = any(series.dtype == pl.Utf8 for series in columns)
+    has_nulls = any(series.null_count() > 0 for series in columns)
+    array_size_dict = {i : get_array_size(series) for i, series in enumerate(columns) if (series.dtype == pl.List)}
+
+    # Fixed layout: fill a structured array column by column
+    if not (has_text or has_nulls or (None in array_size_dict.values())):
+        fields = [('field_count', '>i2')]
+        for i, series in enumerate(columns):
+            fields.append((f'length_{i}', '>i4'))
+            if i in array_size_dict:
+                fields.append((f'value_{i}', get_array_dtype(series.dtype.inner, array_size_dict[i])))
+            else:
+                fields.append((f'value_{i}', binary_type_dict[series.dtype]))
+
+        rows = np.empty(n_rows, dtype = np.dtype(fields))
+        rows['field_count'] = n_cols
+        for i, series in enumerate(columns):
+            rows[f'length_{i}'] = rows.dtype[f'value_{i}'].itemsize
+
+            if i in array_size_dict:
+                array = rows[f'value_{i}']
+                array['ndim'] = 1
+                array['has_null'] = 0
+                array['element_oid'] = binary_array_type_dict[series.dtype.inner][1]
+                array['size'] = array_size_dict[i]
+                array['lower_bound'] = 1
+                array['elements']['length'] = array.dtype['elements'].base['value'].itemsize
+                array['elements']['value'] = series.explode().to_numpy().reshape(n_rows, array_size_dict[i])
+            else:
+                rows[f'value_{i}'] = series.to_numpy()
+
+        return rows.tobytes()
+
+    # Variable layout: for each column, get the data length of every field (-1 for NULL) and the bytes of the non-NULL values
+    field_lst = []
+    row_size = np.full(n_rows, 2, dtype = np.int64)   # Every row starts with the int16 field count
+
+    for series in columns:
+        is_null = series.is_null().to_numpy()
+
+        if (series.dtype == pl.Utf8):
+            data_len = series.str.len_bytes().fill_null(-1).to_numpy().astype(np.int64)
+            payload = np.frombuffer(''.join(series.drop_nulls().to_list()).encode('utf-8'), dtype = np.uint8)
+        elif (series.dtype == pl.List):
+            data_len, payload = encode_array_column(series)
+        else:
+            np_type = np.dtype(binary_type_dict[series.dtype])
+            values = series.fill_null(0).to_numpy().astype(np_type)
+            data_len = np.where(is_null, -1, np_type.itemsize).astype(np.int64)
+            payload = values.view(np.uint8).reshape(n_rows, np_type.itemsize)[~is_null].ravel()
+
+        field_lst.append((data_len, payload))
+        row_size += 4 + np.maximum(data_len, 0)
+
+    # Starting position of every row in the output
+    row_start = np.zeros(n_rows, dtype = np.int64)
+    row_start[1:] = np.cumsum(row_size)[:-1]
+    out = np.empty(int(row_size.sum()), dtype = np.uint8)
+
+    # int16 field count
+    count_bytes = np.array([n_cols], dtype = '>i2').view(np.uint8)
+    out[row_start] = count_bytes[0]
+    out[row_start + 1] = count_bytes[1]
+    pos = row_start + 2
+
+    for data_len, payload in field_lst:
+        # int32 field length
+        len_bytes = data_len.astype('>i4').view(np.uint8).reshape(n_rows, 4)
+        out[pos[:, None] + np.arange(4)] = len_bytes
+        pos = pos + 4
+
+        # Field values: byte j of a value goes to (start of its field + j)
+        sizes = np.maximum(data_len, 0)
+        if (payload.size > 0):
+            value_start = np.cumsum(sizes) - sizes
+            offsets = np.arange(payload.size) - np.repeat(value_start, sizes)
+            out[np.repeat(pos, sizes) + offsets] = payload
+        pos = pos + sizes
+
+    return out.tobytes()
+
+'''
+Encode a whole data frame, including the header and trailer.
+'''
+def encode_binary_copy(df):
+    return binary_copy_header + encode_binary_rows(df) + binary_copy_trailer
+
+'''
+Split a data frame, or an iterator of data frames / Arrow record batches, into data frames small enough that one encoded
+batch stays under max_buffer_mb megabytes. The number of rows per batch comes from the in-memory size of each row (plus the
+4 byte length of every field), doubled to leave room for the NumPy arrays used while encoding. Slices of a data frame are
+views, so no rows are copied here.
+'''
+def iter_batches(data, max_buffer_mb = 64):
+    if isinstance(data, pl.DataFrame):
+        data = [data]
+
+    for batch in data:
+        # Arrow record batches and tables are turned into Polars data frames
+        if not isinstance(batch, pl.DataFrame):
+            batch = pl.from_arrow(batch)
+
+        if (batch.height == 0):
+            continue
+
+        row_size = batch.estimated_size() / batch.height + 2 + 4 * batch.width
+        max_rows = max(1, int(max_buffer_mb * 1024 * 1024 / (2 * row_size)))
+
+        for offset in range(0, batch.height, max_rows):
+            yield batch.slice(offset, max_rows)
+
+'''
+Write every List column of a data frame as PostgreSQL array text ('{1.5,2,NaN}', with NULL for a NULL element), so the data frame
+can be written as CSV (CSV files can't hold List columns). A NULL array stays NULL. Other columns are left as they are.
+'''
+def format_array_columns(df):
+    array_lst = [name for name, dtype in df.schema.items() if (dtype == pl.List)]
+    if (len(array_lst) == 0):
+        return df
+
+    return df.with_columns([pl.concat_str([pl.lit('{'),
+                                           pl.col(name).list.eval(pl.element().cast(pl.Utf8).fill_null('NULL')).list.join(','),
+                                           pl.lit('}')]).alias(name)
+                            for name in array_lst])
+
+'''
+Pass the batches through, raising a ValueError as soon as one has different column names or types than the first batch. The format
+of the COPY (and, for binary, the types the values are encoded as) is chosen from the first batch, so a later batch with a Float64
+column where the first had Int64 would otherwise be written as the raw bits of the floats, without any error from the database.
+'''
+def iter_same_schema(batches):
+    schema = None
+
+    for batch in batches:
+        if schema is None:
+            schema = batch.schema
+        elif (batch.schema != schema):
+            if (batch.columns != list(schema.keys())):
+                raise ValueError(f"A batch has the columns {batch.columns}, but the first batch has {list(schema.keys())}")
+
+            changed_lst = [f"{name} ({schema[name]} -> {dtype})" for name, dtype in batch.schema.items() if (dtype != schema[name])]
+            raise ValueError(f"A batch has different column types than the first batch: {', '.join(changed_lst)}")
+
+        yield batch
+
+'''
+Encode batches one at a time, yielding the header, the rows of each batch, and then the trailer of a binary COPY.
+'''
+def iter_binary_copy(batches):
+    yield binary_copy_header
+
+    for batch in iter_same_schema(batches):
+        yield encode_binary_rows(batch)
+
+    yield binary_copy_trailer
+
+'''
+Encode batches one at a time as CSV (with a header line before the first batch), for COPY ... WITH CSV HEADER NULL AS 'NULL'.
+'''
+def iter_csv_copy(batches):
+    include_header = True
+
+    for batch in iter_same_schema(batches):
+        yield format_array_columns(batch).write_csv(include_header = include_header, null_value = 'NULL').encode('utf-8')
+        include_header = False
+
+'''
+A read-only file-like object over an iterator of bytes, for copy_expert. The next chunk is only pulled from the iterator (and so
+only encoded) once the previous chunk has been read, so memory use is bounded by the size of one chunk.
+'''
+class CopyStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = memoryview(b'')
+        self.offset = 0
+        self.bytes_read = 0
+
+    '''
+    Return up to size bytes (all of the remaining bytes if size is negative). Returns b'' once every chunk has been read.
+    '''
+    def read(self, size = -1):
+        parts = []
+        n_bytes = 0
+
+        while (size < 0) or (n_bytes < size):
+            # Move on to the next chunk once the current one has been read
+            if (self.offset >= len(self.chunk)):
+                next_chunk = next(self.chunks, None)
+                if next_chunk is None:
+                    break
+
+                self.chunk = memoryview(next_chunk)
+                self.offset = 0
+                continue
+
+            if (size < 0):
+                end = len(self.chunk)
+            else:
+                end = min(len(self.chunk), self.offset + size - n_bytes)
+
+            parts.append(self.chunk[self.offset:end])
+            n_bytes += end - self.offset
+            self.offset = end
+
+        self.bytes_read += n_bytes
+
+        return b''.join(parts)
+
+'''
+Turn a cursor.description (from a query on the table) into a dictionary of column name : Polars data type. Types that are
+not in pg_type_dict are read as text.
+'''
+def get_polars_schema(description):
+    schema = {}
+
+    for column in description:
+        schema[column.name] = pg_type_dict.get(column.type_code, pl.Utf8)
+
+    return schema
+
+'''
+Get a Polars expression that parses a text column of arrays into a List column of dtype. Both the PostgreSQL array text ('{1.5,2,NaN}',
+with NULL for a NULL element) and the tuple text written by bag_to_csv_py3.py ('(1.5, 2.0, nan)') are understood. The text is split and
+cast by Polars, so no Python work is done per array. NULL elements (and anything else that isn't a number) become NULL.
+'''
+def array_text_to_list(column, dtype):
+    text = pl.col(column).str.replace_all(' ', '', literal = True).str.strip_chars('{}()[]')
+
+    # An empty array would split into one empty string, so it is made separately
+    return (pl.when(text == '').then(pl.lit([], dtype = dtype))
+            .otherwise(text.str.replace_all('NULL', '', literal = True).str.split(',').cast(dtype, strict = False))
+            .alias(column))
+
+'''
+A write-only file-like object for COPY ... TO STDOUT WITH CSV (without a header). copy_expert writes the CSV text in small
+pieces. Once at least batch_mb megabytes are waiting, everything up to the last complete line is parsed with the known schema
+(so no types are inferred) and the data frame is handed to batch_function. Call close() after copy_expert to parse the rest.
+
+A newline inside a quoted value is not the end of a row, so the cut is moved back until an even number of quotes come before it.
+Array columns are read as text and then parsed into List columns with array_text_to_list.
+'''
+class CopyOutParser:
+    def __init__(self, schema, batch_function, batch_mb = 64):
+        self.schema = schema
+        self.array_lst = [name for name, dtype in schema.items() if (dtype == pl.List)]
+        self.csv_schema = {name : (pl.Utf8 if name in self.array_lst else dtype) for name, dtype in schema.items()}
+        self.batch_function = batch_function
+        self.batch_size = batch_mb * 1024 * 1024
+        self.pending = bytearray()
+        self.n_rows = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self.pending += data
+
+        if (len(self.pending) >= self.batch_size):
+            # Find the end of the last complete row
+            cut = self.pending.rfind(b'\n') + 1
+            while (cut > 0) and (self.pending.count(b'"', 0, cut) % 2 == 1):
+                cut = self.pending.rfind(b'\n', 0, cut - 1) + 1
+
+            if (cut > 0):
+                self.parse(bytes(self.pending[:cut]))
+                del self.pending[:cut]
+
+    '''
+    Parse whatever is left once copy_expert is done.
+    '''
+    def close(self):
+        if (len(self.pending) > 0):
+            self.parse(bytes(self.pending))
+            self.pending = bytearray()
+
+    def parse(self, csv_bytes):
+        batch = pl.read_csv(csv_bytes, has_header = False, schema = self.csv_schema)
+        if (len(self.array_lst) > 0):
+            batch = batch.with_columns([array_text_to_list(name, self.schema[name]) for name in self.array_lst])
+        self.n_rows += batch.height
+        self.batch_function(batch)
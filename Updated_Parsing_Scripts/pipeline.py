@@ -0,0 +1,262 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script runs a chain of stages (for example decode -> transform -> sink) over a stream of items, either one item
+    at a time in the calling thread, or with every stage on its own thread and the stages joined by bounded queues. With
+    threads, the stages overlap: while the sink is waiting on the database during COPY (which releases the GIL), the next
+    chunk is already being decoded and transformed. The queues hold at most queue_size items, so a slow sink makes the
+    earlier stages wait rather than letting decoded chunks pile up in memory.
+
+    For every stage, the time spent working, waiting for input, and waiting for room in the output queue is measured, and
+    print_pipeline_report() prints each stage's utilization (working time / total time). The stage with the highest
+    utilization is the bottleneck.
+
+    If a stage raises an error, every stage stops, and run_pipeline raises the first error once all of the threads have
+    finished. Each stage can have an on_start function and an on_finish function that run in the stage's own thread, for
+    example to set up or commit that thread's database connection. on_finish is given the first error (or None).
+
+Usage:
+    Use with the parse_and_insert.py script.
+        stage_lst = [Stage('transform', transform_function),
+                     Stage('sink', sink_function, on_start = start_function, on_finish = finish_function)]
+        stats_lst, total_time = run_pipeline(Stage('decode', source_iterator), stage_lst, queue_size = 4, threaded = True)
+        print_pipeline_report(stats_lst, total_time)
+
+Method(s):
+    1. class Stage(name, function, on_start = None, on_finish = None)
+        One stage of the pipeline. For the first stage, function is an iterable of items instead.
+
+    2. run_pipeline(source, stage_lst, queue_size = 4, threaded = True)
+        Run the items of the source stage through every stage. Returns the list of per-stage statistics and the total time.
+
+    3. print_pipeline_report(stats_lst, total_time)
+        Print the items, working time, waiting time, and utilization of every stage.
+'''
+import queue
+import threading
+import time
+
+# Put on a queue after the last item
+end_of_stream = object()
+
+# How long a blocked stage waits before checking whether the pipeline was stopped
+queue_timeout = 0.1
+
+'''
+    ========================================= Class Stage =========================================
+    #	Purpose: One stage of a pipeline, along with its statistics.
+    #
+    #   Attributes:
+    #       name:        name of the stage in the report
+    #       function:    called with each item, returns the item for the next stage (for the first
+    #                    stage, an iterable of items)
+    #       on_start:    called with no arguments in the stage's thread before the first item
+    #       on_finish:   called with the first error of the pipeline (or None) in the stage's thread
+    #                    after the last item
+    #       items:       number of items handled
+    #       busy_time:   seconds spent in function
+    #       input_time:  seconds spent waiting for an item from the previous stage
+    #       output_time: seconds spent waiting for room in the queue to the next stage
+    ===============================================================================================
+'''
+class Stage:
+    def __init__(self, name, function, on_start = None, on_finish = None):
+        self.name = name
+        self.function = function
+        self.on_start = on_start
+        self.on_finish = on_finish
+
+        self.items = 0
+        self.busy_time = 0
+        self.input_time = 0
+        self.output_time = 0
+
+    '''
+    Statistics of the stage, with the utilization worked out from the total time of the pipeline.
+    '''
+    def get_stats(self, total_time):
+        return {'name': self.name,
+                'items': self.items,
+                'busy_time': self.busy_time,
+                'input_time': self.input_time,
+                'output_time': self.output_time,
+                'utilization': (self.busy_time / total_time) if (total_time > 0) else 0}
+
+'''
+Keeps the first error raised by any stage, and tells the other stages to stop.
+'''
+class PipelineState:
+    def __init__(self):
+        self.error = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.stop_event.set()
+
+'''
+Get the next item from a queue, giving up if the pipeline was stopped. Returns end_of_stream if there are no more items.
+'''
+def get_item(in_queue, state):
+    while True:
+        try:
+            return in_queue.get(timeout = queue_timeout)
+        except queue.Empty:
+            if state.stop_event.is_set():
+                return end_of_stream
+
+'''
+Put an item on a queue, giving up if the pipeline was stopped. Returns False if it gave up.
+'''
+def put_item(out_queue, item, state):
+    while True:
+        try:
+            out_queue.put(item, timeout = queue_timeout)
+            return True
+        except queue.Full:
+            if state.stop_event.is_set():
+                return False
+
+'''
+Run one stage in its own thread: take items from in_queue (or from the source iterable if in_queue is None), hand each one to the
+stage's function, and put the results on out_queue (if there is a next stage). end_of_stream is always passed on, even after an
+error, so the next stage finishes too.
+'''
+def run_stage(stage, in_queue, out_queue, state):
+    try:
+        if stage.on_start is not None:
+            stage.on_start()
+
+        if in_queue is None:
+            iterator = iter(stage.function)
+
+        while not state.stop_event.is_set():
+            # Get the next item
+            if in_queue is None:
+                start_time = time.perf_counter()
+                item = next(iterator, end_of_stream)
+                stage.busy_time += time.perf_counter() - start_time
+            else:
+                start_time = time.perf_counter()
+                item = get_item(in_queue, state)
+                stage.input_time += time.perf_counter() - start_time
+
+                if item is not end_of_stream:
+                    start_time = time.perf_counter()
+                    item = stage.function(item)
+                    stage.busy_time += time.perf_counter() - start_time
+
+            if item is end_of_stream:
+                break
+
+            stage.items += 1
+
+            # Hand the item to the next stage
+            if out_queue is not None:
+                start_time = time.perf_counter()
+                put_item(out_queue, item, state)
+                stage.output_time += time.perf_counter() - start_time
+
+    except Exception as e:
+        state.fail(e)
+
+    finally:
+        if out_queue is not None:
+            put_item(out_queue, end_of_stream, state)
+
+        if stage.on_finish is not None:
+            try:
+                stage.on_finish(state.error)
+            except Exception as e:
+                state.fail(e)
+
+'''
+Run the items of the source stage through every stage of stage_lst. With threaded = True, every stage runs on its own thread and the
+stages are joined by queues of at most queue_size items. With threaded = False, each item goes through every stage in the calling
+thread before the next item is read (the same statistics are kept, so the two can be compared). Raises the first error of any stage.
+Returns the list of per-stage statistics and the total time.
+'''
+def run_pipeline(source, stage_lst, queue_size = 4, threaded = True):
+    all_stage_lst = [source] + list(stage_lst)
+    state = PipelineState()
+
+    start_time = time.perf_counter()
+
+    if threaded:
+        queue_lst = [queue.Queue(maxsize = queue_size) for _ in stage_lst]
+        thread_lst = []
+
+        for index, stage in enumerate(all_stage_lst):
+            in_queue = queue_lst[index - 1] if (index > 0) else None
+            out_queue = queue_lst[index] if (index < len(queue_lst)) else None
+
+            thread = threading.Thread(target = run_stage, args = (stage, in_queue, out_queue, state), name = f"pipeline-{stage.name}", daemon = True)
+            thread.start()
+            thread_lst.append(thread)
+
+        for thread in thread_lst:
+            thread.join()
+
+    else:
+        try:
+            for stage in all_stage_lst:
+                if stage.on_start is not None:
+                    stage.on_start()
+
+            iterator = iter(source.function)
+            while True:
+                item_start_time = time.perf_counter()
+                item = next(iterator, end_of_stream)
+                source.busy_time += time.perf_counter() - item_start_time
+
+                if item is end_of_stream:
+                    break
+                source.items += 1
+
+                for stage in stage_lst:
+                    item_start_time = time.perf_counter()
+                    item = stage.function(item)
+                    stage.busy_time += time.perf_counter() - item_start_time
+                    stage.items += 1
+
+        except Exception as e:
+            state.fail(e)
+
+        finally:
+            for stage in all_stage_lst:
+                if stage.on_finish is not None:
+                    try:
+                        stage.on_finish(state.error)
+                    except Exception as e:
+                        state.fail(e)
+
+    total_time = time.perf_counter() - start_time
+    stats_lst = [stage.get_stats(total_time) for stage in all_stage_lst]
+
+    if state.error is not None:
+        raise state.error
+
+    return stats_lst, total_time
+
+'''
+Print the items, working time, waiting time, and utilization of every stage, and name the bottleneck (the busiest stage).
+'''
+def print_pipeline_report(stats_lst, total_time):
+    print("------------------------------------------------------------------------------------------------------------------")
+    print(f"Pipeline stages ({total_time:.2f} seconds in total):")
+    print(f"{'stage':<12}{'items':>8}{'busy (s)':>12}{'wait in (s)':>14}{'wait out (s)':>14}{'utilization':>14}")
+    for stats in stats_lst:
+        print(f"{stats['name']:<12}{stats['items']:>8}{stats['busy_time']:>12.2f}{stats['input_time']:>14.2f}"
+              f"{stats['output_time']:>14.2f}{stats['utilization']:>13.0%}")
+
+    if (len(stats_lst) > 0):
+        bottleneck = max(stats_lst, key = lambda stats: stats['busy_time'])
+        print(f"Bottleneck: {bottleneck['name']} ({bottleneck['utilization']:.0%} busy)")
+    print("------------------------------------------------------------------------------------------------------------------")
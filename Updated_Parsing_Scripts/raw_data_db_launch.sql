@@ -48,6 +48,23 @@ CREATE TABLE IF NOT EXISTS bag_files (
     CONSTRAINT bag_file_unique UNIQUE (bag_file_name)
 );
 
+-- Table: ingest_manifest
+-- One row per (bag file, topic) that parse_and_insert.py has tried to load. See ingest_manifest.py.
+CREATE TABLE IF NOT EXISTS ingest_manifest (
+    id serial NOT NULL,
+    bag_files_id int NOT NULL,
+    topic varchar(100) NOT NULL,
+    table_name varchar(50) NOT NULL,
+    bag_file_hash varchar(64) NOT NULL,
+    bag_file_size bigint NOT NULL,
+    row_count bigint NOT NULL DEFAULT 0,
+    status varchar(10) NOT NULL, -- running, done, or failed
+    error_message text NULL,
+    ingest_timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT ingest_manifest_pk PRIMARY KEY (id),
+    CONSTRAINT ingest_manifest_unique UNIQUE (bag_files_id, topic)
+);
+
 ----------------------------------------------------------------------
 -- Sensor Type: Encoder
 ----------------------------------------------------------------------
@@ -259,6 +276,9 @@ CREATE TABLE IF NOT EXISTS gps_spark_fun_front_vtg (
 -- Sensor Type: LiDAR
 ----------------------------------------------------------------------
 -- Table: sick_lms_5xx
+-- ranges and intensities hold one element per beam of the scan. A database made when they were text columns can be changed with:
+--     ALTER TABLE sick_lms_5xx ALTER COLUMN ranges TYPE real[] USING translate(ranges, '()[]', '{}{}')::real[],
+--                              ALTER COLUMN intensities TYPE real[] USING translate(intensities, '()[]', '{}{}')::real[];
 CREATE TABLE IF NOT EXISTS sick_lms_5xx (
     id serial NOT NULL,
     bag_files_id int NOT NULL,
@@ -269,8 +289,8 @@ CREATE TABLE IF NOT EXISTS sick_lms_5xx (
     angle_increment real NOT NULL,
     range_min real NOT NULL,
     range_max real NOT NULL,
-    ranges text NOT NULL,
-    intensities text NOT NULL,
+    ranges real[] NOT NULL,
+    intensities real[] NOT NULL,
     ros_seconds bigint NOT NULL,
     ros_nanoseconds bigint NOT NULL,
     ros_publish_time real NOT NULL,
@@ -279,11 +299,14 @@ CREATE TABLE IF NOT EXISTS sick_lms_5xx (
 );
 
 -- Table: velodyne_lidar (option 1)
+-- One row per scan. The packets of the scan are in a file of the LiDAR blob store (see lidar_blob_store.py), named by the
+-- SHA-256 hash of its bytes (velodyne_lidar_hash_tag), at velodyne_lidar_location under the root of the store.
+-- Identical scans in different bag files share one file, so the hash only has to be unique within a bag file.
 CREATE TABLE IF NOT EXISTS velodyne_lidar (
     id serial NOT NULL,
     bag_files_id int NOT NULL,
-    velodyne_lidar_hash_tag int NOT NULL,
-    velodyne_lidar_location varchar (10) NOT NULL,
+    velodyne_lidar_hash_tag varchar (64) NOT NULL,
+    velodyne_lidar_location text NOT NULL,
     velodyne_lidar_file_size bigint NOT NULL,
     velodyne_lidar_file_time real NOT NULL, -- Might not need
     ros_seconds bigint NOT NULL,
@@ -291,7 +314,7 @@ CREATE TABLE IF NOT EXISTS velodyne_lidar (
     ros_publish_time real NOT NULL,
     ros_record_time real NOT NULL,
     CONSTRAINT velodyne_lidar_pk PRIMARY KEY (id),
-    CONSTRAINT velodyne_lidar_hash_tag_unique UNIQUE (velodyne_lidar_hash_tag)
+    CONSTRAINT velodyne_lidar_hash_tag_unique UNIQUE (bag_files_id, velodyne_lidar_hash_tag)
 );
 
 /*
@@ -319,11 +342,14 @@ CREATE TABLE IF NOT EXISTS velodyne_lidar (
 */
 
 -- Table: velodyne_lidar (option 1)
+-- One row per scan. The packets of the scan are in a file of the LiDAR blob store (see lidar_blob_store.py), named by the
+-- SHA-256 hash of its bytes (velodyne_lidar_hash_tag), at velodyne_lidar_location under the root of the store.
+-- Identical scans in different bag files share one file, so the hash only has to be unique within a bag file.
 CREATE TABLE IF NOT EXISTS velodyne_lidar (
     id serial NOT NULL,
     bag_files_id int NOT NULL,
-    velodyne_lidar_hash_tag int NOT NULL,
-    velodyne_lidar_location varchar (10) NOT NULL,
+    velodyne_lidar_hash_tag varchar (64) NOT NULL,
+    velodyne_lidar_location text NOT NULL,
     velodyne_lidar_file_size bigint NOT NULL,
     velodyne_lidar_file_time real NOT NULL, -- Might not need
     ros_seconds bigint NOT NULL,
@@ -331,15 +357,18 @@ CREATE TABLE IF NOT EXISTS velodyne_lidar (
     ros_publish_time real NOT NULL,
     ros_record_time real NOT NULL,
     CONSTRAINT velodyne_lidar_pk PRIMARY KEY (id),
-    CONSTRAINT velodyne_lidar_hash_tag_unique UNIQUE (velodyne_lidar_hash_tag)
+    CONSTRAINT velodyne_lidar_hash_tag_unique UNIQUE (bag_files_id, velodyne_lidar_hash_tag)
 );
 
 -- Table: ouster_lidar (option 1)
+-- One row per scan. The packets of the scan are in a file of the LiDAR blob store (see lidar_blob_store.py), named by the
+-- SHA-256 hash of its bytes (ouster_lidar_hash_tag), at ouster_lidar_location under the root of the store.
+-- Identical scans in different bag files share one file, so the hash only has to be unique within a bag file.
 CREATE TABLE IF NOT EXISTS ouster_lidar (
     id serial NOT NULL,
     bag_files_id int NOT NULL,
-    ouster_lidar_hash_tag int NOT NULL,
-    ouster_lidar_location varchar (10) NOT NULL,
+    ouster_lidar_hash_tag varchar (64) NOT NULL,
+    ouster_lidar_location text NOT NULL,
     ouster_lidar_file_size bigint NOT NULL,
     ouster_lidar_file_time real NOT NULL, -- Might not need
     ros_seconds bigint NOT NULL,
@@ -347,7 +376,7 @@ CREATE TABLE IF NOT EXISTS ouster_lidar (
     ros_publish_time real NOT NULL,
     ros_record_time real NOT NULL,
     CONSTRAINT ouster_lidar_pk PRIMARY KEY (id),
-    CONSTRAINT ouster_lidar_hash_tag_unique UNIQUE (ouster_lidar_hash_tag)
+    CONSTRAINT ouster_lidar_hash_tag_unique UNIQUE (bag_files_id, ouster_lidar_hash_tag)
 );
 
 /*
@@ -445,6 +474,14 @@ ALTER TABLE gps_spark_fun_front_gga ADD
 ----------------------------------------------------------------------
 -- Bag Files
 ----------------------------------------------------------------------
+-- Reference: ingest_manifest_bag_files (table: ingest_manifest)
+ALTER TABLE ingest_manifest ADD
+    FOREIGN KEY (bag_files_id)
+    REFERENCES bag_files (id)  
+    NOT DEFERRABLE 
+    INITIALLY IMMEDIATE
+;
+
 -- Reference: encoder_bag_files (table: encoder)
 ALTER TABLE encoder ADD
     FOREIGN KEY (bag_files_id)
@@ -0,0 +1,371 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script decodes serialized ROS messages in bulk, without making a Python message object for each one. It is used by
+    bag_reader.py for topics such as the GPS SparkFun GGA/GST/VTG, /parseEncoder, and /parseTrigger messages, which only
+    hold numbers and a few strings, and for /sick_lms_5xx/scan, whose ranges and intensities are arrays of numbers.
+
+    A decoder is generated from the message definition stored in the bag file. The definition is flattened into a list of
+    fields (header.seq, header.stamp.secs, header.stamp.nsecs, header.frame_id, Latitude, ...), each with a little-endian
+    NumPy type. Messages are read with read_messages(raw = True), which only hands back the serialized bytes, and the bytes
+    of every message with the same layout are joined and read with one np.frombuffer call using a structured data type.
+
+    Strings and variable-length arrays of numbers are the only fields whose size changes between messages. The layout of a
+    message is the length of each of these fields. If a message has a single one, its layout is just its total length, so
+    messages are grouped by length. Otherwise, the uint32 length prefixes of the fields are read to find the layout. Each
+    group gets its own structured data type with the strings and arrays at the right offsets. A 2D LiDAR has the same
+    number of points in every scan, so all of its scans are read with one np.frombuffer call into a 2D array.
+
+    Definitions with arrays of strings or messages can't be decoded this way, and get_struct_decoder returns None for them
+    so that bag_reader.py falls back to deserializing message objects.
+
+Usage:
+    Use with the bag_reader.py script.
+        decoder = get_struct_decoder(msg_type, msg_def)
+        if decoder is not None:
+            column_dict = decoder.decode(data_lst)    # data_lst is a list of serialized messages (bytes)
+
+Method(s):
+    1. parse_msg_def(msg_type, msg_def)
+        Split a full message definition into the definitions of the message and every message it uses. Returns a
+        dictionary of message type : list of (field type, field name).
+
+    2. flatten_fields(msg_type, msg_def_dict, prefix = '')
+        Flatten a message type into a list of (field path, NumPy type, 'string', or ('array', NumPy type)). Raises
+        ValueError for fields that can't be decoded this way.
+
+    3. get_unit_size(field_type)
+        The number of bytes per unit of a variable-size field's length prefix, or None for a fixed-size field.
+
+    4. class StructDecoder(msg_type, fields)
+        Decode a list of serialized messages into a dictionary of field path : NumPy array.
+
+    5. get_struct_decoder(msg_type, msg_def)
+        Get a StructDecoder for a message definition, or None if the message can't be decoded this way.
+'''
+import struct
+
+import numpy as np
+
+# ROS primitive type : little-endian NumPy type
+ros_primitive_dict = {'bool': '?',
+                      'int8': '<i1',
+                      'byte': '<i1',
+                      'uint8': '<u1',
+                      'char': '<u1',
+                      'int16': '<i2',
+                      'uint16': '<u2',
+                      'int32': '<i4',
+                      'uint32': '<u4',
+                      'int64': '<i8',
+                      'uint64': '<u8',
+                      'float32': '<f4',
+                      'float64': '<f8'
+}
+
+# time and duration are serialized as two 32 bit integers
+ros_time_dict = {'time': '<u4',
+                 'duration': '<i4'
+}
+
+# Length prefix of a string
+string_length = struct.Struct('<I')
+
+# Cache of decoders, keyed by (message type, message definition)
+decoder_cache = {}
+
+'''
+Split a full message definition (as stored in the bag file) into the definitions of the message and every message it uses. The
+definitions of the other messages follow the main one, each after a line of '=' and a 'MSG: <type>' line. Comments and constants
+are left out. Returns a dictionary of message type : list of (field type, field name).
+'''
+def parse_msg_def(msg_type, msg_def):
+    msg_def_dict = {msg_type: []}
+    current_type = msg_type
+
+    for line in msg_def.split('\n'):
+        line = line.split('#')[0].strip()
+
+        if (line == '') or line.startswith('=='):
+            continue
+        elif line.startswith('MSG:'):
+            current_type = line[4:].strip()
+            msg_def_dict[current_type] = []
+            continue
+
+        parts = line.split()
+        if (len(parts) < 2) or ('=' in line):
+            continue   # Constants don't take up any space in the serialized message
+
+        msg_def_dict[current_type].append((parts[0], parts[1]))
+
+    return msg_def_dict
+
+'''
+Find the full name of a message type used inside another message. 'Header' is always std_msgs/Header, and a type without a
+package is first looked for in the package of the message that uses it.
+'''
+def resolve_type(field_type, parent_type, msg_def_dict):
+    if (field_type == 'Header'):
+        return 'std_msgs/Header'
+    elif '/' in field_type:
+        return field_type
+
+    package = parent_type.split('/')[0]
+    if f"{package}/{field_type}" in msg_def_dict:
+        return f"{package}/{field_type}"
+
+    for msg_type in msg_def_dict:
+        if msg_type.endswith(f"/{field_type}"):
+            return msg_type
+
+    return field_type
+
+'''
+Flatten a message type into a list of (field path, NumPy type, 'string', or ('array', NumPy type)), in the order the fields are
+serialized. Nested messages are walked into (header.stamp.secs), fixed-size arrays of primitives become sub-array types, and
+variable-length arrays of primitives become ('array', NumPy type of an element). Raises ValueError for arrays of strings or messages.
+'''
+def flatten_fields(msg_type, msg_def_dict, prefix = ''):
+    fields = []
+
+    if msg_type not in msg_def_dict:
+        raise ValueError(f"no definition for '{msg_type}'")
+
+    for field_type, field_name in msg_def_dict[msg_type]:
+        path = prefix + field_name
+
+        if '[' in field_type:
+            base_type, size = field_type[:-1].split('[')
+            if base_type not in ros_primitive_dict:
+                raise ValueError(f"'{path}' is a {field_type} array")
+            elif (size == ''):
+                fields.append((path, ('array', ros_primitive_dict[base_type])))
+            else:
+                fields.append((path, (ros_primitive_dict[base_type], (int(size),))))
+
+        elif field_type in ros_primitive_dict:
+            fields.append((path, ros_primitive_dict[field_type]))
+
+        elif field_type in ros_time_dict:
+            fields.append((f"{path}.secs", ros_time_dict[field_type]))
+            fields.append((f"{path}.nsecs", ros_time_dict[field_type]))
+
+        elif (field_type == 'string'):
+            fields.append((path, 'string'))
+
+        else:
+            nested_type = resolve_type(field_type, msg_type, msg_def_dict)
+            fields.extend(flatten_fields(nested_type, msg_def_dict, f"{path}."))
+
+    return fields
+
+'''
+Get the number of bytes per unit of a variable-size field's uint32 length prefix: 1 for a string (its length is in bytes), and the size
+of an element for a variable-length array (its length is the number of elements). Returns None for a fixed-size field.
+'''
+def get_unit_size(field_type):
+    if (field_type == 'string'):
+        return 1
+    elif isinstance(field_type, tuple) and (field_type[0] == 'array'):
+        return np.dtype(field_type[1]).itemsize
+
+    return None
+
+'''
+    =================================== Class StructDecoder =======================================
+    #	Purpose: Decode serialized messages of one type in bulk. The fields are split into runs of
+    #            fixed-size fields between the strings and variable-length arrays, so the layout of a
+    #            message only depends on the lengths of its strings and arrays.
+    #
+    #   Methods:
+    #       1. def get_layout_key(self, data)
+    #           Get the layout of one serialized message (the length of each of its strings and arrays).
+    #
+    #       2. def get_dtype(self, layout_key)
+    #           Get the structured data type for a layout, generating it the first time.
+    #
+    #       3. def decode(self, data_lst)
+    #           Decode a list of serialized messages. Returns a dictionary of field path : NumPy array
+    #           (object arrays of str for strings, 2D arrays for arrays, or object arrays of 1D arrays
+    #           if the arrays don't all have the same length), in the same order as data_lst. Raises
+    #           ValueError if a message doesn't match the definition.
+    ===============================================================================================
+'''
+class StructDecoder:
+    def __init__(self, msg_type, fields):
+        self.msg_type = msg_type
+        self.fields = fields
+        self.string_paths = [path for path, field_type in fields if (field_type == 'string')]
+        self.array_dict = {path : field_type[1] for path, field_type in fields if (get_unit_size(field_type) is not None) and (field_type != 'string')}
+
+        # Bytes per unit of the length of each variable-size field, and the size of the fixed-size fields before each one, and after
+        # the last one
+        self.unit_size_lst = []
+        self.run_size_lst = [0]
+        for path, field_type in fields:
+            unit_size = get_unit_size(field_type)
+            if unit_size is not None:
+                self.unit_size_lst.append(unit_size)
+                self.run_size_lst.append(0)
+            else:
+                self.run_size_lst[-1] += np.dtype(field_type).itemsize
+
+        self.dtype_cache = {}
+
+    '''
+    Get the layout of one serialized message: the length of each of its strings and arrays. With one of them, the total length of the
+    message already gives its layout, so no bytes need to be read.
+    '''
+    def get_layout_key(self, data):
+        if (len(self.unit_size_lst) <= 1):
+            return len(data)
+
+        offset = 0
+        lengths = []
+        for run_size, unit_size in zip(self.run_size_lst[:-1], self.unit_size_lst):
+            offset += run_size
+            length = string_length.unpack_from(data, offset)[0]
+            lengths.append(length)
+            offset += 4 + length * unit_size
+
+        return tuple(lengths)
+
+    '''
+    Get the structured data type for a layout. Strings become fixed-size byte strings and arrays become sub-arrays at their offset in
+    this layout. Empty strings and arrays are left out (they are filled in as '' or an empty array by decode).
+    '''
+    def get_dtype(self, layout_key):
+        if layout_key in self.dtype_cache:
+            return self.dtype_cache[layout_key]
+
+        # Work out the length from the total message length if there is a single string or array
+        if (len(self.unit_size_lst) == 0):
+            lengths = []
+        elif (len(self.unit_size_lst) == 1):
+            size = layout_key - sum(self.run_size_lst) - 4
+            if (size % self.unit_size_lst[0] != 0):
+                raise ValueError(f"'{self.msg_type}' messages don't match the message definition")
+            lengths = [size // self.unit_size_lst[0]]
+        else:
+            lengths = list(layout_key)
+
+        names, formats, offsets = [], [], []
+        offset = 0
+        variable_index = 0
+        for path, field_type in self.fields:
+            unit_size = get_unit_size(field_type)
+
+            if unit_size is not None:
+                length = lengths[variable_index]
+                variable_index += 1
+                offset += 4
+
+                if (length < 0):
+                    raise ValueError(f"'{self.msg_type}' message is too short")
+                elif (length > 0):
+                    names.append(path)
+                    formats.append(f"S{length}" if (field_type == 'string') else (field_type[1], (length,)))
+                    offsets.append(offset)
+                offset += length * unit_size
+            else:
+                names.append(path)
+                formats.append(field_type)
+                offsets.append(offset)
+                offset += np.dtype(field_type).itemsize
+
+        dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': offset})
+        self.dtype_cache[layout_key] = dtype
+
+        return dtype
+
+    '''
+    Decode a list of serialized messages. Messages with the same layout are joined and read with one np.frombuffer call, and their
+    values are put back in the original order. Returns a dictionary of field path : NumPy array. An array field is a 2D array (one row
+    per message) if every message has the same number of elements, and otherwise an object array of 1D arrays.
+    '''
+    def decode(self, data_lst):
+        n_rows = len(data_lst)
+
+        # Group the messages by layout
+        group_dict = {}
+        for index, data in enumerate(data_lst):
+            try:
+                key = self.get_layout_key(data)
+            except struct.error:
+                raise ValueError(f"'{self.msg_type}' message is too short")
+
+            if key in group_dict:
+                group_dict[key].append(index)
+            else:
+                group_dict[key] = [index]
+
+        column_dict = {}
+        for path, field_type in self.fields:
+            if (field_type == 'string'):
+                column_dict[path] = np.full(n_rows, '', dtype = object)
+            elif path in self.array_dict:
+                column_dict[path] = np.empty(n_rows, dtype = object)
+            else:
+                column_dict[path] = np.empty(n_rows, dtype = np.dtype(field_type).newbyteorder('='))
+
+        for key, index_lst in group_dict.items():
+            dtype = self.get_dtype(key)
+
+            buffer = b''.join([data_lst[index] for index in index_lst])
+            if (len(buffer) != dtype.itemsize * len(index_lst)):
+                raise ValueError(f"'{self.msg_type}' messages don't match the message definition")
+
+            values = np.frombuffer(buffer, dtype = dtype)
+            if (len(group_dict) == 1):
+                index_lst = slice(None)   # Every message has the same layout, no need to reorder
+            else:
+                index_lst = np.array(index_lst)
+
+            for path in dtype.names:
+                if path in self.string_paths:
+                    column_dict[path][index_lst] = np.char.decode(values[path], 'utf-8')
+                elif path in self.array_dict:
+                    array_values = values[path].astype(values[path].dtype.newbyteorder('='))
+                    if (len(group_dict) == 1):
+                        column_dict[path] = array_values
+                    else:
+                        for row, index in enumerate(index_lst):
+                            column_dict[path][index] = array_values[row]
+                else:
+                    column_dict[path][index_lst] = values[path]
+
+        # Arrays that were empty in some (or all) of the messages
+        for path, np_type in self.array_dict.items():
+            column = column_dict[path]
+            if (column.dtype == object):
+                np_type = np.dtype(np_type).newbyteorder('=')
+                if (len(group_dict) == 1):
+                    column_dict[path] = np.empty((n_rows, 0), dtype = np_type)
+                else:
+                    for index, value in enumerate(column):
+                        if value is None:
+                            column[index] = np.empty(0, dtype = np_type)
+
+        return column_dict
+
+'''
+Get a StructDecoder for a message definition, or None if the message has arrays of strings or messages (or anything else that can't
+be decoded this way). Decoders are cached by message type and definition.
+'''
+def get_struct_decoder(msg_type, msg_def):
+    cache_key = (msg_type, msg_def)
+
+    if cache_key not in decoder_cache:
+        try:
+            fields = flatten_fields(msg_type, parse_msg_def(msg_type, msg_def))
+            decoder_cache[cache_key] = StructDecoder(msg_type, fields)
+
+        except ValueError:
+            decoder_cache[cache_key] = None
+
+    return decoder_cache[cache_key]
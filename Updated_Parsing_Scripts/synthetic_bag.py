@@ -0,0 +1,520 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script writes synthetic mapping van bag files and CSV files for testing and benchmarking the ingest, so that
+    benchmark_suite.py, benchmark_ingest.py, and async_database.py can run without real drives. It is the only source of
+    synthetic data: the same values can also be made straight into data frames, either shaped like the output of
+    bag_reader.py or like the database tables. Every topic in get_topics.py has a message definition here with the
+    same field names as the real sensors (GPS SparkFun GGA/GST/VTG, encoder, trigger, SICK LMS5xx, Velodyne, and Ouster).
+    The message classes are generated from these definitions with genpy, so no ROS packages other than rosbag and genpy
+    need to be installed.
+
+    The values are random but reproducible: every topic has its own random generator seeded from the topic name and the
+    seed, so the same arguments always write the same files. The bag file and the CSV files written from the same arguments
+    hold the same values, with the CSV files laid out like the ones from the bag_to_csv_py3.py script (one file per topic,
+    named after the topic, with the mapping_dict keys as columns).
+
+    The LiDAR topics are laid out like the real drivers, so both layouts of lidar_blob_store.py are read:
+    /velodyne_packets is a velodyne_msgs/VelodyneScan per rotation (a 'scan'), and /ouster_packets is one
+    ouster_ros/PacketMsg per packet (a single uint8[] buf, a 'packet'), with the frame id of its rotation at byte 10. Their
+    data frames and CSV files hold what the ingest gets for them from a BlobStore: one row of metadata per scan, with the
+    hash of the blob its packets are packed into.
+
+Usage:
+    Use with the benchmark_suite.py, benchmark_ingest.py, and async_database.py scripts, or on its own:
+        python(3) synthetic_bag.py <bag file> [number of messages per topic] [CSV folder]
+
+Method(s):
+    1. get_msg_classes()
+        Generate the message class of every synthetic topic. Returns a dictionary of topic : message class.
+
+    2. make_topic_columns(topic, n_messages, seed = 0)
+        Make the values of every field of a topic. Returns a dictionary of field : NumPy array (or list).
+
+    3. write_synthetic_bag(bag_file, topic_lst, n_messages, seed = 0)
+        Write a bag file with n_messages messages for each topic. Returns the number of messages written.
+
+    4. write_synthetic_csvs(folder, topic_lst, n_rows, seed = 0)
+        Write one CSV file per topic in the bag_to_csv_py3.py layout. Returns the list of CSV files written.
+
+    5. make_velodyne_packets(rng, n_scans, n_packets, model = 'VLP-16')
+        Make the packets of n_scans Velodyne rotations, laid out like the sensor's packets so they can be decoded.
+
+    6. make_bag_df(topic, n_rows, seed = 0)
+        Make a data frame of a topic shaped like the output of bag_reader.py (the mapping_dict keys as columns).
+
+    7. make_table_df(topic, n_rows, bag_files_id, base_station_id, seed = 0)
+        Make a data frame of a topic with the same columns and data types as its database table.
+
+    8. make_scan_df(topic, columns, key_lst)
+        Make the metadata rows of the scans of a LiDAR packet topic, as the blob store extractor of bag_reader.py does.
+'''
+import hashlib
+import os
+import sys
+import zlib
+
+import genpy
+import genpy.dynamic
+import numpy as np
+import polars as pl
+import rosbag
+
+from get_topics import get_topics, get_db_schema
+from lidar_blob_store import get_blob_location, pack_scan, packet_topic_lst
+from velodyne_decoder import packet_dtype, block_flag, velodyne_model_dict
+
+# Separator between the definitions of a message and the messages it uses
+msg_separator = '=' * 80
+
+header_def = '''uint32 seq
+time stamp
+string frame_id'''
+
+# Kind of message : (message type, message definition, definitions of the messages it uses)
+msg_def_dict = {
+    'gga': ('ivsg_synthetic/GPGGA', '''Header header
+float64 GPSSecs
+float64 GPSMicroSecs
+float64 Latitude
+float64 Longitude
+float64 Altitude
+float64 GeoSep
+uint8 NavMode
+uint8 NumOfSats
+float64 HDOP
+float64 AgeOfDiff
+uint8 LockStatus
+string BaseStationID''', {'std_msgs/Header': header_def}),
+
+    'gst': ('ivsg_synthetic/GPGST', '''Header header
+float64 GPSSecs
+float64 GPSMicroSecs
+float64 StdMajor
+float64 StdMinor
+float64 StdOri
+float64 StdLat
+float64 StdLon
+float64 StdAlt''', {'std_msgs/Header': header_def}),
+
+    'vtg': ('ivsg_synthetic/GPVTG', '''Header header
+float64 TrueTrack
+float64 MagTrack
+float64 SpdOverGrndKnots
+float64 SpdOverGrndKmph''', {'std_msgs/Header': header_def}),
+
+    'encoder': ('ivsg_synthetic/Encoder', '''Header header
+string mode
+int64 C1
+int64 C2
+int64 C3
+int64 C4
+int64 P1
+int64 E1
+uint8 err_wrong_element_length
+uint8 err_bad_element_structure
+uint8 err_failed_time
+uint8 err_bad_uppercase_character
+uint8 err_bad_lowercase_character
+uint8 err_bad_character''', {'std_msgs/Header': header_def}),
+
+    'trigger': ('ivsg_synthetic/Trigger', '''Header header
+string mode
+int32 mode_counts
+int32 adjone
+int32 adjtwo
+int32 adjthree
+uint8 err_failed_mode_count
+uint8 err_failed_XI_format
+uint8 err_failed_checkInformation
+uint8 err_trigger_unknown_error_occured
+uint8 err_bad_uppercase_character
+uint8 err_bad_lowercase_character
+uint8 err_bad_three_adj_element
+uint8 err_bad_first_element
+uint8 err_bad_character
+uint8 err_wrong_element_length''', {'std_msgs/Header': header_def}),
+
+    'sick': ('sensor_msgs/LaserScan', '''Header header
+float32 angle_min
+float32 angle_max
+float32 angle_increment
+float32 time_increment
+float32 scan_time
+float32 range_min
+float32 range_max
+float32[] ranges
+float32[] intensities''', {'std_msgs/Header': header_def}),
+
+    'velodyne': ('velodyne_msgs/VelodyneScan', '''Header header
+VelodynePacket[] packets''', {'std_msgs/Header': header_def,
+                              'velodyne_msgs/VelodynePacket': '''time stamp
+uint8[1206] data'''}),
+
+    'ouster': ('ouster_ros/PacketMsg', '''uint8[] buf''', {}),
+}
+
+# Topic : (kind of message, messages per second)
+topic_kind_dict = {'/GPS_SparkFun_Front_GGA': ('gga', 10),
+                   '/GPS_SparkFun_RearLeft_GGA': ('gga', 10),
+                   '/GPS_SparkFun_RearRight_GGA': ('gga', 10),
+                   '/GPS_SparkFun_Front_GST': ('gst', 10),
+                   '/GPS_SparkFun_RearLeft_GST': ('gst', 10),
+                   '/GPS_SparkFun_RearRight_GST': ('gst', 10),
+                   '/GPS_SparkFun_Front_VTG': ('vtg', 10),
+                   '/GPS_SparkFun_RearLeft_VTG': ('vtg', 10),
+                   '/GPS_SparkFun_RearRight_VTG': ('vtg', 10),
+                   '/parseEncoder': ('encoder', 100),
+                   '/parseTrigger': ('trigger', 10),
+                   '/sick_lms_5xx/scan': ('sick', 50),
+                   '/velodyne_packets': ('velodyne', 10),
+                   '/ouster_packets': ('ouster', 640)   # One message per packet, 64 packets per rotation at 10 Hz
+}
+
+# Every topic with a synthetic message
+synthetic_topic_lst = list(topic_kind_dict.keys())
+
+# Points per SICK scan, packets per Velodyne/Ouster rotation, and bytes per Ouster packet (OS1-64, 16 columns of 64 channels)
+sick_points = 1141
+velodyne_packets = 76
+ouster_packets = 64
+ouster_packet_size = 12608
+
+# Start of the first message (2024-06-20 15:25:21, the day of the test bag file)
+start_time = 1718911521
+
+# Cache of generated message classes, keyed by kind of message, and of the packet classes of the Velodyne/Ouster scans
+msg_class_cache = {}
+packet_class_cache = {}
+
+'''
+Generate the message class of every synthetic topic from its definition. Returns a dictionary of topic : message class.
+'''
+def get_msg_classes():
+    for kind, (msg_type, msg_def, dependency_dict) in msg_def_dict.items():
+        if kind not in msg_class_cache:
+            full_def = msg_def
+            for dependency_type, dependency_def in dependency_dict.items():
+                full_def += f"\n{msg_separator}\nMSG: {dependency_type}\n{dependency_def}"
+
+            class_dict = genpy.dynamic.generate_dynamic(msg_type, full_def)
+            msg_class_cache[kind] = class_dict[msg_type]
+
+            # The packet class is the message used by the scan other than the header
+            for dependency_type in dependency_dict:
+                if (dependency_type != 'std_msgs/Header'):
+                    packet_class_cache[kind] = class_dict[dependency_type]
+
+    return {topic : msg_class_cache[kind] for topic, (kind, _) in topic_kind_dict.items()}
+
+'''
+Make the values of every field of a topic, plus the secs and nsecs of each message's header stamp. The random generator is seeded from
+the topic name and the seed, so the values are the same every time. Returns a dictionary of field : NumPy array (or list).
+'''
+def make_topic_columns(topic, n_messages, seed = 0):
+    kind, rate = topic_kind_dict[topic]
+    rng = np.random.default_rng([zlib.crc32(topic.encode('utf-8')), seed])
+
+    # Header stamps at the topic's rate, with a little jitter
+    stamp = start_time + np.arange(n_messages) / rate + rng.random(n_messages) * 0.001
+    secs = np.floor(stamp).astype(np.int64)
+    columns = {'secs': secs,
+               'nsecs': ((stamp - secs) * 10**9).astype(np.int64)}
+
+    if kind in ('gga', 'gst'):
+        gps_stamp = stamp - 0.05
+        columns['GPSSecs'] = np.floor(gps_stamp)
+        columns['GPSMicroSecs'] = np.round((gps_stamp - np.floor(gps_stamp)) * 10**6)
+
+    if (kind == 'gga'):
+        columns['Latitude'] = 40.8623 + np.cumsum(rng.normal(0, 1e-6, n_messages))
+        columns['Longitude'] = -77.8361 + np.cumsum(rng.normal(0, 1e-6, n_messages))
+        columns['Altitude'] = 350 + rng.normal(0, 0.5, n_messages)
+        columns['GeoSep'] = np.full(n_messages, -33.4)
+        columns['NavMode'] = rng.choice([1, 2, 4, 5], n_messages).astype(np.uint8)
+        columns['NumOfSats'] = rng.integers(6, 20, n_messages).astype(np.uint8)
+        columns['HDOP'] = rng.random(n_messages) * 2
+        columns['AgeOfDiff'] = rng.random(n_messages)
+        columns['LockStatus'] = rng.integers(0, 2, n_messages).astype(np.uint8)
+        columns['BaseStationID'] = rng.choice(['"LTI"', '"Test Track"', '"Reber1"', '"Reber2"'], n_messages).tolist()
+
+    elif (kind == 'gst'):
+        for field in ['StdMajor', 'StdMinor', 'StdOri', 'StdLat', 'StdLon', 'StdAlt']:
+            columns[field] = rng.random(n_messages)
+
+    elif (kind == 'vtg'):
+        columns['TrueTrack'] = rng.random(n_messages) * 360
+        columns['MagTrack'] = rng.random(n_messages) * 360
+        columns['SpdOverGrndKnots'] = rng.random(n_messages) * 40
+        columns['SpdOverGrndKmph'] = columns['SpdOverGrndKnots'] * 1.852
+
+    elif kind in ('encoder', 'trigger'):
+        columns['mode'] = rng.choice(['T', 'I', 'L'], n_messages).tolist()
+        for field, _ in get_topics(topic)[1].items():
+            if field in columns or field == 'rosbagTimestamp':
+                continue
+            elif field.startswith('err_'):
+                columns[field] = rng.integers(0, 2, n_messages).astype(np.uint8)
+            elif (kind == 'encoder'):
+                columns[field] = np.cumsum(rng.integers(0, 100, n_messages)).astype(np.int64)
+            else:
+                columns[field] = rng.integers(0, 1000, n_messages).astype(np.int32)
+
+    elif (kind == 'sick'):
+        columns['angle_min'] = np.full(n_messages, -1.658, dtype = np.float32)
+        columns['angle_max'] = np.full(n_messages, 1.658, dtype = np.float32)
+        columns['angle_increment'] = np.full(n_messages, 3.316 / (sick_points - 1), dtype = np.float32)
+        columns['time_increment'] = np.full(n_messages, 1 / (rate * sick_points), dtype = np.float32)
+        columns['scan_time'] = np.full(n_messages, 1 / rate, dtype = np.float32)
+        columns['range_min'] = np.full(n_messages, 0.05, dtype = np.float32)
+        columns['range_max'] = np.full(n_messages, 80, dtype = np.float32)
+        columns['ranges'] = (rng.random((n_messages, sick_points)) * 80).astype(np.float32)
+        columns['intensities'] = (rng.random((n_messages, sick_points)) * 255).astype(np.float32)
+
+    elif (kind == 'velodyne'):
+        columns['packets'] = make_velodyne_packets(rng, n_messages, velodyne_packets)
+
+        # The packets of a scan are spread over the time of one message
+        packet_time = columns['secs'][:, None] * 10**9 + columns['nsecs'][:, None] + (np.arange(velodyne_packets) * 10**9) // (rate * velodyne_packets)
+        columns['packet_secs'] = packet_time // 10**9
+        columns['packet_nsecs'] = packet_time % 10**9
+
+    elif (kind == 'ouster'):
+        # Each message is one packet: the timestamp (nanoseconds), measurement id, and frame id of its first column, then the rest
+        buf = rng.integers(0, 256, (n_messages, ouster_packet_size), dtype = np.uint8)
+        packet_count = np.arange(n_messages)
+        buf[:, 0:8] = (columns['secs'] * 10**9 + columns['nsecs']).astype('<u8').view(np.uint8).reshape(n_messages, 8)
+        buf[:, 8:10] = ((packet_count % ouster_packets) * 16).astype('<u2').view(np.uint8).reshape(n_messages, 2)
+        buf[:, 10:12] = (packet_count // ouster_packets).astype('<u2').view(np.uint8).reshape(n_messages, 2)
+        columns['buf'] = buf
+
+    return columns
+
+'''
+Write a bag file with n_messages messages for each topic of topic_lst (topics without a synthetic message are skipped). The messages
+are written in time order, with each one recorded 2 ms after its header stamp. Returns the number of messages written.
+'''
+def write_synthetic_bag(bag_file, topic_lst, n_messages, seed = 0):
+    msg_class_dict = get_msg_classes()
+    topic_lst = [topic for topic in topic_lst if topic in topic_kind_dict]
+
+    # Make every message first, then write them all in time order
+    msg_lst = []
+    for topic in topic_lst:
+        kind = topic_kind_dict[topic][0]
+        msg_class = msg_class_dict[topic]
+        columns = make_topic_columns(topic, n_messages, seed)
+        field_lst = [field for field in columns if field not in ('secs', 'nsecs', 'packet_secs', 'packet_nsecs')]
+
+        for index in range(n_messages):
+            msg = msg_class()
+            stamp = genpy.Time(int(columns['secs'][index]), int(columns['nsecs'][index]))
+
+            # The Ouster packets have no header
+            if hasattr(msg, 'header'):
+                msg.header.seq = index
+                msg.header.stamp = stamp
+                msg.header.frame_id = topic.strip('/')
+
+            for field in field_lst:
+                value = columns[field][index]
+                if (field == 'packets'):
+                    value = [make_packet(packet_class_cache[kind], packet, genpy.Time(int(columns['packet_secs'][index][count]),
+                                                                                      int(columns['packet_nsecs'][index][count])))
+                             for count, packet in enumerate(value)]
+                elif isinstance(value, np.ndarray) and (value.dtype == np.uint8):
+                    value = value.tobytes()
+                elif isinstance(value, np.ndarray):
+                    value = value.tolist()
+                elif isinstance(value, np.generic):
+                    value = value.item()
+                setattr(msg, field, value)
+
+            msg_lst.append((stamp + genpy.Duration(0, 2000000), topic, msg))
+
+    msg_lst.sort(key = lambda item: item[0])
+
+    with rosbag.Bag(bag_file, 'w') as bag:
+        for record_time, topic, msg in msg_lst:
+            bag.write(topic, msg, t = record_time)
+
+    return len(msg_lst)
+
+'''
+Make one packet of a Velodyne scan message from its bytes.
+'''
+def make_packet(packet_class, data, stamp):
+    packet = packet_class()
+    packet.stamp = stamp
+    packet.data = data.tobytes()
+
+    return packet
+
+'''
+Write one CSV file per topic of topic_lst in the bag_to_csv_py3.py layout: the file is named after the topic ('/parseEncoder' ->
+'_slash_parseEncoder.csv') and has the mapping_dict keys as columns. SICK scans are written as text, like the ranges and intensities
+columns of the database. The Velodyne/Ouster topics are written as the metadata of their scans (see make_scan_df), which is all their
+tables hold. Returns the list of CSV files written.
+'''
+def write_synthetic_csvs(folder, topic_lst, n_rows, seed = 0):
+    os.makedirs(folder, exist_ok = True)
+    csv_file_lst = []
+
+    for topic in topic_lst:
+        if (topic not in topic_kind_dict):
+            continue
+
+        df = make_bag_df(topic, n_rows, seed)
+
+        # Arrays are written as a Python tuple
+        df = df.with_columns([pl.format('({})', pl.col(key).cast(pl.List(pl.Utf8)).list.join(', ')).alias(key)
+                              for key, dtype in df.schema.items() if isinstance(dtype, pl.List)])
+
+        csv_file = os.path.join(folder, f"{topic.replace('/', '_slash_')}.csv")
+        df.write_csv(csv_file)
+        csv_file_lst.append(csv_file)
+
+    return csv_file_lst
+
+'''
+Make the packets of n_scans Velodyne rotations of n_packets packets each, laid out like the sensor's packets (see velodyne_decoder.py)
+so they can be decoded. The sensor turns once per scan, starting a quarter turn in so each rotation is split across two scans, and
+about 5% of the firings have no return. Returns a uint8 array of shape (n_scans, n_packets, 1206).
+'''
+def make_velodyne_packets(rng, n_scans, n_packets, model = 'VLP-16'):
+    model_dict = velodyne_model_dict[model]
+    n_total = n_scans * n_packets
+
+    packets = np.zeros(n_total, dtype = packet_dtype)
+    blocks = packets['blocks']
+
+    block_count = np.arange(n_total * 12)
+    blocks['flag'] = block_flag
+    blocks['azimuth'] = ((9000 + block_count * 36000 // (n_packets * 12)) % 36000).reshape(n_total, 12)
+
+    distance = rng.integers(250, 50000, (n_total, 12, 32))
+    distance[rng.random((n_total, 12, 32)) < 0.05] = 0
+    blocks['channels']['distance'] = distance
+    blocks['channels']['intensity'] = rng.integers(0, 256, (n_total, 12, 32))
+
+    # Microseconds past the hour
+    packets['timestamp'] = (np.arange(n_total) * 12 * model_dict['block_time'] * 10**6).astype(np.int64) % (3600 * 10**6)
+    packets['return_mode'] = 0x37   # Strongest return
+    packets['product_id'] = model_dict['product_id']
+
+    return packets.view(np.uint8).reshape(n_scans, n_packets, packet_dtype.itemsize)
+
+'''
+Make a data frame of a topic shaped like the output of bag_reader.py: the mapping_dict keys of get_topics.py as columns, with the types
+of the message fields rather than the database types, and arrays (the SICK ranges and intensities) as List columns. The values are the
+ones make_topic_columns makes, so they match the synthetic bag file and CSV files, with each message recorded 2 ms after its header
+stamp (rosbagTimestamp). For the LiDAR packet topics, n_rows is the number of messages, and there is one row per scan (make_scan_df).
+'''
+def make_bag_df(topic, n_rows, seed = 0):
+    key_lst = list(get_topics(topic)[1].keys())
+    columns = make_topic_columns(topic, n_rows, seed)
+
+    if topic in packet_topic_lst:
+        return make_scan_df(topic, columns, key_lst)
+
+    columns['rosbagTimestamp'] = columns['secs'] + columns['nsecs'] * 10**(-9) + 0.002
+
+    series_lst = []
+    for key in key_lst:
+        value = columns[key]
+        if isinstance(value, np.ndarray) and (value.ndim == 2):
+            series_lst.append(pl.Series(key, value).cast(pl.List(pl.Float32)))
+        else:
+            series_lst.append(pl.Series(key, value))
+
+    return pl.DataFrame(series_lst)
+
+'''
+Make a data frame of a topic with the same columns and data types as its database table (get_db_schema in get_topics.py), from the
+values of make_bag_df. The new columns are worked out the same way as DFBuilder.update_df (parse_and_insert.py) does, but without the
+database: bag_files_id and base_station_messages_id are set to ids that exist in the database, so the foreign keys are satisfied.
+'''
+def make_table_df(topic, n_rows, bag_files_id, base_station_id, seed = 0):
+    df = make_bag_df(topic, n_rows, seed)
+
+    exp = 10**(-9)
+    new_column_dict = {'bag_files_id': pl.lit(bag_files_id),
+                       'base_station_messages_id': pl.lit(base_station_id),
+                       'ros_publish_time': pl.col('secs') + (pl.col('nsecs') * exp),
+                       'gpstime': pl.col('GPSSecs') + (pl.col('GPSMicroSecs') * exp)}
+
+    # Database column name : name of the column it comes from
+    source_dict = {new_name : original_name for original_name, (new_name, _) in get_topics(topic)[1].items()}
+
+    column_lst = []
+    for col, dtype in get_db_schema(topic).items():
+        column = new_column_dict[col] if (col in new_column_dict) else pl.col(source_dict[col])
+        column_lst.append(column.cast(dtype).alias(col))
+
+    return df.select(column_lst)
+
+'''
+Make the rows PacketBlobExtractor (lidar_blob_store.py) gives for a LiDAR packet topic of the synthetic bag file, from the values of
+make_topic_columns: one row per scan with its stamp, the hash and location of the blob its packets are packed into (pack_scan), the
+size of the blob, and the seconds between its first and last packet. A Velodyne scan is one message, with the times of its packets. An
+Ouster scan is the packets of one frame id, each timed by its record time (2 ms after its stamp), and stamped with the first of them.
+Nothing is written to a blob store. Returns a data frame with the keys of key_lst as columns.
+'''
+def make_scan_df(topic, columns, key_lst):
+    scan_lst = []   # (secs, nsecs, packets, packet times) of each scan
+
+    if (topic_kind_dict[topic][0] == 'velodyne'):
+        for index in range(len(columns['secs'])):
+            times = columns['packet_secs'][index] + columns['packet_nsecs'][index] * 10**(-9)
+            scan_lst.append((columns['secs'][index], columns['nsecs'][index], columns['packets'][index], times))
+
+    else:
+        record_time = columns['secs'] * 10**9 + columns['nsecs'] + 2000000
+        secs = record_time // 10**9
+        nsecs = record_time % 10**9
+
+        for start in range(0, len(secs), ouster_packets):
+            end = start + ouster_packets
+            times = secs[start:end] + nsecs[start:end] * 10**(-9)
+            scan_lst.append((secs[start], nsecs[start], [packet.tobytes() for packet in columns['buf'][start:end]], times))
+
+    hash_lst = []
+    size_lst = []
+    for _, _, packets, times in scan_lst:
+        blob = pack_scan(packets, times)
+        hash_lst.append(hashlib.sha256(blob).hexdigest())
+        size_lst.append(len(blob))
+
+    secs = np.array([scan[0] for scan in scan_lst], dtype = np.int64)
+    nsecs = np.array([scan[1] for scan in scan_lst], dtype = np.int64)
+    column_dict = {'rosbagTimestamp': pl.Series(secs + nsecs * 10**(-9)),
+                   'secs': pl.Series(secs),
+                   'nsecs': pl.Series(nsecs),
+                   'hash_tag': pl.Series(hash_lst, dtype = pl.Utf8),
+                   'location': pl.Series([get_blob_location(hash_tag) for hash_tag in hash_lst], dtype = pl.Utf8),
+                   'file_size': pl.Series(size_lst, dtype = pl.Int64),
+                   'file_time': pl.Series([float(scan[3].max() - scan[3].min()) for scan in scan_lst], dtype = pl.Float32)}
+
+    return pl.DataFrame({key : column_dict[key].alias(key) for key in key_lst})
+
+def main():
+    if (len(sys.argv) < 2) or (len(sys.argv) > 4):
+        print("Usage: python(3) synthetic_bag.py <bag file> [number of messages per topic] [CSV folder]")
+        return
+
+    bag_file = sys.argv[1]
+    n_messages = int(sys.argv[2]) if (len(sys.argv) > 2) else 1000
+
+    n_written = write_synthetic_bag(bag_file, synthetic_topic_lst, n_messages)
+    print(f"Wrote {n_written} messages to '{bag_file}' ({os.path.getsize(bag_file) / 2**20:.1f} MB).")
+
+    if (len(sys.argv) == 4):
+        csv_file_lst = write_synthetic_csvs(sys.argv[3], synthetic_topic_lst, n_messages)
+        print(f"Wrote {len(csv_file_lst)} CSV files to '{sys.argv[3]}'.")
+
+if __name__ == "__main__":
+    main()
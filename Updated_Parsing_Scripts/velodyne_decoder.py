@@ -0,0 +1,359 @@
+'''
+Python 3.10.1 and Python 3.12.3
+
+Written at IVSG.
+Supervised by Professor Sean Brennan
+
+Purpose:
+    This script turns the raw Velodyne packets of /velodyne_packets into point clouds without any ROS tooling
+    (velodyne_pointcloud). The packets come either straight from a bag file or from the LiDAR blob store (see
+    lidar_blob_store.py), and each full rotation of the sensor is written as a .npy file that can be memory-mapped.
+
+    Packets:
+        A Velodyne packet is 1206 bytes: 12 firing blocks of 100 bytes (the flag 0xEEFF, the uint16 azimuth in hundredths of
+        a degree, and 32 channels of a uint16 distance and a uint8 intensity), then the uint32 time of the packet in
+        microseconds past the hour, the return mode, and the product id. A NumPy structured data type with this layout is
+        laid over the packets, so a whole scan of packets is read with one view, without any per-point Python.
+
+        The azimuth in a block is the azimuth of its first firing. The azimuth of every other firing is found from its time
+        in the block and the azimuth of the next block, since the sensor turns at a constant speed. In dual return mode, each
+        pair of blocks holds the two returns of the same firing.
+
+    Points:
+        Each point has x, y, z (meters, in the frame of velodyne_pointcloud: x forward, y left, z up), intensity, ring (the
+        laser, numbered from the lowest to the highest), and time (seconds since the first point of the rotation), all
+        packed into one structured array. Points without a return (a distance of 0) are left out. The time of a point is
+        the ROS stamp of its packet plus the time of its firing in the packet.
+
+        Supported sensors (picked from the product id of the packets, unless given):
+            VLP-16      16 lasers, 2 firings of every laser per block
+            HDL-32E     32 lasers, 1 firing of every laser per block
+
+    Rotations:
+        The packets of a VelodyneScan message don't start at the same azimuth, so the points are cut into rotations where
+        the azimuth wraps around from 360 to 0 degrees, across as many messages (or blobs) as needed. The partial
+        rotations at the start and the end of the bag file are left out.
+
+    Files:
+        Each rotation is written to <folder>/scan_<number>.npy (under a temporary name, then renamed), and a list of the
+        rotations (scan number, file, time of the first point, number of points) to <folder>/scans.csv. A file can be read
+        back with np.load(file_name, mmap_mode = 'r'), so only the points that are used are read from the disk.
+
+Usage:  python(3) velodyne_decoder.py <bag file> [output folder]
+    - Use with lidar_blob_store.py and bag_reader.py
+        decoder = VelodyneDecoder()   # The model is found from the first packet
+        scans = iter_bag_scans('mapping_van_2024-06-20-15-25-21_0.bag')
+        # or, from the blob store: scans = iter_blob_scans(blob_store, df['hash_tag'])   (a velodyne_lidar data frame)
+        index_df = write_rotations(iter_rotations(scans, decoder), 'point_clouds')
+
+        points = read_rotation('point_clouds/scan_000000.npy')   # points['x'], points['ring'], ...
+
+Method(s):
+    1. class VelodyneDecoder(model = None)
+        Decode a scan of Velodyne packets into points.
+
+    2. iter_bag_scans(bag_file, topic = '/velodyne_packets')
+        Read the packets of each VelodyneScan message of a bag file, straight from the serialized messages.
+
+    3. iter_blob_scans(blob_store, hash_lst)
+        Read the packets of each scan from the LiDAR blob store.
+
+    4. iter_rotations(scan_iter, decoder, keep_partial = False)
+        Decode scans of packets and cut the points into full rotations.
+
+    5. write_rotations(rotation_iter, folder)
+        Write each rotation as a .npy file, and the list of rotations as scans.csv.
+
+    6. read_rotation(file_name)
+        Read the points of a rotation as a memory-mapped structured array.
+'''
+import os
+import sys
+import time
+
+import numpy as np
+import polars as pl
+import rosbag
+
+from bag_reader import get_bag_info
+from lidar_blob_store import get_packet_layout, read_scan_message
+
+# Layout of a Velodyne packet
+channel_dtype = np.dtype([('distance', '<u2'), ('intensity', 'u1')])
+block_dtype = np.dtype([('flag', '<u2'), ('azimuth', '<u2'), ('channels', channel_dtype, (32,))])
+packet_dtype = np.dtype([('blocks', block_dtype, (12,)), ('timestamp', '<u4'), ('return_mode', 'u1'), ('product_id', 'u1')])
+
+# Flag at the start of every firing block, and the return mode byte of a dual return packet
+block_flag = 0xEEFF
+dual_return_mode = 0x39
+
+# Meters per unit of distance
+distance_resolution = 0.002
+
+# Model : product id, vertical angle (degrees) and vertical offset (meters) of each laser, time between the firings of two lasers,
+# and time between two firing blocks (seconds)
+velodyne_model_dict = {'VLP-16': {'product_id': 0x22,
+                                  'vertical_angles': [-15, 1, -13, 3, -11, 5, -9, 7, -7, 9, -5, 11, -3, 13, -1, 15],
+                                  'vertical_offsets': [0.0112, -0.0007, 0.0097, -0.0022, 0.0081, -0.0037, 0.0066, -0.0051,
+                                                       0.0051, -0.0066, 0.0037, -0.0081, 0.0022, -0.0097, 0.0007, -0.0112],
+                                  'firing_time': 2.304e-6,
+                                  'block_time': 110.592e-6},
+                       'HDL-32E': {'product_id': 0x21,
+                                   'vertical_angles': [-30.67, -9.33, -29.33, -8.00, -28.00, -6.67, -26.67, -5.33,
+                                                       -25.33, -4.00, -24.00, -2.67, -22.67, -1.33, -21.33, 0.00,
+                                                       -20.00, 1.33, -18.67, 2.67, -17.33, 4.00, -16.00, 5.33,
+                                                       -14.67, 6.67, -13.33, 8.00, -12.00, 9.33, -10.67, 10.67],
+                                   'vertical_offsets': [0.0] * 32,
+                                   'firing_time': 1.152e-6,
+                                   'block_time': 46.08e-6}
+}
+
+# Fields of each point
+point_dtype = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('intensity', '<f4'), ('ring', '<u2'), ('time', '<f4')])
+
+# Name of the list of rotations in the output folder
+scan_index_file_name = 'scans.csv'
+
+'''
+    =================================== Class VelodyneDecoder =====================================
+    #	Purpose: Decode a scan of Velodyne packets into points. The sines, cosines, rings, and firing
+    #            times of the 32 channels of a block are worked out once per model, so decoding is
+    #            only NumPy operations on whole arrays.
+    #
+    #   Methods:
+    #       1. def set_model(self, model)
+    #           Work out the tables of a model ('VLP-16' or 'HDL-32E').
+    #
+    #       2. def decode(self, packets, times)
+    #           Decode packets (a 2D uint8 array with one 1206 byte packet per row), where times is
+    #           the ROS stamp of each packet in seconds. Returns the points (point_dtype), the azimuth
+    #           of each point in hundredths of a degree, and the time of each point in seconds.
+    ===============================================================================================
+'''
+class VelodyneDecoder:
+    def __init__(self, model = None):
+        self.model = None
+        if model is not None:
+            self.set_model(model)
+
+    def set_model(self, model):
+        if model not in velodyne_model_dict:
+            raise ValueError(f"Unknown Velodyne model '{model}', should be one of {list(velodyne_model_dict)}")
+
+        model_dict = velodyne_model_dict[model]
+        n_lasers = len(model_dict['vertical_angles'])
+        self.model = model
+        self.block_time = model_dict['block_time']
+
+        # Laser of each of the 32 channels of a block, and the time of its firing in the block
+        channel = np.arange(32)
+        laser = channel % n_lasers
+        sequence_time = self.block_time / (32 // n_lasers)
+        self.channel_time = (channel // n_lasers) * sequence_time + laser * model_dict['firing_time']
+        self.channel_fraction = (self.channel_time / self.block_time).astype(np.float32)   # Share of the gap to the next block
+
+        vertical_angle = np.radians(np.array(model_dict['vertical_angles']))
+        self.cos_vertical = np.cos(vertical_angle)[laser].astype(np.float32)
+        self.sin_vertical = np.sin(vertical_angle)[laser].astype(np.float32)
+        self.vertical_offset = np.array(model_dict['vertical_offsets'], dtype = np.float32)[laser]
+
+        # Rings are numbered from the lowest laser to the highest
+        self.ring = np.argsort(np.argsort(model_dict['vertical_angles'])).astype(np.uint16)[laser]
+
+    def decode(self, packets, times):
+        packets = np.ascontiguousarray(packets, dtype = np.uint8)
+        if (packets.ndim != 2) or (packets.shape[1] != packet_dtype.itemsize):
+            raise ValueError(f"Velodyne packets should be {packet_dtype.itemsize} bytes, not {packets.shape[-1]}")
+
+        n_packets = packets.shape[0]
+        if (n_packets == 0):
+            return np.empty(0, dtype = point_dtype), np.empty(0, dtype = np.float32), np.empty(0)
+
+        packet = packets.view(packet_dtype).reshape(n_packets)
+        blocks = packet['blocks']
+
+        if self.model is None:
+            model_lst = [model for model, model_dict in velodyne_model_dict.items() if model_dict['product_id'] == packet['product_id'][0]]
+            if (len(model_lst) == 0):
+                raise ValueError(f"Unknown Velodyne product id {packet['product_id'][0]:#x}")
+            self.set_model(model_lst[0])
+
+        # In dual return mode, blocks 2i and 2i + 1 are the two returns of the same firing
+        step = 2 if (packet['return_mode'][0] == dual_return_mode) else 1
+        block_offset = (np.arange(12) // step) * self.block_time
+
+        # Azimuth turned between each firing and the next one (the last firing uses the one before it). A gap from missing packets
+        # is replaced by the usual gap.
+        azimuth = blocks['azimuth'].astype(np.float32)
+        firing_azimuth = azimuth[:, ::step].reshape(-1)
+        gap = np.diff(firing_azimuth, append = firing_azimuth[-1:]) % 36000
+        if (len(gap) > 1):
+            gap[-1] = gap[-2]
+            usual_gap = np.median(gap)
+            gap[gap > 2 * usual_gap] = usual_gap
+        gap = np.repeat(gap.reshape(n_packets, -1), step, axis = 1)
+
+        # Only the points with a return
+        distance = blocks['channels']['distance']
+        valid = (distance > 0) & (blocks['flag'] == block_flag)[:, :, None]
+        packet_index, block_index, channel_index = np.nonzero(valid)
+
+        # Azimuth of each firing, from its time in the block
+        point_azimuth = azimuth[packet_index, block_index] + gap[packet_index, block_index] * self.channel_fraction[channel_index]
+        point_azimuth %= 36000
+        rotation = point_azimuth * np.float32(np.pi / 18000)
+
+        d = distance[valid].astype(np.float32) * np.float32(distance_resolution)
+        xy = d * self.cos_vertical[channel_index]
+
+        points = np.empty(len(d), dtype = point_dtype)
+        points['x'] = xy * np.cos(rotation)
+        points['y'] = -xy * np.sin(rotation)
+        points['z'] = d * self.sin_vertical[channel_index] + self.vertical_offset[channel_index]
+        points['intensity'] = blocks['channels']['intensity'][valid]
+        points['ring'] = self.ring[channel_index]
+
+        point_times = np.asarray(times, dtype = np.float64)[packet_index] + block_offset[block_index] + self.channel_time[channel_index]
+        if (len(point_times) > 0):
+            points['time'] = point_times - point_times[0]
+
+        return points, point_azimuth, point_times
+
+'''
+Read the packets of each VelodyneScan message of a bag file. The messages are read with raw = True and the packets are read straight
+from the serialized bytes (see read_scan_message in lidar_blob_store.py), without making message objects. Yields (packets, times) per
+message: a 2D uint8 array with one packet per row, and the ROS stamp of each packet in seconds.
+'''
+def iter_bag_scans(bag_file, topic = '/velodyne_packets'):
+    bag = rosbag.Bag(bag_file)
+
+    try:
+        topic_info_dict = get_bag_info(bag, [topic])
+        if topic not in topic_info_dict:
+            print(f"\n'{topic}' is not in {bag_file}.")
+            return
+
+        layout = get_packet_layout(topic_info_dict[topic]['msg_type'], topic_info_dict[topic]['msg_def'])
+        if (layout is None) or (layout.kind != 'scan'):
+            raise ValueError(f"'{topic}' ({topic_info_dict[topic]['msg_type']}) doesn't hold scans of Velodyne packets")
+
+        for _, raw_msg, _ in bag.read_messages(topics = [topic], raw = True):
+            _, _, packets, times = read_scan_message(raw_msg[1], layout)
+            yield packets[layout.data_field], times
+
+    finally:
+        bag.close()
+
+'''
+Read the packets of each scan from the LiDAR blob store, in the order of hash_lst (for example, the velodyne_lidar_hash_tag column of
+the table, sorted by time). The blobs are memory-mapped, so the packets are only read from the disk as they are decoded. Yields
+(packets, times) per scan, as iter_bag_scans does.
+'''
+def iter_blob_scans(blob_store, hash_lst):
+    for hash_tag in hash_lst:
+        index, packets = blob_store.read_scan(hash_tag)
+        yield packets, index['time']
+
+'''
+Decode each scan of packets from scan_iter with the decoder and cut the points into full rotations, where the azimuth wraps around from
+360 to 0 degrees (a drop of more than 180 degrees from one point to the next). A rotation can take points from more than one scan. The
+partial rotations at the start and the end are left out, unless keep_partial is True. Yields (time of the first point in seconds,
+points) per rotation, with the time of each point from the first point of its rotation.
+'''
+def iter_rotations(scan_iter, decoder, keep_partial = False):
+    piece_lst = []          # (points, point times) of the rotation so far
+    last_azimuth = None
+    is_first = True
+
+    '''
+    Join the pieces of a rotation, with the time of each point from the first point.
+    '''
+    def join_pieces():
+        points = np.concatenate([points for points, _ in piece_lst])
+        point_times = np.concatenate([point_times for _, point_times in piece_lst])
+        points['time'] = point_times - point_times[0]
+        return point_times[0], points
+
+    for packets, times in scan_iter:
+        points, azimuth, point_times = decoder.decode(packets, times)
+        if (len(points) == 0):
+            continue
+
+        # The first point of each new rotation
+        diff = np.diff(azimuth, prepend = azimuth[0] if (last_azimuth is None) else last_azimuth)
+        cut_lst = np.flatnonzero(diff < -18000)
+        last_azimuth = azimuth[-1]
+
+        start = 0
+        for cut in cut_lst:
+            piece_lst.append((points[start:cut], point_times[start:cut]))
+            if (not is_first or keep_partial) and (sum(len(points) for points, _ in piece_lst) > 0):
+                yield join_pieces()
+            is_first = False
+            piece_lst = []
+            start = cut
+
+        piece_lst.append((points[start:], point_times[start:]))
+
+    if keep_partial and (len(piece_lst) > 0):
+        yield join_pieces()
+
+'''
+Write each rotation from rotation_iter (see iter_rotations) into folder as scan_<number>.npy, under a temporary name that is renamed
+once the file is complete, and the list of rotations as scans.csv. Prints the number of rotations and points, and the points/sec.
+Returns the list of rotations as a data frame (scan, file_name, start_time, n_points).
+'''
+def write_rotations(rotation_iter, folder):
+    os.makedirs(folder, exist_ok = True)
+    start_time = time.time()
+
+    scan_lst = []
+    file_lst = []
+    start_time_lst = []
+    count_lst = []
+
+    for scan, (rotation_time, points) in enumerate(rotation_iter):
+        file_name = f"scan_{scan:06d}.npy"
+        temp_file = os.path.join(folder, f".{file_name}.tmp")
+        with open(temp_file, 'wb') as npy_file:
+            np.save(npy_file, points)
+        os.replace(temp_file, os.path.join(folder, file_name))
+
+        scan_lst.append(scan)
+        file_lst.append(file_name)
+        start_time_lst.append(rotation_time)
+        count_lst.append(len(points))
+
+    index_df = pl.DataFrame({'scan': pl.Series(scan_lst, dtype = pl.Int64),
+                             'file_name': pl.Series(file_lst, dtype = pl.Utf8),
+                             'start_time': pl.Series(start_time_lst, dtype = pl.Float64),
+                             'n_points': pl.Series(count_lst, dtype = pl.Int64)})
+    index_df.write_csv(os.path.join(folder, scan_index_file_name))
+
+    total_time = time.time() - start_time
+    n_points = sum(count_lst)
+    print(f"\nWrote {len(scan_lst)} rotations ({n_points} points) to '{folder}' in {total_time:.1f} seconds "
+          f"({n_points / max(total_time, 1e-9):.0f} points/sec).")
+
+    return index_df
+
+'''
+Read the points of a rotation written by write_rotations. The file is memory-mapped, so only the points (and fields) that are used are
+read from the disk. Returns a structured array of point_dtype.
+'''
+def read_rotation(file_name):
+    return np.load(file_name, mmap_mode = 'r')
+
+def main():
+    if (len(sys.argv) not in [2, 3]):
+        print("Usage: python(3) velodyne_decoder.py <bag file> [output folder]")
+        sys.exit(1)
+
+    bag_file = sys.argv[1]
+    folder = sys.argv[2] if (len(sys.argv) == 3) else f"{os.path.basename(bag_file)[:-4]}_point_clouds"
+
+    decoder = VelodyneDecoder()
+    write_rotations(iter_rotations(iter_bag_scans(bag_file), decoder), folder)
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,51 @@ This script connects to a PostgreSQL server using psycopg2.
 It uses the PostgreSQL COPY FROM command for fast ingestion directly from a buffer to the specified table.
 
 Polars is used to read CSV files efficiently.
+
+Upload modes:
+    stream:   the bytes of the CSV file are sent to COPY ... FROM STDIN as they are read, without being parsed in Python.
+              The header line names the columns, so the CSV columns can be in any order.
+    validate: the CSV file is read in batches with Polars, the columns are projected (optionally to a subset) and cast to the
+              data types of the table, and each batch is sent to COPY. Bad values are reported with the file and batch
+              instead of failing half way through a COPY.
+    parse:    the original behavior, the whole file is read into a Polars DataFrame and written back out for COPY.
+
+Usage:
+    python csv_to_servers.py <CSV file> <table name> [--mode stream|validate|parse]
+    python csv_to_servers.py <folder of CSV files> [--mode stream|validate|parse] [--workers 4]
+
+    In the folder mode, every CSV file is uploaded to the table with the same name as the file (without '.csv'), with up to
+    --workers files uploading at once over a pool of connections. The MB/s and rows/s of each file are printed.
 """
 
 # Import necessary libraries
+import argparse  # For reading the command line arguments
+import csv  # For reading the header line of a CSV file
+import os  # For listing folders and file sizes
+import time  # For timing each upload
+from concurrent.futures import ThreadPoolExecutor, as_completed  # For uploading several files at once
+from io import BytesIO, StringIO  # For handling in-memory file-like objects
+
 import polars as pl  # Faster for reading and processing large datasets
 import psycopg2  # For handling database operations
-from io import StringIO  # For handling in-memory file-like objects
+import psycopg2.pool  # For sharing connections between the upload threads
+
+# Number of bytes psycopg2 reads from the file for each message of COPY FROM STDIN
+copy_read_size = 1024 * 1024
+
+# PostgreSQL data type (as in information_schema.columns) : Polars data type used to validate a column. Any other type is
+# sent as text and left for PostgreSQL to parse.
+pg_type_dict = {
+    'smallint': pl.Int16,
+    'integer': pl.Int32,
+    'bigint': pl.Int64,
+    'real': pl.Float32,
+    'double precision': pl.Float64,
+    'numeric': pl.Float64,
+    'text': pl.Utf8,
+    'character varying': pl.Utf8,
+    'character': pl.Utf8,
+}
 
 # Function to create a database connection
 def create_db_connection(host, port, dbname, user, password):
@@ -44,6 +83,9 @@ def upload_csv_to_postgresql(csv_path, table_name, conn):
     csv_path (str): Path to the CSV file
     table_name (str): Target table name in the database
     conn: Active database connection object
+
+    Returns:
+    int: Number of rows uploaded
     """
     # Load data from CSV file into a Polars DataFrame
     df = pl.read_csv(csv_path)
@@ -63,6 +105,270 @@ def upload_csv_to_postgresql(csv_path, table_name, conn):
     conn.commit()
     cursor.close()
 
+    return df.height
+
+# Function to quote a list of column names for a COPY command
+def quote_columns(columns):
+    """
+    Quotes column names so they can be used in a COPY column list.
+
+    Args:
+    columns (list): Column names
+
+    Returns:
+    str: The quoted column names separated by commas
+    """
+    return ', '.join('"' + column.replace('"', '""') + '"' for column in columns)
+
+# Function to stream the bytes of a CSV file straight into COPY
+def stream_csv_to_postgresql(csv_path, table_name, conn, columns=None):
+    """
+    Streams a CSV file into a PostgreSQL table with COPY ... FROM STDIN, without parsing it in Python. The header line
+    gives the column list of the COPY, so the columns of the file don't need to be in the same order as the table.
+
+    Args:
+    csv_path (str): Path to the CSV file
+    table_name (str): Target table name in the database
+    conn: Active database connection object
+    columns (list): Column names to use instead of the header line (the header line is still skipped)
+
+    Returns:
+    int: Number of rows uploaded
+
+    Raises:
+    ValueError: If the file is empty (there is no header line to take the columns from)
+    """
+    with open(csv_path, 'rb') as csv_file:
+        # Read the header line, the rest of the file is sent as it is
+        header = csv_file.readline().decode('utf-8-sig')
+        if not header.strip():
+            raise ValueError(f"{csv_path}: empty CSV file, there is no header line")
+        if columns is None:
+            columns = next(csv.reader([header]))
+
+        cursor = conn.cursor()
+        cursor.copy_expert(f"COPY {table_name} ({quote_columns(columns)}) FROM STDIN WITH (FORMAT csv)", csv_file, size=copy_read_size)
+        row_count = cursor.rowcount
+
+    conn.commit()
+    cursor.close()
+
+    return row_count
+
+# Function to get the data types of the columns of a table
+def get_table_schema(table_name, conn):
+    """
+    Gets the columns of a table and the Polars data type each one is validated with.
+
+    Args:
+    table_name (str): Table name in the database
+    conn: Active database connection object
+
+    Returns:
+    dict: Column name : Polars data type (None for types that are left for PostgreSQL to parse), in table order
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT column_name, data_type FROM information_schema.columns "
+                   "WHERE table_name = %s ORDER BY ordinal_position;", (table_name,))
+    schema = {column: pg_type_dict.get(data_type) for column, data_type in cursor.fetchall()}
+    cursor.close()
+
+    if not schema:
+        raise ValueError(f"Table '{table_name}' does not exist")
+
+    return schema
+
+# Function to validate and project a CSV file in batches and upload each batch with COPY
+def validate_csv_to_postgresql(csv_path, table_name, conn, columns=None, batch_size=100000):
+    """
+    Reads a CSV file in batches with Polars, keeps only the columns that are in the table (or only the given columns),
+    casts each one to the data type of its table column, and uploads each batch with COPY. Values that can't be cast
+    raise an error naming the file and batch. The whole file is committed at once, so a bad batch uploads nothing.
+
+    Args:
+    csv_path (str): Path to the CSV file
+    table_name (str): Target table name in the database
+    conn: Active database connection object
+    columns (list): Columns to upload (default: every column of the file that is also in the table)
+    batch_size (int): Number of rows per batch
+
+    Returns:
+    int: Number of rows uploaded
+    """
+    table_schema = get_table_schema(table_name, conn)
+    file_columns = pl.scan_csv(csv_path).collect_schema().names()
+
+    # Project to the columns that are both in the file and in the table
+    if columns is None:
+        columns = [column for column in file_columns if column in table_schema]
+    missing = [column for column in columns if column not in file_columns or column not in table_schema]
+    if missing:
+        raise ValueError(f"{csv_path}: columns {missing} are not in both the file and '{table_name}'")
+
+    # Read every column as text, then cast strictly so that bad values are caught here
+    lazy_df = pl.scan_csv(csv_path, infer_schema=False).select(
+        [pl.col(column).cast(table_schema[column], strict=True) if table_schema[column] is not None else pl.col(column)
+         for column in columns]
+    )
+
+    cursor = conn.cursor()
+    row_count = 0
+    batch_number = 0
+
+    try:
+        batches = iter(lazy_df.collect_batches(chunk_size=batch_size))
+        while True:
+            # Counted before the batch is pulled, since a value that can't be cast raises while the batch is read
+            batch_number += 1
+            batch = next(batches, None)
+            if batch is None:
+                break
+
+            csv_buffer = BytesIO()
+            batch.write_csv(csv_buffer, include_header=False)
+            csv_buffer.seek(0)
+
+            cursor.copy_expert(f"COPY {table_name} ({quote_columns(columns)}) FROM STDIN WITH (FORMAT csv)", csv_buffer, size=copy_read_size)
+            row_count += batch.height
+
+    except pl.exceptions.InvalidOperationError as e:
+        conn.rollback()
+        cursor.close()
+        raise ValueError(f"{csv_path}: batch {batch_number} (after {row_count} rows) has values that don't match '{table_name}': {e}")
+
+    except Exception:
+        conn.rollback()
+        cursor.close()
+        raise
+
+    conn.commit()
+    cursor.close()
+
+    return row_count
+
+# Function to upload one CSV file and measure how fast it went
+def upload_csv_file(csv_path, table_name, conn, mode='stream'):
+    """
+    Uploads one CSV file with the chosen mode and times it.
+
+    Args:
+    csv_path (str): Path to the CSV file
+    table_name (str): Target table name in the database
+    conn: Active database connection object
+    mode (str): 'stream', 'validate', or 'parse'
+
+    Returns:
+    dict: file, table, rows, MB, seconds, MB/s, and rows/s of the upload
+    """
+    start_time = time.perf_counter()
+
+    if mode == 'stream':
+        row_count = stream_csv_to_postgresql(csv_path, table_name, conn)
+    elif mode == 'validate':
+        row_count = validate_csv_to_postgresql(csv_path, table_name, conn)
+    elif mode == 'parse':
+        row_count = upload_csv_to_postgresql(csv_path, table_name, conn)
+    else:
+        raise ValueError(f"Unknown upload mode: '{mode}'")
+
+    seconds = time.perf_counter() - start_time
+    size_mb = os.path.getsize(csv_path) / 2**20
+
+    return {
+        'file': csv_path,
+        'table': table_name,
+        'rows': row_count,
+        'MB': size_mb,
+        'seconds': seconds,
+        'MB/s': size_mb / seconds if seconds > 0 else 0,
+        'rows/s': row_count / seconds if seconds > 0 else 0,
+    }
+
+# Function to upload one CSV file with a connection from the pool
+def upload_csv_file_pooled(csv_path, table_name, pool, mode='stream'):
+    """
+    Takes a connection from the pool, uploads one CSV file, and gives the connection back.
+
+    Args:
+    csv_path (str): Path to the CSV file
+    table_name (str): Target table name in the database
+    pool: psycopg2 ThreadedConnectionPool
+    mode (str): 'stream', 'validate', or 'parse'
+
+    Returns:
+    dict: Upload statistics (see upload_csv_file)
+    """
+    conn = pool.getconn()
+    try:
+        return upload_csv_file(csv_path, table_name, conn, mode)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+# Function to print the statistics of one upload
+def print_upload_stats(stats):
+    """
+    Prints the rows, size, time, MB/s, and rows/s of one upload.
+
+    Args:
+    stats (dict): Upload statistics (see upload_csv_file)
+    """
+    print(f"{os.path.basename(stats['file'])} -> {stats['table']}: {stats['rows']} rows, {stats['MB']:.1f} MB "
+          f"in {stats['seconds']:.2f} s ({stats['MB/s']:.1f} MB/s, {stats['rows/s']:.0f} rows/s)")
+
+# Function to upload every CSV file in a folder
+def upload_csv_directory(directory, host, port, dbname, user, password, mode='stream', workers=4, table_names=None):
+    """
+    Uploads every CSV file in a folder to its table, with up to `workers` files uploading at once. Each upload thread
+    takes its own connection from a shared pool. The statistics of each file are printed as it finishes.
+
+    Args:
+    directory (str): Folder of CSV files
+    host, port, dbname, user, password (str): Database connection details
+    mode (str): 'stream', 'validate', or 'parse'
+    workers (int): Number of files to upload at once
+    table_names (dict): File name : table name (default: the file name without '.csv')
+
+    Returns:
+    list: Statistics of each file that was uploaded (see upload_csv_file)
+    """
+    csv_files = sorted(f for f in os.listdir(directory) if f.endswith('.csv'))
+    if table_names is None:
+        table_names = {f: f[:-4] for f in csv_files}
+
+    pool = psycopg2.pool.ThreadedConnectionPool(1, workers, host=host, port=port, dbname=dbname, user=user, password=password)
+    stats_list = []
+    start_time = time.perf_counter()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(upload_csv_file_pooled, os.path.join(directory, f), table_names[f], pool, mode): f
+                for f in csv_files
+            }
+
+            for future in as_completed(futures):
+                try:
+                    stats = future.result()
+                    stats_list.append(stats)
+                    print_upload_stats(stats)
+                except Exception as e:
+                    print(f"{futures[future]}: upload failed: {e}")
+
+    finally:
+        pool.closeall()
+
+    # Print the totals
+    seconds = time.perf_counter() - start_time
+    total_mb = sum(stats['MB'] for stats in stats_list)
+    total_rows = sum(stats['rows'] for stats in stats_list)
+    print(f"Uploaded {len(stats_list)} of {len(csv_files)} files: {total_rows} rows, {total_mb:.1f} MB in {seconds:.2f} s "
+          f"({total_mb / seconds if seconds > 0 else 0:.1f} MB/s, {total_rows / seconds if seconds > 0 else 0:.0f} rows/s)")
+
+    return stats_list
+
 # Main function to execute the process
 def main():
     # Database credentials and details
@@ -73,16 +379,30 @@ def main():
     password = 'your_password'
     csv_path = 'path_to_your_csv.csv'
     table_name = 'your_table_name'
-    
+
+    # A CSV file (and its table) or a folder of CSV files can also be given on the command line
+    parser = argparse.ArgumentParser(description="Upload CSV files to PostgreSQL with COPY")
+    parser.add_argument('path', nargs='?', default=csv_path, help="CSV file or folder of CSV files")
+    parser.add_argument('table', nargs='?', default=table_name, help="Target table (CSV file only)")
+    parser.add_argument('--mode', choices=['stream', 'validate', 'parse'], default='stream', help="Upload mode")
+    parser.add_argument('--workers', type=int, default=4, help="Files to upload at once (folder only)")
+    args = parser.parse_args()
+
+    # Upload every CSV file in the folder
+    if os.path.isdir(args.path):
+        upload_csv_directory(args.path, host, port, dbname, user, password, args.mode, args.workers)
+        return
+
     # Create database connection
     conn = create_db_connection(host, port, dbname, user, password)
-    
+
     # Upload CSV to PostgreSQL
-    upload_csv_to_postgresql(csv_path, table_name, conn)
-    
+    stats = upload_csv_file(args.path, args.table, conn, args.mode)
+    print_upload_stats(stats)
+
     # Close the database connection
     conn.close()
 
 # Execute the main function
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()